@@ -0,0 +1,670 @@
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from models import MODEL_SETTINGS, build_model, input_density, sparse_input_linear
+from execution import set_execution_mode, set_checkpointing, format_input, autocast, to_float
+from quantization import encode_decode, quantize_dynamic_dSprite, check_quantization
+from inference import freeze, check_freeze, export_onnx, ONNXModel, test_onnx_parity
+from distillation import StudentVAE, count_parameters
+from profiler import count_macs, saved_activation_bytes
+from lowrank import compress_low_rank
+from engine import vae_losses, Engine, Callback, ReconstructionCallback
+from visualization import VisualizationWriter
+from ensemble import ModelEnsemble, EnsembleEngine
+import distributed
+
+
+DSPRITES_ROOT = './dsprites-dataset/dsprites_ndarray_co1sh3sc6or40x32y32_64x64.npz'
+
+
+def generate_inputs(model, batch_size=16) :
+	# binary-ish images in [0,1], as expected by the binary cross entropy :
+	return torch.rand( (batch_size, model.img_depth, model.img_dim, model.img_dim) )
+
+def load_dsprites(root=DSPRITES_ROOT) :
+	# the whole dSprites dataset as a (N,1,64,64) uint8 tensor of binary images :
+	dataset_zip = np.load(root)
+	return torch.from_numpy(dataset_zip['imgs']).unsqueeze(1)
+
+def vae_loss(model, out, images, mu, log_var) :
+	# the training loss of the engine :
+	return vae_losses(model, out, images, mu, log_var)['total_loss']
+
+def measure_throughput(fn, x, nbr_iter=10, nbr_warmup=3) :
+	# returns the number of images per second processed by fn :
+	for _ in range(nbr_warmup) :
+		fn(x)
+	start = time.perf_counter()
+	for _ in range(nbr_iter) :
+		fn(x)
+	elapsed = time.perf_counter() - start
+	return nbr_iter*x.size(0)/elapsed
+
+def measure_latency(fn, x, nbr_iter=10, nbr_warmup=3) :
+	# returns the mean latency per call in milliseconds :
+	for _ in range(nbr_warmup) :
+		fn(x)
+	start = time.perf_counter()
+	for _ in range(nbr_iter) :
+		fn(x)
+	elapsed = time.perf_counter() - start
+	return 1e3*elapsed/nbr_iter
+
+def inference_step(model) :
+	def step(x) :
+		with torch.no_grad() :
+			return model(x)
+	return step
+
+def training_step(model, optimizer) :
+	def step(x) :
+		with autocast(model, x.device.type) :
+			out, mu, log_var = model(x)
+		out, mu, log_var = to_float(out, mu, log_var)
+		loss = vae_loss(model, out, x, mu, log_var)
+		optimizer.zero_grad()
+		loss.backward()
+		optimizer.step()
+		return loss
+	return step
+
+def print_table(header, rows) :
+	widths = [ max( len(str(r[i])) for r in [header]+rows ) for i in range(len(header)) ]
+	line = ' | '.join( '{:<'+str(w)+'}' for w in widths )
+	print(line.format(*header))
+	print('-+-'.join( '-'*w for w in widths ))
+	for r in rows :
+		print(line.format(*r))
+
+
+def benchmark_execution(names=None, batch_size=16, nbr_iter=10, **kwargs) :
+	# img/s in inference and training for the default NCHW eager mode, channels_last, and channels_last + torch.compile :
+	if names is None :
+		names = list(MODEL_SETTINGS.keys())
+
+	modes = [ ('eager', dict()),
+			('channels_last', dict(channels_last=True)),
+			('channels_last+compile', dict(channels_last=True, compile=True)) ]
+
+	rows = []
+	for name in names :
+		reference = build_model(name)
+		state_dict = reference.state_dict()
+		baseline = None
+
+		for mode, options in modes :
+			model = build_model(name)
+			model.load_state_dict(state_dict)
+			model = set_execution_mode(model, **options)
+			x = format_input(model, generate_inputs(model, batch_size=batch_size))
+
+			model.eval()
+			infer = measure_throughput(inference_step(model), x, nbr_iter=nbr_iter)
+			model.train()
+			optimizer = torch.optim.Adam( model.parameters(), lr=1e-5)
+			train = measure_throughput(training_step(model, optimizer), x, nbr_iter=nbr_iter)
+
+			if baseline is None :
+				baseline = (infer, train)
+			rows.append( [name, mode, '{:.1f}'.format(infer), '{:.2f}x'.format(infer/baseline[0]), '{:.1f}'.format(train), '{:.2f}x'.format(train/baseline[1])] )
+
+	print_table( ['model', 'mode', 'inference img/s', 'speedup', 'training img/s', 'speedup'], rows)
+	return rows
+
+
+def benchmark_bf16(batch_size=64, nbr_iter=1000, root=DSPRITES_ROOT, log_interval=100, seed=0, lr=1e-4, **kwargs) :
+	# trains betaVAEdSprite twice from the same initialization, on the same batches and with the same
+	# reparameterization noise, in float32 and under bfloat16 autocast, and compares the loss curves :
+	imgs = load_dsprites(root)
+	generator = torch.Generator().manual_seed(seed)
+	indexes = torch.randint( len(imgs), (nbr_iter, batch_size), generator=generator)
+
+	torch.manual_seed(seed)
+	reference = build_model('betaVAEdSprite', beta=4.0)
+	state_dict = reference.state_dict()
+
+	curves = {}
+	summary = []
+	for bf16 in [False, True] :
+		mode = 'bf16' if bf16 else 'fp32'
+		model = build_model('betaVAEdSprite', beta=4.0)
+		model.load_state_dict(state_dict)
+		model = set_execution_mode(model, bf16=bf16)
+		optimizer = torch.optim.Adam( model.parameters(), lr=lr)
+		step = training_step(model, optimizer)
+
+		torch.manual_seed(seed)
+		losses = []
+		start = time.perf_counter()
+		for it in range(nbr_iter) :
+			images = imgs[indexes[it]].float()
+			losses.append( step(images).item() )
+		elapsed = time.perf_counter() - start
+
+		curves[mode] = losses
+		activations = saved_activation_bytes(model, imgs[indexes[0]].float())
+		summary.append( [mode, '{:.1f}'.format(nbr_iter*batch_size/elapsed), '{:.1f}'.format(activations/2**20)] )
+
+	rows = []
+	for start in range(0, nbr_iter, log_interval) :
+		fp32 = np.mean( curves['fp32'][start:start+log_interval] )
+		bf16 = np.mean( curves['bf16'][start:start+log_interval] )
+		rows.append( [start+log_interval, '{:.2f}'.format(fp32), '{:.2f}'.format(bf16), '{:.2f}%'.format(100.0*(bf16-fp32)/fp32)] )
+
+	print_table( ['step', 'fp32 loss', 'bf16 loss', 'relative difference'], rows)
+	print('')
+	print_table( ['mode', 'training img/s', 'autograd saved MB'], summary)
+	return curves
+
+
+def training_dsprites(imgs, indexes) :
+	# dSprites images as load_dSprite feeds them to the model : ToTensor reads the (1,64,64) array of Rescale as (H,W,C),
+	# which transposes the frame once viewed as (1,64,64), and divides the uint8 pixels by 255.
+	return imgs[indexes].float().transpose(-1,-2) / 255.0
+
+def benchmark_dynamic_quantization(batch_sizes=(1,32,256), nbr_iter=50, root=DSPRITES_ROOT, seed=0, **kwargs) :
+	# latency and throughput of the float and dynamically quantized int8 betaVAEdSprite, on dSprites images :
+	imgs = load_dsprites(root)
+	generator = torch.Generator()
+	generator.manual_seed(seed)
+	model = build_model('betaVAEdSprite').eval()
+	quantized = quantize_dynamic_dSprite(model)
+	check_quantization(model, quantized, training_dsprites(imgs, torch.randint( len(imgs), (256,), generator=generator) ) )
+
+	rows = []
+	for batch_size in batch_sizes :
+		x = training_dsprites(imgs, torch.randint( len(imgs), (batch_size,), generator=generator) )
+		for mode, m in [('fp32', model), ('int8', quantized)] :
+			def step(x) :
+				with torch.no_grad() :
+					return encode_decode(m, x)
+			latency = measure_latency(step, x, nbr_iter=nbr_iter)
+			rows.append( [batch_size, mode, '{:.3f}'.format(latency), '{:.1f}'.format(1e3*batch_size/latency)] )
+
+	print_table( ['batch', 'mode', 'latency ms', 'img/s'], rows)
+	return rows
+
+
+def benchmark_freeze(names=None, batch_size=16, nbr_iter=10, **kwargs) :
+	# encode and decode latencies of the eval-mode models before and after the BatchNorm folding :
+	if names is None :
+		names = list(MODEL_SETTINGS.keys())
+
+	rows = []
+	for name in names :
+		model = build_model(name)
+		x = generate_inputs(model, batch_size=batch_size)
+		# non-trivial BatchNorm running statistics :
+		with torch.no_grad() :
+			for _ in range(3) :
+				model(x)
+		model.eval()
+
+		frozen = freeze(model)
+		check_freeze(model, frozen, x)
+		with torch.no_grad() :
+			z, _ = torch.chunk( model.encoder(x), 2, dim=1 )
+
+		timings = []
+		for m in [model, frozen] :
+			def encode(x) :
+				with torch.no_grad() :
+					return m.encoder(x)
+			def decode(z) :
+				with torch.no_grad() :
+					return m.decoder(z)
+			timings.append( (measure_latency(encode, x, nbr_iter=nbr_iter), measure_latency(decode, z, nbr_iter=nbr_iter)) )
+
+		(encode_ms, decode_ms), (fencode_ms, fdecode_ms) = timings
+		rows.append( [name, '{:.2f}'.format(encode_ms), '{:.2f}'.format(fencode_ms), '{:.2f}x'.format(encode_ms/fencode_ms), '{:.2f}'.format(decode_ms), '{:.2f}'.format(fdecode_ms), '{:.2f}x'.format(decode_ms/fdecode_ms)] )
+
+	print_table( ['model', 'encode ms', 'folded encode ms', 'speedup', 'decode ms', 'folded decode ms', 'speedup'], rows)
+	return rows
+
+
+def benchmark_onnx(names=None, batch_size=16, nbr_iter=10, intra_op_threads=0, inter_op_threads=0, **kwargs) :
+	# encode and decode latencies of the (BatchNorm-folded) models in PyTorch and in ONNX Runtime :
+	if names is None :
+		names = list(MODEL_SETTINGS.keys())
+
+	rows = []
+	output_dir = tempfile.mkdtemp()
+	for name in names :
+		model = freeze( build_model(name).eval() )
+		encoder_path, decoder_path = export_onnx(model, output_dir, name)
+		onnx_model = ONNXModel(encoder_path, decoder_path, intra_op_threads=intra_op_threads, inter_op_threads=inter_op_threads)
+
+		x = generate_inputs(model, batch_size=batch_size)
+		test_onnx_parity(model, onnx_model, x)
+		with torch.no_grad() :
+			z, _ = torch.chunk( model.encoder(x), 2, dim=1 )
+
+		def encode(x) :
+			with torch.no_grad() :
+				return model.encoder(x)
+		def decode(z) :
+			with torch.no_grad() :
+				return model.decoder(z)
+		encode_ms = measure_latency(encode, x, nbr_iter=nbr_iter)
+		decode_ms = measure_latency(decode, z, nbr_iter=nbr_iter)
+		oencode_ms = measure_latency(onnx_model.encode, x.numpy(), nbr_iter=nbr_iter)
+		odecode_ms = measure_latency(onnx_model.decode, z.numpy(), nbr_iter=nbr_iter)
+
+		rows.append( [name, '{:.2f}'.format(encode_ms), '{:.2f}'.format(oencode_ms), '{:.2f}x'.format(encode_ms/oencode_ms), '{:.2f}'.format(decode_ms), '{:.2f}'.format(odecode_ms), '{:.2f}x'.format(decode_ms/odecode_ms)] )
+
+	print_table( ['model', 'torch encode ms', 'ort encode ms', 'speedup', 'torch decode ms', 'ort decode ms', 'speedup'], rows)
+	return rows
+
+
+def checkpointing_run(name, encoder_segments, decoder_segments, batch_size, nbr_iter, queue) :
+	# runs in a fresh process, so that its peak resident memory only accounts for this configuration :
+	model = build_model(name)
+	set_checkpointing(model, encoder_segments=encoder_segments, decoder_segments=decoder_segments)
+	optimizer = torch.optim.Adam( model.parameters(), lr=1e-5)
+	x = generate_inputs(model, batch_size=batch_size)
+
+	# ru_maxrss is in kB on Linux :
+	baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	throughput = measure_throughput(training_step(model, optimizer), x, nbr_iter=nbr_iter, nbr_warmup=1)
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	queue.put( (throughput, (peak-baseline)/1024.0) )
+
+def benchmark_checkpointing(names=('betaVAEXYS','betaVAEXYS2'), batch_sizes=(16,32,64), nbr_iter=5, batch_size=None, **kwargs) :
+	# memory/throughput trade-off of the activation checkpointing, per (encoder, decoder) number of segments :
+	if batch_size is not None :
+		batch_sizes = (batch_size,)
+	context = multiprocessing.get_context('spawn')
+
+	rows = []
+	for name in names :
+		net_depth = MODEL_SETTINGS[name]['net_depth']
+		configurations = [(0,0), (1,0), (0,1), (1,1), (2,2), (net_depth,net_depth)]
+		for batch_size in batch_sizes :
+			for encoder_segments, decoder_segments in configurations :
+				queue = context.Queue()
+				process = context.Process( target=checkpointing_run, args=(name, encoder_segments, decoder_segments, batch_size, nbr_iter, queue) )
+				process.start()
+				throughput, peak = queue.get()
+				process.join()
+				rows.append( [name, batch_size, encoder_segments, decoder_segments, '{:.0f}'.format(peak), '{:.2f}'.format(throughput)] )
+
+	print_table( ['model', 'batch', 'encoder segments', 'decoder segments', 'peak training MB', 'training img/s'], rows)
+	return rows
+
+
+def benchmark_distillation(names=('betaVAEXYS','betaVAEXYS2'), widths=(8,16,32), depth=4, batch_size=16, nbr_iter=10, **kwargs) :
+	# parameters and encode cost of the teacher encoders and of student encoders of several widths :
+	rows = []
+	for name in names :
+		teacher = build_model(name).eval()
+		x = generate_inputs(teacher, batch_size=batch_size)
+		students = [ ('teacher', teacher) ] + [ ('student w{} d{}'.format(width, depth), StudentVAE(teacher, width=width, depth=depth).eval()) for width in widths ]
+
+		teacher_ms = None
+		for label, model in students :
+			def encode(x) :
+				with torch.no_grad() :
+					return model.encoder(x)
+			latency = measure_latency(encode, x[:1], nbr_iter=nbr_iter)
+			throughput = measure_throughput(encode, x, nbr_iter=nbr_iter)
+			if teacher_ms is None :
+				teacher_ms = latency
+			rows.append( [name, label, count_parameters(model.encoder), '{:.2f}'.format(latency), '{:.2f}x'.format(teacher_ms/latency), '{:.2f}'.format(throughput)] )
+
+	print_table( ['model', 'encoder', 'parameters', 'latency ms (batch 1)', 'speedup', 'encode img/s'], rows)
+	return rows
+
+
+def benchmark_separable(names=('betaVAEXYS','betaVAEXYS2','betaVAEXYS3'), batch_size=16, nbr_iter=10, nbr_train_iter=500, seed=0, lr=1e-4, **kwargs) :
+	# dense vs depthwise-separable convolutions : MACs and parameters of the encoder and decoder, CPU img/s,
+	# and the reconstruction loss after a fixed budget of nbr_train_iter training steps on the XYS dataset,
+	# from the same seed and on the same batches :
+	dataset = None
+	if nbr_train_iter > 0 :
+		try :
+			from datasetXYS import load_dataset_XYS
+			dataset = load_dataset_XYS(img_dim=MODEL_SETTINGS[names[0]]['img_dim'])
+		except Exception as e :
+			print('EXCEPTION : XYS DATASET : {} : skipping the training budget.'.format(e) )
+
+	rows = []
+	for name in names :
+		for separable in [False, True] :
+			torch.manual_seed(seed)
+			model = build_model(name, separable=separable)
+			x = generate_inputs(model, batch_size=batch_size)
+			with torch.no_grad() :
+				z, _ = torch.chunk( model.encoder(x), 2, dim=1 )
+			encoder_macs = count_macs(model.encoder, x)
+			decoder_macs = count_macs(model.decoder, z)
+			params = sum( p.numel() for p in model.parameters() )
+
+			model.eval()
+			infer = measure_throughput(inference_step(model), x, nbr_iter=nbr_iter)
+			model.train()
+			optimizer = torch.optim.Adam( model.parameters(), lr=lr)
+			train = measure_throughput(training_step(model, optimizer), x, nbr_iter=nbr_iter)
+
+			reconst = 'n/a'
+			if dataset is not None :
+				torch.manual_seed(seed)
+				model = build_model(name, separable=separable)
+				optimizer = torch.optim.Adam( model.parameters(), lr=lr)
+				data_loader = torch.utils.data.DataLoader(dataset=dataset, batch_size=batch_size, shuffle=True, generator=torch.Generator().manual_seed(seed) )
+				losses = []
+				while len(losses) < nbr_train_iter :
+					for sample in data_loader :
+						images = sample['image'].float().view(-1, model.img_depth, model.img_dim, model.img_dim)
+						out, mu, log_var = model(images)
+						loss = vae_loss(model, out, images, mu, log_var)
+						optimizer.zero_grad()
+						loss.backward()
+						optimizer.step()
+						losses.append( F.binary_cross_entropy( out.detach(), images, reduction='sum').item()/images.size(0) )
+						if len(losses) >= nbr_train_iter :
+							break
+				# mean reconstruction loss per image over the last 10% of the budget :
+				reconst = '{:.2f}'.format( np.mean( losses[-max(1,nbr_train_iter//10):] ) )
+
+			rows.append( [name, 'separable' if separable else 'dense', params, '{:.3f}'.format(encoder_macs/1e9), '{:.3f}'.format(decoder_macs/1e9), '{:.1f}'.format(infer), '{:.1f}'.format(train), reconst] )
+
+	print_table( ['model', 'convolutions', 'parameters', 'encoder GMACs/img', 'decoder GMACs/img', 'inference img/s', 'training img/s', 'reconst loss after {} steps'.format(nbr_train_iter)], rows)
+	return rows
+
+
+def benchmark_multires(patch_dims=(32,64), batch_size=16, nbr_iter=10, **kwargs) :
+	# encoder cost of the stacked betaVAEXYS2 (three full-resolution channels) and of the multi-resolution
+	# stacked encoder (full frame + shared eye stem on patch_dim patches), on the same stacked inputs :
+	configurations = [ ('betaVAEXYS2', dict()) ] + [ ('betaVAEXYSMultiRes', dict(patch_dim=patch_dim)) for patch_dim in patch_dims ]
+
+	rows = []
+	baseline = None
+	for name, options in configurations :
+		model = build_model(name, **options)
+		x = generate_inputs(model, batch_size=batch_size)
+		macs = count_macs(model.encoder, x)
+		params = sum( p.numel() for p in model.encoder.parameters() )
+
+		model.eval()
+		def encode(x) :
+			with torch.no_grad() :
+				return model.encoder(x)
+		infer = measure_throughput(encode, x, nbr_iter=nbr_iter)
+		model.train()
+		optimizer = torch.optim.Adam( model.parameters(), lr=1e-5)
+		train = measure_throughput(training_step(model, optimizer), x, nbr_iter=nbr_iter)
+
+		if baseline is None :
+			baseline = (macs, infer)
+		label = name if len(options) == 0 else '{} patch {}'.format(name, options['patch_dim'])
+		rows.append( [label, params, '{:.3f}'.format(macs/1e9), '{:.2f}x'.format(baseline[0]/macs), '{:.1f}'.format(infer), '{:.2f}x'.format(infer/baseline[1]), '{:.1f}'.format(train)] )
+
+	print_table( ['encoder', 'parameters', 'GMACs/img', 'reduction', 'encode img/s', 'speedup', 'training img/s'], rows)
+	return rows
+
+
+def reconstruction_error(model, x) :
+	# binary cross entropy per image of the deterministic reconstructions, decoded from mu :
+	model.eval()
+	with torch.no_grad() :
+		out, mu, _ = encode_decode(model, x)
+		error = F.binary_cross_entropy( out.view(x.shape), x, reduction='sum').item()/x.size(0)
+	model.train()
+	return error, mu
+
+def benchmark_low_rank(ranks=(None,256,128,64,32), batch_size=64, nbr_iter=10, nbr_train_iter=1000, root=DSPRITES_ROOT, seed=0, lr=1e-4, **kwargs) :
+	# betaVAEdSprite with rank-r factorized layers :
+	# - trained from scratch for nbr_train_iter steps, from the same seed and on the same batches,
+	# - obtained by SVD-compressing the dense model trained above,
+	# with their parameters, MACs, img/s and reconstruction error on held-out images.
+	imgs = load_dsprites(root)
+	generator = torch.Generator().manual_seed(seed)
+	indexes = torch.randint( len(imgs), (nbr_train_iter, batch_size), generator=generator)
+	held_out = imgs[ torch.randint( len(imgs), (1024,), generator=generator) ].float()
+
+	def costs(model) :
+		x = held_out[:batch_size]
+		params = sum( p.numel() for p in model.parameters() )
+		macs = count_macs(model.encoder, x) + count_macs(model.decoder, torch.zeros( (1, model.z_dim) ))
+		model.eval()
+		infer = measure_throughput(inference_step(model), x, nbr_iter=nbr_iter)
+		model.train()
+		return params, macs, infer
+
+	dense = None
+	rows = []
+	for rank in ranks :
+		torch.manual_seed(seed)
+		model = build_model('betaVAEdSprite', beta=4.0, rank=rank)
+		optimizer = torch.optim.Adam( model.parameters(), lr=lr)
+		step = training_step(model, optimizer)
+		start = time.perf_counter()
+		for it in range(nbr_train_iter) :
+			step( imgs[indexes[it]].float() )
+		train = nbr_train_iter*batch_size/(time.perf_counter()-start)
+
+		params, macs, infer = costs(model)
+		error, _ = reconstruction_error(model, held_out)
+		if rank is None :
+			dense = model
+		rows.append( ['dense' if rank is None else rank, params, '{:.2f}'.format(macs/1e6), '{:.1f}'.format(infer), '{:.1f}'.format(train), '{:.2f}'.format(error)] )
+
+	print('FROM SCRATCH : {} training steps of batch {} :'.format(nbr_train_iter, batch_size) )
+	print_table( ['rank', 'parameters', 'MMACs/img', 'inference img/s', 'training img/s', 'reconst BCE/img'], rows)
+
+	compressed_rows = []
+	if dense is not None :
+		dense_error, dense_mu = reconstruction_error(dense, held_out)
+		for rank in ranks :
+			if rank is None :
+				continue
+			compressed, energies = compress_low_rank(dense, rank)
+			params, macs, infer = costs(compressed)
+			error, mu = reconstruction_error(compressed, held_out)
+			compressed_rows.append( [rank, params, '{:.2f}'.format(macs/1e6), '{:.1f}'.format(infer), '{:.4f}'.format( min(energies.values()) ), '{:.2f}'.format(error), '{:+.2f}'.format(error-dense_error), '{:.4f}'.format( (mu-dense_mu).abs().mean().item() )] )
+
+		print('')
+		print('SVD COMPRESSION of the dense model (reconst BCE/img {:.2f}) :'.format(dense_error) )
+		print_table( ['rank', 'parameters', 'MMACs/img', 'inference img/s', 'min retained energy', 'reconst BCE/img', 'difference', 'mean |mu error|'], compressed_rows)
+	return rows, compressed_rows
+
+
+def benchmark_sparse(batch_sizes=(1,16,64,256), nbr_iter=20, root=DSPRITES_ROOT, seed=0, **kwargs) :
+	# dense vs sparse input path of the first EncoderdSprite layer, on dSprites batches :
+	# latency of the layer alone in inference, and img/s of full training steps.
+	imgs = load_dsprites(root)
+	generator = torch.Generator().manual_seed(seed)
+
+	torch.manual_seed(seed)
+	reference = build_model('betaVAEdSprite', beta=4.0)
+	state_dict = reference.state_dict()
+
+	rows = []
+	for batch_size in batch_sizes :
+		x = imgs[ torch.randint( len(imgs), (batch_size,), generator=generator) ].float()
+		density = input_density(x)
+		flat = x.view(batch_size, -1)
+
+		timings = []
+		for threshold in [0.0, 1.0] :
+			model = build_model('betaVAEdSprite', beta=4.0)
+			model.load_state_dict(state_dict)
+			model = set_execution_mode(model, sparse_threshold=threshold)
+			def first_layer(x) :
+				with torch.no_grad() :
+					if threshold > 0.0 :
+						return sparse_input_linear(model.encoder.fc, x)
+					return model.encoder.fc(x)
+			latency = measure_latency(first_layer, flat, nbr_iter=nbr_iter)
+			optimizer = torch.optim.Adam( model.parameters(), lr=1e-4)
+			train = measure_throughput(training_step(model, optimizer), x, nbr_iter=nbr_iter)
+			timings.append( (latency, train) )
+
+		(dense_ms, dense_train), (sparse_ms, sparse_train) = timings
+		rows.append( [batch_size, '{:.4f}'.format(density), '{:.3f}'.format(dense_ms), '{:.3f}'.format(sparse_ms), '{:.2f}x'.format(dense_ms/sparse_ms), '{:.1f}'.format(dense_train), '{:.1f}'.format(sparse_train), '{:.2f}x'.format(sparse_train/dense_train)] )
+
+	print_table( ['batch', 'density', 'dense fc ms', 'sparse fc ms', 'speedup', 'dense training img/s', 'sparse training img/s', 'speedup'], rows)
+	return rows
+
+
+class StepTimer(Callback) :
+	# wall time of each step, callbacks included :
+	def on_train_begin(self, engine) :
+		self.durations = []
+		self.last = time.perf_counter()
+
+	def on_step_end(self, engine, metrics) :
+		now = time.perf_counter()
+		self.durations.append(now-self.last)
+		self.last = now
+
+def benchmark_visualization(names=('betaVAEXYS2',), batch_size=16, nbr_iter=60, reconst_interval=10, **kwargs) :
+	# step times of the engine when the reconstruction grids are encoded on the training thread
+	# or in the background process, with the default and the lowest PNG compression :
+	path = 'benchmark-visualization'
+	os.makedirs('./beta-data/{}/reconst_images/'.format(path), exist_ok=True)
+	rows = []
+	for name in names :
+		model = build_model(name, beta=1.0)
+		dataset = torch.utils.data.TensorDataset( generate_inputs(model, batch_size=nbr_iter*batch_size) )
+		data_loader = torch.utils.data.DataLoader(dataset=dataset, batch_size=batch_size, shuffle=False)
+		fixed_x = generate_inputs(model, batch_size=batch_size)
+		for mode, compress_level in [('sync', 6), ('background', 6), ('background', 0)] :
+			writer = VisualizationWriter(compress_level=compress_level) if mode == 'background' else None
+			timer = StepTimer()
+			callbacks = [ ReconstructionCallback(fixed_x, path, interval=reconst_interval, writer=writer), timer ]
+			optimizer = torch.optim.Adam( model.parameters(), lr=1e-4)
+			Engine(model, optimizer, data_loader, nbr_epoch=1, callbacks=callbacks).run()
+			if writer is not None :
+				writer.close()
+
+			# the first interval of steps is the warmup, the reconstructions then happen every reconst_interval steps :
+			durations = 1e3*np.array(timer.durations[reconst_interval:])
+			spikes = durations[::reconst_interval]
+			rows.append( [name, mode, compress_level, '{:.2f}'.format(np.median(durations)), '{:.2f}'.format(np.mean(spikes)), '{:.2f}'.format(durations.max())] )
+
+	print_table( ['model', 'encoding', 'png level', 'median step ms', 'reconstruction step ms', 'max step ms'], rows)
+	return rows
+
+
+def ddp_run(rank, nproc, name, batch_size, nbr_iter, port, queue) :
+	# one process of a local gloo process group, with its share of the cores :
+	os.environ.update( MASTER_ADDR='127.0.0.1', MASTER_PORT=str(port) )
+	torch.distributed.init_process_group('gloo', rank=rank, world_size=nproc)
+	torch.set_num_threads( max(1, (os.cpu_count() or 1) // nproc) )
+
+	torch.manual_seed(0)
+	model = build_model(name, beta=1.0)
+	# only the shard of the process is generated, the images of the other processes would only be skipped by its sampler :
+	torch.manual_seed(1+rank)
+	dataset = torch.utils.data.TensorDataset( generate_inputs(model, batch_size=(nbr_iter+2)*batch_size) )
+	data_loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=False)
+	optimizer = torch.optim.Adam( model.parameters(), lr=1e-4)
+	timer = StepTimer()
+	Engine(model, optimizer, data_loader, nbr_epoch=1, callbacks=[timer], parallel_model=distributed.parallelize(model)).run()
+
+	# the first 2 steps are the warmup :
+	elapsed = sum(timer.durations[2:])
+	if rank == 0 :
+		queue.put( nproc*batch_size*len(timer.durations[2:])/elapsed )
+	torch.distributed.destroy_process_group()
+
+def benchmark_ddp(names=('betaVAEXYS2',), nprocs=None, batch_size=16, nbr_iter=10, port=29511, **kwargs) :
+	# global training img/s of DistributedDataParallel over gloo with 1 to N local processes (batch_size images per process),
+	# the cores of the machine being split between the processes :
+	if nprocs is None :
+		nprocs = [1]
+		while 2*nprocs[-1] <= (os.cpu_count() or 1) and nprocs[-1] < 8 :
+			nprocs.append(2*nprocs[-1])
+	context = multiprocessing.get_context('spawn')
+
+	rows = []
+	for name in names :
+		reference = None
+		for nproc in nprocs :
+			queue = context.Queue()
+			processes = [ context.Process( target=ddp_run, args=(rank, nproc, name, batch_size, nbr_iter, port, queue) ) for rank in range(nproc) ]
+			for process in processes :
+				process.start()
+			throughput = queue.get()
+			for process in processes :
+				process.join()
+			if reference is None :
+				reference = throughput
+			rows.append( [name, nproc, max(1, (os.cpu_count() or 1) // nproc), nproc*batch_size, '{:.2f}'.format(throughput), '{:.2f}x'.format(throughput/reference), '{:.0f}%'.format(100.0*throughput/(reference*nproc))] )
+
+	print_table( ['model', 'processes', 'threads/process', 'global batch', 'training img/s', 'speedup', 'efficiency'], rows)
+	return rows
+
+def benchmark_ensemble(names=('betaVAEXYS2',), sizes=(1,2,4,8), batch_size=16, nbr_iter=10, **kwargs) :
+	# training throughput of M models (model-images/s, i.e. images/s per model times M) trained on the same batches,
+	# either vmap-ed in a single ModelEnsemble step or as M independent models stepped one after the other :
+	rows = []
+	for name in names :
+		for nbr_models in sizes :
+			ensemble = ModelEnsemble(name, betas=[ 10.0**m for m in range(nbr_models) ], lrs=[1e-4], seeds=list(range(nbr_models)) )
+			x = generate_inputs(ensemble.model, batch_size=batch_size)
+			# the training step of ensemble.train_ensemble, without its data loader :
+			engine = EnsembleEngine(ensemble, ensemble.optimizer, [x])
+			vmapped = nbr_models*measure_throughput(engine.train_step, x, nbr_iter=nbr_iter)
+
+			steps = []
+			for m in range(nbr_models) :
+				model = build_model(name, beta=10.0**m)
+				steps.append( training_step(model, torch.optim.Adam( model.parameters(), lr=1e-4)) )
+			independent = nbr_models*measure_throughput(lambda x : [ step(x) for step in steps ], x, nbr_iter=nbr_iter)
+
+			rows.append( [name, nbr_models, '{:.2f}'.format(vmapped/nbr_models), '{:.2f}'.format(vmapped), '{:.2f}'.format(independent), '{:.2f}x'.format(vmapped/independent)] )
+
+	print_table( ['model', 'models', 'vmap img/s per model', 'vmap model-img/s', 'independent model-img/s', 'speedup'], rows)
+	return rows
+
+
+BENCHMARKS = {
+	'execution' : benchmark_execution,
+	'bf16' : benchmark_bf16,
+	'dynamic_quantization' : benchmark_dynamic_quantization,
+	'freeze' : benchmark_freeze,
+	'onnx' : benchmark_onnx,
+	'checkpointing' : benchmark_checkpointing,
+	'distillation' : benchmark_distillation,
+	'separable' : benchmark_separable,
+	'multires' : benchmark_multires,
+	'low_rank' : benchmark_low_rank,
+	'sparse' : benchmark_sparse,
+	'visualization' : benchmark_visualization,
+	'ddp' : benchmark_ddp,
+	'ensemble' : benchmark_ensemble,
+}
+
+if __name__ == '__main__' :
+	import argparse
+	parser = argparse.ArgumentParser(description='beta-VAE CPU benchmarks')
+	parser.add_argument('--bench', type=str, default='execution', choices=list(BENCHMARKS.keys()))
+	parser.add_argument('--models', type=str, default=None, help='comma-separated list among : {}'.format(','.join(MODEL_SETTINGS.keys())) )
+	parser.add_argument('--batch', type=int, default=None)
+	parser.add_argument('--iter', type=int, default=None)
+	parser.add_argument('--threads', type=int, default=None)
+	parser.add_argument('--root', type=str, default=DSPRITES_ROOT)
+	args = parser.parse_args()
+
+	if args.threads is not None :
+		torch.set_num_threads(args.threads)
+
+	# only override the defaults of each benchmark with the options that were given :
+	options = dict(root=args.root)
+	if args.models is not None :
+		options['names'] = args.models.split(',')
+	if args.batch is not None :
+		options['batch_size'] = args.batch
+	if args.iter is not None :
+		options['nbr_iter'] = args.iter
+
+	BENCHMARKS[args.bench](**options)
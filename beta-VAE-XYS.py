@@ -14,18 +14,28 @@ from PIL import Image
 
 from models import Rescale, betaVAE, betaVAEdSprite, betaVAEXYS, betaVAEXYS2, Bernoulli
 from datasetXYS import load_dataset_XYS
+from visualization import save_traversal
+from execution import set_execution_mode, format_input, autocast, to_float
+from quantization import quantize_static_encoder, calibration_batches, report_static_quantization
+from distillation import load_or_distill, report_distillation
+from engine import train_model
+from distributed import init_distributed
+from datasets import make_data_loader
+from shared_dataset import attach_dataset
 
-use_cuda = True
+use_cuda = torch.cuda.is_available()
 
 
-def setting(nbr_epoch=100,offset=0,train=True,batch_size=32, evaluate=False):	
+def setting(nbr_epoch=100,offset=0,train=True,batch_size=32, evaluate=False,channels_last=False,compile=False,bf16=False,quantize=False,checkpoint_encoder=0,checkpoint_decoder=0,distill=False,student_width=16,student_depth=4,distill_epoch=10,separable=False,log_interval=10,resume=False,micro_batch=0,memory_budget=0,shared_dataset=None):	
 	size = 256
-	dataset = load_dataset_XYS(img_dim=size)
+	if train and shared_dataset :
+		# the decoded images of a shared-memory dataset server, which must hold this dataset :
+		dataset = attach_dataset(shared_dataset, expected=dict(dataset='XYS', img_dim=size, stacking=False))
+	else :
+		dataset = load_dataset_XYS(img_dim=size)
 
 	# Data loader
-	data_loader = torch.utils.data.DataLoader(dataset=dataset,
-    	                                      batch_size=batch_size, 
-        	                                  shuffle=True)
+	data_loader = make_data_loader(dataset, batch_size=batch_size)
 
 	# Model :
 	'''
@@ -37,7 +47,7 @@ def setting(nbr_epoch=100,offset=0,train=True,batch_size=32, evaluate=False):
 	global use_cuda
 	net_depth = 5
 	beta = 5000e0
-	betavae = betaVAEXYS(beta=beta,net_depth=net_depth,z_dim=z_dim,img_dim=img_dim,img_depth=img_depth,conv_dim=conv_dim, use_cuda=use_cuda)
+	betavae = betaVAEXYS(beta=beta,net_depth=net_depth,z_dim=z_dim,img_dim=img_dim,img_depth=img_depth,conv_dim=conv_dim, use_cuda=use_cuda, separable=separable)
 	'''
 	frompath = True
 	z_dim = 10
@@ -47,7 +57,7 @@ def setting(nbr_epoch=100,offset=0,train=True,batch_size=32, evaluate=False):
 	global use_cuda
 	net_depth = 5
 	beta = 1000e0
-	betavae = betaVAEXYS2(beta=beta,net_depth=net_depth,z_dim=z_dim,img_dim=img_dim,img_depth=img_depth,conv_dim=conv_dim, use_cuda=use_cuda)
+	betavae = betaVAEXYS2(beta=beta,net_depth=net_depth,z_dim=z_dim,img_dim=img_dim,img_depth=img_depth,conv_dim=conv_dim, use_cuda=use_cuda, separable=separable)
 	print(betavae)
 
 
@@ -58,12 +68,14 @@ def setting(nbr_epoch=100,offset=0,train=True,batch_size=32, evaluate=False):
 		
 
 	path = 'test--XYS--img{}-lr{}-beta{}-layers{}-z{}-conv{}'.format(img_dim,lr,beta,net_depth,z_dim,conv_dim)
+	if separable :
+		path+= '-separable'
 	if not os.path.exists( './beta-data/{}/'.format(path) ) :
-		os.mkdir('./beta-data/{}/'.format(path))
+		os.makedirs('./beta-data/{}/'.format(path), exist_ok=True)
 	if not os.path.exists( './beta-data/{}/gen_images/'.format(path) ) :
-			os.mkdir('./beta-data/{}/gen_images/'.format(path))
+			os.makedirs('./beta-data/{}/gen_images/'.format(path), exist_ok=True)
 	if not os.path.exists( './beta-data/{}/reconst_images/'.format(path) ) :
-			os.mkdir('./beta-data/{}/reconst_images/'.format(path))
+			os.makedirs('./beta-data/{}/reconst_images/'.format(path), exist_ok=True)
 	
 	
 	SAVE_PATH = './beta-data/{}'.format(path) 
@@ -75,165 +87,39 @@ def setting(nbr_epoch=100,offset=0,train=True,batch_size=32, evaluate=False):
 		except Exception as e :
 			print('EXCEPTION : NET LOADING : {}'.format(e) )
 
+	betavae = set_execution_mode(betavae, channels_last=channels_last, compile=compile, bf16=bf16, checkpoint_encoder=checkpoint_encoder, checkpoint_decoder=checkpoint_decoder)
+
+	if distill and not train :
+		# lightweight student encoder, distilled from the encoder of the trained model, with the same decoder :
+		teacher_betavae = betavae
+		betavae = load_or_distill(teacher_betavae, data_loader, SAVE_PATH, width=student_width, depth=student_depth, nbr_epoch=distill_epoch)
+		report_distillation(teacher_betavae, betavae, calibration_batches(data_loader, nbr_batches=10) )
+
+	if quantize and not train :
+		# static int8 quantization of the encoder, calibrated on the dataset :
+		float_betavae = betavae
+		betavae = quantize_static_encoder(float_betavae, calibration_batches(data_loader) )
+		report_static_quantization(float_betavae, betavae, calibration_batches(data_loader, nbr_batches=10) )
+
 	if train :
-		train_model(betavae,data_loader, optimizer, SAVE_PATH,path,nbr_epoch=nbr_epoch,batch_size=batch_size,offset=offset)
+		train_model(betavae,data_loader, optimizer, SAVE_PATH,path,nbr_epoch=nbr_epoch,offset=offset,log_interval=log_interval,resume=resume,micro_batch=micro_batch,memory_budget=memory_budget*2**20 if memory_budget > 0 else None)
 	else :
 		if evaluate :
-			evaluate_disentanglement(betavae, dataset, nbr_epoch=nbr_epoch)
+			accuracy = evaluate_disentanglement(betavae, dataset, nbr_epoch=nbr_epoch)
+			if quantize :
+				float_accuracy = evaluate_disentanglement(float_betavae, dataset, nbr_epoch=nbr_epoch)
+				print('LINEAR PROBE ACCURACY : fp32 : {} // int8 : {}'.format(float_accuracy, accuracy) )
+			if distill :
+				teacher_accuracy = evaluate_disentanglement(teacher_betavae, dataset, nbr_epoch=nbr_epoch)
+				print('LINEAR PROBE ACCURACY : teacher : {} // student : {}'.format(teacher_accuracy, accuracy) )
 		else :
 			query_XYS(betavae, data_loader,path)
 
 
 
-def train_model(betavae,data_loader, optimizer, SAVE_PATH,path,nbr_epoch=100,batch_size=32, offset=0) :
-	global use_cuda
-	
-	z_dim = betavae.z_dim
-	img_depth=betavae.img_depth
-	img_dim = betavae.img_dim
-
-	data_iter = iter(data_loader)
-	iter_per_epoch = len(data_loader)
-
-	# Debug :
-	# fixed inputs for debugging
-	fixed_z = Variable(torch.randn(45, z_dim))
-	if use_cuda :
-		fixed_z = fixed_z.cuda()
-
-	sample = next(data_iter)
-	fixed_x, _ = sample['image'], sample['landmarks']
-	
-	fixed_x = fixed_x.view( (-1, img_depth, img_dim, img_dim) )
-	torchvision.utils.save_image(fixed_x.cpu(), './beta-data/{}/real_images.png'.format(path))
-	
-	fixed_x = Variable(fixed_x.view(fixed_x.size(0), img_depth, img_dim, img_dim)).float()
-	if use_cuda :
-		fixed_x = fixed_x.cuda()
-
-	out = torch.zeros((1,1))
-
-	# variations over the latent variable :
-	sigma_mean = torch.ones((z_dim))
-	mu_mean = torch.zeros((z_dim))
-
-	best_loss = None
-	best_model_wts = betavae.state_dict()
-	
-	for epoch in range(nbr_epoch):
-		
-		# Save generated variable images :
-		nbr_steps = 8
-		mu_mean /= batch_size
-		sigma_mean /= batch_size
-		gen_images = torch.ones( (8, img_depth, img_dim, img_dim) )
-
-		for latent in range(z_dim) :
-			#var_z0 = torch.stack( [mu_mean]*nbr_steps, dim=0)
-			var_z0 = torch.zeros(nbr_steps, z_dim)
-			val = mu_mean[latent]-sigma_mean[latent]
-			step = 2.0*sigma_mean[latent]/nbr_steps
-			print(latent,mu_mean[latent],step)
-			for i in range(nbr_steps) :
-				var_z0[i] = mu_mean
-				var_z0[i][latent] = val
-				val += step
-
-			var_z0 = Variable(var_z0)
-			if use_cuda :
-				var_z0 = var_z0.cuda()
-
-
-			gen_images_latent = betavae.decoder(var_z0)
-			gen_images_latent = gen_images_latent.view(-1, img_depth, img_dim, img_dim).cpu().data
-			gen_images = torch.cat( [gen_images,gen_images_latent], dim=0)
-
-		#torchvision.utils.save_image(gen_images.data.cpu(),'./beta-data/{}/gen_images/dim{}/{}.png'.format(path,latent,(epoch+1)) )
-		torchvision.utils.save_image(gen_images,'./beta-data/{}/gen_images/{}.png'.format(path,(epoch+offset+1)) )
-
-		mu_mean = 0.0
-		sigma_mean = 0.0
-
-		epoch_loss = 0.0
-		
-
-		for i, sample in enumerate(data_loader):
-			images = sample['image']
-			# Save the reconstructed images
-			if i % 100 == 0 :
-				reconst_images, _, _ = betavae(fixed_x)
-				reconst_images = reconst_images.view(-1, img_depth, img_dim, img_dim).cpu().data
-				orimg = fixed_x.cpu().data.view(-1, img_depth, img_dim, img_dim)
-				ri = torch.cat( [orimg, reconst_images], dim=2)
-				torchvision.utils.save_image(ri,'./beta-data/{}/reconst_images/{}.png'.format(path,(epoch+offset+1) ) )
-			
-			
-			images = Variable( (images.view(-1, img_depth,img_dim, img_dim) ) ).float()
-			
-			if use_cuda :
-				images = images.cuda() 
-
-			out, mu, log_var = betavae(images)
-			
-			mu_mean += torch.mean(mu.data,dim=0)
-			sigma_mean += torch.mean( torch.sqrt( torch.exp(log_var.data) ), dim=0 )
-
-			# Compute :
-			#reconstruction loss :
-			reconst_loss = F.binary_cross_entropy( out, images, size_average=False)
-			#reconst_loss = nn.MultiLabelSoftMarginLoss()(input=out_logits, target=images)
-			#reconst_loss = F.binary_cross_entropy_with_logits( input=out, target=images, size_average=False)
-			#reconst_loss = F.binary_cross_entropy( Bernoulli(out).sample(), images, size_average=False)
-			#reconst_loss = torch.mean( (out.view(-1) - images.view(-1))**2 )
-			
-			# expected log likelyhood :
-			expected_log_lik = torch.mean( Bernoulli( out.view((-1)) ).log_prob( images.view((-1)) ) )
-			#expected_log_lik = torch.mean( Bernoulli( out ).log_prob( images ) )
-
-			# kl divergence :
-			kl_divergence = 0.5 * torch.mean( torch.sum( (mu**2 + torch.exp(log_var) - log_var -1), dim=1) )
-			#kl_divergence = 0.5 * torch.sum( (mu**2 + torch.exp(log_var) - log_var -1) )
-
-			# ELBO :
-			elbo = expected_log_lik - betavae.beta * kl_divergence
-			
-			# TOTAL LOSS :
-			total_loss = reconst_loss + betavae.beta*kl_divergence
-			#total_loss = reconst_loss
-			#total_loss = -elbo
-
-			# Backprop + Optimize :
-			optimizer.zero_grad()
-			total_loss.backward()
-			optimizer.step()
-
-			del images
-			
-			epoch_loss += total_loss.cpu().data[0]
-
-			if i % 10 == 0:
-			    print ("Epoch[%d/%d], Step [%d/%d], Total Loss: %.4f, "
-			           "Reconst Loss: %.4f, KL Div: %.7f, E[ |~| p(x|theta)]: %.7f " 
-			           %(epoch+1, 50, i+1, iter_per_epoch, total_loss.data[0], 
-			             reconst_loss.data[0], kl_divergence.data[0],expected_log_lik.exp().data[0]) )
-
-		if best_loss is None :
-			#first validation : let us set the initialization but not save it :
-			best_loss = epoch_loss
-			best_model_wts = betavae.state_dict()
-			# save best model weights :
-			torch.save( best_model_wts, os.path.join(SAVE_PATH,'weights') )
-			print('Model saved at : {}'.format(os.path.join(SAVE_PATH,'weights')) )
-		elif epoch_loss < best_loss:
-			best_loss = epoch_loss
-			best_model_wts = betavae.state_dict()
-			# save best model weights :
-			torch.save( best_model_wts, os.path.join(SAVE_PATH,'weights') )
-			print('Model saved at : {}'.format(os.path.join(SAVE_PATH,'weights')) )
-
-
 def query_XYS(betavae,data_loader,path):
-	global use_cuda
+	# the device of the model, the CPU for a quantized one :
+	use_cuda = betavae.use_cuda
 
 	z_dim = betavae.z_dim
 	img_depth=betavae.img_depth
@@ -257,6 +143,7 @@ def query_XYS(betavae,data_loader,path):
 	fixed_x = Variable(fixed_x.view(fixed_x.size(0), img_depth, img_dim, img_dim)).float()
 	if use_cuda :
 		fixed_x = fixed_x.cuda()
+	fixed_x = format_input(betavae, fixed_x)
 
 	# variations over the latent variable :
 	sigma_mean = 3.0*torch.ones((z_dim))
@@ -264,30 +151,7 @@ def query_XYS(betavae,data_loader,path):
 
 	# Save generated variable images :
 	nbr_steps = 8
-	gen_images = torch.ones( (8, img_depth, img_dim, img_dim) )
-
-	for latent in range(z_dim) :
-		#var_z0 = torch.stack( [mu_mean]*nbr_steps, dim=0)
-		var_z0 = torch.zeros(nbr_steps, z_dim)
-		val = mu_mean[latent]-sigma_mean[latent]
-		step = 2.0*sigma_mean[latent]/nbr_steps
-		print(latent,mu_mean[latent]-sigma_mean[latent],mu_mean[latent],mu_mean[latent]+sigma_mean[latent])
-		for i in range(nbr_steps) :
-			var_z0[i] = mu_mean
-			var_z0[i][latent] = val
-			val += step
-
-		var_z0 = Variable(var_z0)
-		if use_cuda :
-			var_z0 = var_z0.cuda()
-
-
-		gen_images_latent = betavae.decoder(var_z0)
-		gen_images_latent = gen_images_latent.view(-1, img_depth, img_dim, img_dim).cpu().data
-		gen_images = torch.cat( [gen_images,gen_images_latent], dim=0)
-
-	#torchvision.utils.save_image(gen_images.data.cpu(),'./beta-data/{}/gen_images/dim{}/{}.png'.format(path,latent,(epoch+1)) )
-	torchvision.utils.save_image(gen_images,'./beta-data/{}/gen_images/query.png'.format(path) )
+	save_traversal(betavae.decoder, mu_mean, sigma_mean, './beta-data/{}/gen_images/query.png'.format(path), nbr_steps=nbr_steps, img_shape=(img_depth, img_dim, img_dim), blank_row=True)
 
 
 	reconst_images, _, _ = betavae(fixed_x)
@@ -297,13 +161,12 @@ def query_XYS(betavae,data_loader,path):
 	torchvision.utils.save_image(ri,'./beta-data/{}/reconst_images/query.png'.format(path ) )
 	
 
-def generateTarget(latent_dim=3,idx_latent=0, batch_size=8 ) :
+def generateTarget(latent_dim=3,idx_latent=0, batch_size=8, use_cuda=False ) :
 	target = torch.zeros( (1, latent_dim))
 	target[0,idx_latent] = 1.0
 	target = torch.cat( batch_size*[target], dim=0)
 
 	target = Variable(target)
-	global use_cuda 
 	if use_cuda :
 		target = target.cuda()
 
@@ -330,7 +193,8 @@ def generatePairs(index) :
 def evaluate_disentanglement(model,dataset,nbr_epoch=20) :
 	from datasetXYS import generateIDX, generateClassifier
 
-	global use_cuda
+	# the device of the model, the CPU for a quantized one :
+	use_cuda = model.use_cuda
 	lr = 1e-4
 	
 	indexes = generateIDX(dataset)
@@ -389,13 +253,16 @@ def evaluate_disentanglement(model,dataset,nbr_epoch=20) :
 							img2 = img2.cuda() 
 
 
+						img1 = format_input(model, img1)
+						img2 = format_input(model, img2)
+
 						_, mu1, log_var1 = model(img1)
 						_, mu2, log_var2 = model(img2)
 						
 						z_diff = torch.abs(mu2-mu1)
 						#av_z_diff = z_diff/float(nbrel)
 
-						target = generateTarget(latent_dim=3, idx_latent=idx_latent, batch_size=1)
+						target = generateTarget(latent_dim=3, idx_latent=idx_latent, batch_size=1, use_cuda=use_cuda)
 
 						#logits = classifier(av_z_diff)
 						logits = classifier(z_diff)
@@ -429,7 +296,8 @@ def evaluate_disentanglement(model,dataset,nbr_epoch=20) :
 			print('-'*20)
 			print('{} EPOCH : {}/{} :: Cumulative Accuracy : {} // Cumulative Latent {} Accuracy : {}'.format(phase, epoch, nbrepoch, cum_epoch_acc, idx_latent, cum_latent_acc))
 			print('-'*20)
-		
+
+	return cum_epoch_acc
 
 
 if __name__ == '__main__' :
@@ -441,13 +309,30 @@ if __name__ == '__main__' :
 	parser.add_argument('--offset', type=int, default=0)
 	parser.add_argument('--batch', type=int, default=32)
 	parser.add_argument('--epoch', type=int, default=100)
+	parser.add_argument('--channels_last',action='store_true',default=False)
+	parser.add_argument('--compile',action='store_true',default=False)
+	parser.add_argument('--bf16',action='store_true',default=False)
+	parser.add_argument('--quantize',action='store_true',default=False)
+	parser.add_argument('--distill',action='store_true',default=False)
+	parser.add_argument('--student_width', type=int, default=16)
+	parser.add_argument('--student_depth', type=int, default=4)
+	parser.add_argument('--distill_epoch', type=int, default=10)
+	parser.add_argument('--checkpoint_encoder', type=int, default=0)
+	parser.add_argument('--checkpoint_decoder', type=int, default=0)
+	parser.add_argument('--separable',action='store_true',default=False, help='depthwise-separable convolutions in the encoder and decoder')
+	parser.add_argument('--log_interval', type=int, default=10, help='number of steps between two entries of the metrics log')
+	parser.add_argument('--resume',action='store_true',default=False, help='resume the training from the latest full-state checkpoint')
+	parser.add_argument('--micro_batch', type=int, default=0, help='images per forward/backward pass, the gradients being accumulated over --batch images (0 : whole batch, -1 : probed from --memory_budget)')
+	parser.add_argument('--memory_budget', type=float, default=0, help='memory budget of a training step for --micro_batch -1, in MiB (0 : detected)')
+	parser.add_argument('--shared_dataset', type=str, default=None, help='train on the images published under this name by shared_dataset.py --serve')
 	args = parser.parse_args()
+	init_distributed()
 
 	if args.train :
-		setting(offset=args.offset,batch_size=args.batch,train=True,nbr_epoch=args.epoch)
+		setting(offset=args.offset,batch_size=args.batch,train=True,nbr_epoch=args.epoch,log_interval=args.log_interval,resume=args.resume,micro_batch=args.micro_batch,memory_budget=args.memory_budget,shared_dataset=args.shared_dataset,channels_last=args.channels_last,compile=args.compile,bf16=args.bf16,quantize=args.quantize,checkpoint_encoder=args.checkpoint_encoder,checkpoint_decoder=args.checkpoint_decoder,separable=args.separable)
 	
 	if args.query :
-		setting(train=False)
+		setting(train=False,channels_last=args.channels_last,compile=args.compile,bf16=args.bf16,quantize=args.quantize,distill=args.distill,student_width=args.student_width,student_depth=args.student_depth,distill_epoch=args.distill_epoch,separable=args.separable)
 
 	if args.evaluate :
-		setting(train=False,evaluate=True,nbr_epoch=args.epoch)
\ No newline at end of file
+		setting(train=False,evaluate=True,nbr_epoch=args.epoch,channels_last=args.channels_last,compile=args.compile,bf16=args.bf16,quantize=args.quantize,distill=args.distill,student_width=args.student_width,student_depth=args.student_depth,distill_epoch=args.distill_epoch,separable=args.separable)
\ No newline at end of file
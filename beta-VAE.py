@@ -1,3 +1,4 @@
+import os
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -10,182 +11,53 @@ from PIL import Image
 
 from models import Rescale, betaVAE, betaVAEdSprite, betaVAEXYS, Bernoulli
 from datasetXYS import load_dataset_XYS
-
-def test_mnist():
-	import os
-	import torchvision
-	from torchvision import datasets, transforms
-
+from visualization import save_traversal
+from execution import set_execution_mode, autocast, to_float
+from datasets import load_dataset, make_data_loader
+from shared_dataset import attach_dataset
+from engine import train_model
+from distributed import init_distributed
+
+def test_mnist(bf16=False):
 	size = 64
 	batch_size = 128
-	dataset = datasets.MNIST(root='./data',
-		                     train=True,
-		                     #transform=transforms.ToTensor(),
-							 transform=transforms.Compose([
-	                                               Rescale( (size,size) ),
-	                                               transforms.ToTensor()]),
-	                         download=True) 
-
+	dataset = load_dataset('mnist', img_dim=size)
 
 	# Data loader
-	data_loader = torch.utils.data.DataLoader(dataset=dataset,
-    	                                      batch_size=batch_size, 
-        	                                  shuffle=True)
-	data_iter = iter(data_loader)
-	iter_per_epoch = len(data_loader)
+	data_loader = make_data_loader(dataset, batch_size=batch_size)
 
 	# Model :
 	z_dim = 12
 	img_dim = size
 	img_depth=1
 	conv_dim = 32
-	use_cuda = True#False
+	use_cuda = torch.cuda.is_available()
 	net_depth = 3
 	beta = 5e0
 	betavae = betaVAE(beta=beta,net_depth=net_depth,z_dim=z_dim,img_dim=img_dim,img_depth=img_depth,conv_dim=conv_dim, use_cuda=use_cuda)
 	print(betavae)
+	betavae = set_execution_mode(betavae, bf16=bf16)
 
 
 	# Optim :
 	lr = 1e-4
 	optimizer = torch.optim.Adam( betavae.parameters(), lr=lr)
 
-	# Debug :
-	# fixed inputs for debugging
-	fixed_z = Variable(torch.randn(100, z_dim))
-	if use_cuda :
-		fixed_z = fixed_z.cuda()
-
-	fixed_x, _ = next(data_iter)
-	
-
 	path = 'test--mnist-beta{}-layers{}-z{}-conv{}-lr{}'.format(beta,net_depth,z_dim,conv_dim,lr)
-	if not os.path.exists( './beta-data/{}/'.format(path) ) :
-		os.mkdir('./beta-data/{}/'.format(path))
-	if not os.path.exists( './beta-data/{}/gen_images/'.format(path) ) :
-			os.mkdir('./beta-data/{}/gen_images/'.format(path))
-	
-	
-	fixed_x = fixed_x.view( (-1, img_depth, img_dim, img_dim) )
-	torchvision.utils.save_image(fixed_x.cpu(), './beta-data/{}/real_images.png'.format(path))
-	
-	fixed_x = Variable(fixed_x.view(fixed_x.size(0), img_depth, img_dim, img_dim))
-	if use_cuda :
-		fixed_x = fixed_x.cuda()
-
-	out = torch.zeros((1,1))
-
-	# variations over the latent variable :
-	sigma_mean = torch.ones((z_dim))
-	mu_mean = torch.zeros((z_dim))
-
-	for epoch in range(50):
-		# Save the reconstructed images
-		reconst_images, _, _ = betavae(fixed_x)
-		reconst_images = reconst_images.view(-1, img_depth, img_dim, img_dim)
-		torchvision.utils.save_image(reconst_images.data.cpu(),'./beta-data/{}/reconst_images_{}.png'.format(path,(epoch+1)) )
-
-		# Save generated variable images :
-		nbr_steps = 8
-		mu_mean /= batch_size
-		sigma_mean /= batch_size
-		gen_images = torch.ones( (8, img_depth, img_dim, img_dim) )
-
-		for latent in range(z_dim) :
-			#var_z0 = torch.stack( [mu_mean]*nbr_steps, dim=0)
-			var_z0 = torch.zeros(nbr_steps, z_dim)
-			val = mu_mean[latent]-sigma_mean[latent]
-			step = 2.0*sigma_mean[latent]/nbr_steps
-			print(latent,mu_mean[latent],step)
-			for i in range(nbr_steps) :
-				var_z0[i] = mu_mean
-				var_z0[i][latent] = val
-				val += step
-
-			var_z0 = Variable(var_z0)
-			if use_cuda :
-				var_z0 = var_z0.cuda()
-
-
-			gen_images_latent = betavae.decoder(var_z0)
-			gen_images_latent = gen_images_latent.view(-1, img_depth, img_dim, img_dim).cpu().data
-			gen_images = torch.cat( [gen_images,gen_images_latent], dim=0)
-
-		#torchvision.utils.save_image(gen_images.data.cpu(),'./beta-data/{}/gen_images/dim{}/{}.png'.format(path,latent,(epoch+1)) )
-		torchvision.utils.save_image(gen_images,'./beta-data/{}/gen_images/{}.png'.format(path,(epoch+1)) )
-
-		mu_mean = 0.0
-		sigma_mean = 0.0
-
-		for i, (images, _) in enumerate(data_loader):
-
-			images = Variable( (images.view(-1,1,img_dim, img_dim) ) )
-			if use_cuda :
-				images = images.cuda() 
-
-			out, mu, log_var = betavae(images)
-
-			mu_mean += torch.mean(mu.data,dim=0)
-			sigma_mean += torch.mean( torch.sqrt( torch.exp(log_var.data) ), dim=0 )
-
-			# Compute :
-			#reconstruction loss :
-			reconst_loss = F.binary_cross_entropy(out, images, size_average=False)
-			#reconst_loss = torch.mean( (out.view(-1) - images.view(-1))**2 )
-
-			# expected log likelyhood :
-			expected_log_lik = torch.mean( Bernoulli( out.view((-1)) ).log_prob( images.view((-1)) ) )
-			#expected_log_lik = torch.mean( Bernoulli( out ).log_prob( images ) )
-
-			# kl divergence :
-			#kl_divergence = 0.5 * torch.mean( torch.sum( (mu**2 + torch.exp(log_var) - log_var -1), dim=1) )
-			kl_divergence = 0.5 * torch.sum( (mu**2 + torch.exp(log_var) - log_var -1) )
-
-			# ELBO :
-			elbo = expected_log_lik - betavae.beta * kl_divergence
-			
-			# TOTAL LOSS :
-			total_loss = reconst_loss + betavae.beta*kl_divergence
-			#total_loss = reconst_loss
-			#total_loss = -elbo
-
-			# Backprop + Optimize :
-			optimizer.zero_grad()
-			total_loss.backward()
-			optimizer.step()
-
-			if i % 100 == 0:
-			    print ("Epoch[%d/%d], Step [%d/%d], Total Loss: %.4f, "
-			           "Reconst Loss: %.4f, KL Div: %.7f, E[ |~| p(x|theta)]: %.7f " 
-			           %(epoch+1, 50, i+1, iter_per_epoch, total_loss.data[0], 
-			             reconst_loss.data[0], kl_divergence.data[0],expected_log_lik.exp().data[0]) )
-
-
-
+	SAVE_PATH = './beta-data/{}'.format(path) 
 
+	# KL divergence summed over the batch, weights not saved :
+	train_model(betavae, data_loader, optimizer, SAVE_PATH, path, nbr_epoch=50, kl_reduction='sum', log_interval=100, save=False)
 
-def test_dSprite():
-	import os
-	import matplotlib.pyplot as plt
-	import torchvision
-	from torchvision import datasets, transforms
-	from datasets import dSpriteDataset
 
+def test_dSprite(bf16=False,rank=None,sparse_threshold=0.0,resume=False,shared_dataset=None):
 	size = 64
 	batch_size = 256
-	root = './dsprites-dataset/dsprites_ndarray_co1sh3sc6or40x32y32_64x64.npz'
-	dataset = dSpriteDataset(root=root,
-							 transform=transforms.Compose([
-	                                               Rescale( (size,size) ),
-	                                               transforms.ToTensor()])
-	                        ) 
+	# decoded once by a shared-memory dataset server, if shared_dataset is given :
+	dataset = attach_dataset(shared_dataset, expected=dict(dataset='dSprite', img_dim=size, stacking=False)) if shared_dataset else load_dataset('dSprite', img_dim=size)
 
 	# Data loader
-	data_loader = torch.utils.data.DataLoader(dataset=dataset,
-    	                                      batch_size=batch_size, 
-        	                                  shuffle=True)
-	data_iter = iter(data_loader)
-	iter_per_epoch = len(data_loader)
+	data_loader = make_data_loader(dataset, batch_size=batch_size)
 
 	# Model :
 	frompath = True
@@ -193,22 +65,23 @@ def test_dSprite():
 	img_dim = size
 	img_depth=1
 	conv_dim = 64
-	use_cuda = True#False
+	use_cuda = torch.cuda.is_available()
 	net_depth = 3
 	beta = 5e0
-	betavae = betaVAEdSprite(beta=beta,net_depth=net_depth,z_dim=z_dim,img_dim=img_dim,img_depth=img_depth,conv_dim=conv_dim, use_cuda=use_cuda)
+	betavae = betaVAEdSprite(beta=beta,net_depth=net_depth,z_dim=z_dim,img_dim=img_dim,img_depth=img_depth,conv_dim=conv_dim, use_cuda=use_cuda, rank=rank)
 	'''
 	# Model :
 	z_dim = 10
 	img_dim = size
 	img_depth=1
 	conv_dim = 16
-	use_cuda = True#False
+	use_cuda = torch.cuda.is_available()
 	net_depth = 3
 	beta = 100e0
 	betavae = betaVAE(beta=beta,net_depth=net_depth,z_dim=z_dim,img_dim=img_dim,img_depth=img_depth,conv_dim=conv_dim, use_cuda=use_cuda)
 	'''
 	print(betavae)
+	betavae = set_execution_mode(betavae, bf16=bf16, sparse_threshold=sparse_threshold)
 
 
 	# Optim :
@@ -216,48 +89,13 @@ def test_dSprite():
 	optimizer = torch.optim.Adam( betavae.parameters(), lr=lr)
 	#optimizer = torch.optim.Adagrad( betavae.parameters(), lr=lr)
 	#lr = 1e-3
-	
-	# Debug :
-	# fixed inputs for debugging
-	fixed_z = Variable(torch.randn(45, z_dim))
-	if use_cuda :
-		fixed_z = fixed_z.cuda()
-
-	fixed_x, _ = next(data_iter)
-	
 
 	#path = 'dSprite--beta{}-layers{}-z{}-conv{}-lr{}'.format(beta,net_depth,z_dim,conv_dim,lr)
 	path = 'testAblation--dSprite--beta{}-layers{}-z{}-conv{}'.format(beta,net_depth,z_dim,conv_dim)
+	if rank is not None :
+		path+= '-rank{}'.format(rank)
 	if not os.path.exists( './beta-data/{}/'.format(path) ) :
-		os.mkdir('./beta-data/{}/'.format(path))
-	if not os.path.exists( './beta-data/{}/gen_images/'.format(path) ) :
-			os.mkdir('./beta-data/{}/gen_images/'.format(path))
-	if not os.path.exists( './beta-data/{}/reconst_images/'.format(path) ) :
-			os.mkdir('./beta-data/{}/reconst_images/'.format(path))
-	
-	
-	fixed_x = fixed_x.view( (-1, img_depth, img_dim, img_dim) )
-	torchvision.utils.save_image(255*fixed_x.cpu(), './beta-data/{}/real_images.png'.format(path))
-	
-	# effect of each latent var :
-	nbr_steps = 8
-	var_x = fixed_x[0, :, :, :]
-	var_x = torch.cat( nbr_steps*[var_x], dim=0 ).unsqueeze(1)
-	
-	fixed_x = Variable(fixed_x.view(fixed_x.size(0), img_depth, img_dim, img_dim))
-	var_x = Variable(var_x)
-	if use_cuda :
-		fixed_x = fixed_x.cuda()
-		var_x = var_x.cuda()
-
-	out = torch.zeros((1,1))
-
-	# variations over the latent variable :
-	sigma_mean = torch.ones((z_dim))
-	mu_mean = torch.zeros((z_dim))
-
-	best_loss = None
-	best_model_wts = betavae.state_dict()
+		os.makedirs('./beta-data/{}/'.format(path), exist_ok=True)
 	SAVE_PATH = './beta-data/{}'.format(path) 
 
 	if frompath :
@@ -267,142 +105,18 @@ def test_dSprite():
 		except Exception as e :
 			print('EXCEPTION : NET LOADING : {}'.format(e) )
 
+	train_model(betavae, data_loader, optimizer, SAVE_PATH, path, nbr_epoch=50, scale=255.0, log_interval=100, resume=resume)
 
-	
-	for epoch in range(50):
-		
-		# Save generated variable images :
-		var_z = betavae.encoder(var_x)
-		mu_z, log_var_z = torch.chunk(var_z, 2, dim=1 )
-		mu_mean /= batch_size
-		
-		sigma_mean /= batch_size
-		gen_images = None
-
-		for latent in range(z_dim) :
-			#var_z0 = torch.stack( [mu_mean]*nbr_steps, dim=0)
-			#var_z0 = torch.zeros(nbr_steps, z_dim)
-			var_z0 = mu_z.cpu().data
-			val = mu_mean[latent]-sigma_mean[latent]
-			step = 2.0*sigma_mean[latent]/nbr_steps
-			print(latent,mu_mean[latent],step)
-			for i in range(nbr_steps) :
-				var_z0[i] = mu_mean
-				var_z0[i][latent] = val
-				val += step
-
-			var_z0 = Variable(var_z0)
-			if use_cuda :
-				var_z0 = var_z0.cuda()
-
-
-			gen_images_latent = betavae.decoder(var_z0)
-			gen_images_latent = gen_images_latent.view(-1, img_depth, img_dim, img_dim).cpu().data
-			if gen_images is None :
-				gen_images = gen_images_latent
-			else :
-				gen_images = torch.cat( [gen_images,gen_images_latent], dim=0)
-
-		#torchvision.utils.save_image(gen_images.data.cpu(),'./beta-data/{}/gen_images/dim{}/{}.png'.format(path,latent,(epoch+1)) )
-		torchvision.utils.save_image(255.0*gen_images,'./beta-data/{}/gen_images/{}.png'.format(path,(epoch)) )
-
-		mu_mean = 0.0
-		sigma_mean = 0.0
-
-		epoch_loss = 0.0
-		
 
-		for i, (images, _) in enumerate(data_loader):
-			# Save the reconstructed images
-			if i % 100 == 0 :
-				reconst_images, _, _ = betavae(fixed_x)
-				reconst_images = reconst_images.view(-1, img_depth, img_dim, img_dim).cpu().data
-				orimg = fixed_x.cpu().data.view(-1, img_depth, img_dim, img_dim)
-				ri = torch.cat( [orimg, reconst_images], dim=2)
-				torchvision.utils.save_image(255*ri,'./beta-data/{}/reconst_images/{}.png'.format(path,(epoch)) )
-			
-			images = Variable( (images.view(-1,1,img_dim, img_dim) ) )
-			
-			if use_cuda :
-				images = images.cuda() 
-
-			out, mu, log_var = betavae(images)
-			
-			mu_mean += torch.mean(mu.data,dim=0)
-			sigma_mean += torch.mean( torch.sqrt( torch.exp(log_var.data) ), dim=0 )
-
-			# Compute :
-			#reconstruction loss :
-			reconst_loss = F.binary_cross_entropy( out, images, size_average=False)
-			#reconst_loss = nn.MultiLabelSoftMarginLoss()(input=out_logits, target=images)
-			#reconst_loss = F.binary_cross_entropy_with_logits( input=out, target=images, size_average=False)
-			#reconst_loss = F.binary_cross_entropy( Bernoulli(out).sample(), images, size_average=False)
-			#reconst_loss = torch.mean( (out.view(-1) - images.view(-1))**2 )
-			
-			# expected log likelyhood :
-			expected_log_lik = torch.mean( Bernoulli( out.view((-1)) ).log_prob( images.view((-1)) ) )
-			#expected_log_lik = torch.mean( Bernoulli( out ).log_prob( images ) )
-
-			# kl divergence :
-			kl_divergence = 0.5 * torch.mean( torch.sum( (mu**2 + torch.exp(log_var) - log_var -1), dim=1) )
-			#kl_divergence = 0.5 * torch.sum( (mu**2 + torch.exp(log_var) - log_var -1) )
-
-			# ELBO :
-			elbo = expected_log_lik - betavae.beta * kl_divergence
-			
-			# TOTAL LOSS :
-			total_loss = reconst_loss + betavae.beta*kl_divergence
-			#total_loss = reconst_loss
-			#total_loss = -elbo
-
-			# Backprop + Optimize :
-			optimizer.zero_grad()
-			total_loss.backward()
-			optimizer.step()
-
-			del images
-			
-			epoch_loss += total_loss.cpu().data[0]
-
-			if i % 100 == 0:
-			    print ("Epoch[%d/%d], Step [%d/%d], Total Loss: %.4f, "
-			           "Reconst Loss: %.4f, KL Div: %.7f, E[ |~| p(x|theta)]: %.7f " 
-			           %(epoch+1, 50, i+1, iter_per_epoch, total_loss.data[0], 
-			             reconst_loss.data[0], kl_divergence.data[0],expected_log_lik.exp().data[0]) )
-
-		if best_loss is None :
-			#first validation : let us set the initialization but not save it :
-			best_loss = epoch_loss
-			best_model_wts = betavae.state_dict()
-			# save best model weights :
-			torch.save( best_model_wts, os.path.join(SAVE_PATH,'weights') )
-			print('Model saved at : {}'.format(os.path.join(SAVE_PATH,'weights')) )
-		elif epoch_loss < best_loss:
-			best_loss = epoch_loss
-			best_model_wts = betavae.state_dict()
-			# save best model weights :
-			torch.save( best_model_wts, os.path.join(SAVE_PATH,'weights') )
-			print('Model saved at : {}'.format(os.path.join(SAVE_PATH,'weights')) )
-
-
-def test_XYS(offset=0):
-	import os
-	import matplotlib.pyplot as plt
-	import torchvision
-	from torchvision import datasets, transforms 
-	from models import Bernoulli
-	
+def test_XYS(offset=0,bf16=False,resume=False,shared_dataset=None):
 	size = 256
 	batch_size = 16#32
 	
-	dataset = load_dataset_XYS(img_dim=size)
+	# decoded once by a shared-memory dataset server, if shared_dataset is given :
+	dataset = attach_dataset(shared_dataset, expected=dict(dataset='XYS', img_dim=size, stacking=False)) if shared_dataset else load_dataset('XYS', img_dim=size)
 
 	# Data loader
-	data_loader = torch.utils.data.DataLoader(dataset=dataset,
-    	                                      batch_size=batch_size, 
-        	                                  shuffle=True)
-	data_iter = iter(data_loader)
-	iter_per_epoch = len(data_loader)
+	data_loader = make_data_loader(dataset, batch_size=batch_size)
 
 	# Model :
 	frompath = True
@@ -411,7 +125,7 @@ def test_XYS(offset=0):
 	img_dim = size
 	img_depth=1
 	conv_dim = 64
-	use_cuda = True#False
+	use_cuda = torch.cuda.is_available()
 	net_depth = 3
 	beta = 1e0
 	betavae = betaVAEdSprite(beta=beta,net_depth=net_depth,z_dim=z_dim,img_dim=img_dim,img_depth=img_depth,conv_dim=conv_dim, use_cuda=use_cuda)
@@ -421,11 +135,12 @@ def test_XYS(offset=0):
 	img_dim = size
 	img_depth=3
 	conv_dim = 32
-	use_cuda = True#False
+	use_cuda = torch.cuda.is_available()
 	net_depth = 5
 	beta = 5000e0
 	betavae = betaVAEXYS(beta=beta,net_depth=net_depth,z_dim=z_dim,img_dim=img_dim,img_depth=img_depth,conv_dim=conv_dim, use_cuda=use_cuda)
 	print(betavae)
+	betavae = set_execution_mode(betavae, bf16=bf16)
 
 
 	# Optim :
@@ -433,41 +148,10 @@ def test_XYS(offset=0):
 	optimizer = torch.optim.Adam( betavae.parameters(), lr=lr)
 	#optimizer = torch.optim.Adagrad( betavae.parameters(), lr=lr)
 	#lr = 1e-3
-	
-	# Debug :
-	# fixed inputs for debugging
-	fixed_z = Variable(torch.randn(45, z_dim))
-	if use_cuda :
-		fixed_z = fixed_z.cuda()
-
-	sample = next(data_iter)
-	fixed_x, _ = sample['image'], sample['landmarks']
-		
 
 	path = 'test--XYS--img{}-lr{}-beta{}-layers{}-z{}-conv{}'.format(img_dim,lr,beta,net_depth,z_dim,conv_dim)
 	if not os.path.exists( './beta-data/{}/'.format(path) ) :
-		os.mkdir('./beta-data/{}/'.format(path))
-	if not os.path.exists( './beta-data/{}/gen_images/'.format(path) ) :
-			os.mkdir('./beta-data/{}/gen_images/'.format(path))
-	if not os.path.exists( './beta-data/{}/reconst_images/'.format(path) ) :
-			os.mkdir('./beta-data/{}/reconst_images/'.format(path))
-	
-	
-	fixed_x = fixed_x.view( (-1, img_depth, img_dim, img_dim) )
-	torchvision.utils.save_image(fixed_x.cpu(), './beta-data/{}/real_images.png'.format(path))
-	
-	fixed_x = Variable(fixed_x.view(fixed_x.size(0), img_depth, img_dim, img_dim)).float()
-	if use_cuda :
-		fixed_x = fixed_x.cuda()
-
-	out = torch.zeros((1,1))
-
-	# variations over the latent variable :
-	sigma_mean = torch.ones((z_dim))
-	mu_mean = torch.zeros((z_dim))
-
-	best_loss = None
-	best_model_wts = betavae.state_dict()
+		os.makedirs('./beta-data/{}/'.format(path), exist_ok=True)
 	SAVE_PATH = './beta-data/{}'.format(path) 
 
 	if frompath :
@@ -477,117 +161,7 @@ def test_XYS(offset=0):
 		except Exception as e :
 			print('EXCEPTION : NET LOADING : {}'.format(e) )
 
-
-	for epoch in range(50):
-		
-		# Save generated variable images :
-		nbr_steps = 8
-		mu_mean /= batch_size
-		sigma_mean /= batch_size
-		gen_images = torch.ones( (8, img_depth, img_dim, img_dim) )
-
-		for latent in range(z_dim) :
-			#var_z0 = torch.stack( [mu_mean]*nbr_steps, dim=0)
-			var_z0 = torch.zeros(nbr_steps, z_dim)
-			val = mu_mean[latent]-sigma_mean[latent]
-			step = 2.0*sigma_mean[latent]/nbr_steps
-			print(latent,mu_mean[latent],step)
-			for i in range(nbr_steps) :
-				var_z0[i] = mu_mean
-				var_z0[i][latent] = val
-				val += step
-
-			var_z0 = Variable(var_z0)
-			if use_cuda :
-				var_z0 = var_z0.cuda()
-
-
-			gen_images_latent = betavae.decoder(var_z0)
-			gen_images_latent = gen_images_latent.view(-1, img_depth, img_dim, img_dim).cpu().data
-			gen_images = torch.cat( [gen_images,gen_images_latent], dim=0)
-
-		#torchvision.utils.save_image(gen_images.data.cpu(),'./beta-data/{}/gen_images/dim{}/{}.png'.format(path,latent,(epoch+1)) )
-		torchvision.utils.save_image(gen_images,'./beta-data/{}/gen_images/{}.png'.format(path,(epoch+offset+1)) )
-
-		mu_mean = 0.0
-		sigma_mean = 0.0
-
-		epoch_loss = 0.0
-		
-
-		for i, sample in enumerate(data_loader):
-			images = sample['image']
-			# Save the reconstructed images
-			if i % 100 == 0 :
-				reconst_images, _, _ = betavae(fixed_x)
-				reconst_images = reconst_images.view(-1, img_depth, img_dim, img_dim).cpu().data
-				orimg = fixed_x.cpu().data.view(-1, img_depth, img_dim, img_dim)
-				ri = torch.cat( [orimg, reconst_images], dim=2)
-				torchvision.utils.save_image(ri,'./beta-data/{}/reconst_images/{}.png'.format(path,(epoch+offset+1) ) )
-			
-			
-			images = Variable( (images.view(-1, img_depth,img_dim, img_dim) ) ).float()
-			
-			if use_cuda :
-				images = images.cuda() 
-
-			out, mu, log_var = betavae(images)
-			
-			mu_mean += torch.mean(mu.data,dim=0)
-			sigma_mean += torch.mean( torch.sqrt( torch.exp(log_var.data) ), dim=0 )
-
-			# Compute :
-			#reconstruction loss :
-			reconst_loss = F.binary_cross_entropy( out, images, size_average=False)
-			#reconst_loss = nn.MultiLabelSoftMarginLoss()(input=out_logits, target=images)
-			#reconst_loss = F.binary_cross_entropy_with_logits( input=out, target=images, size_average=False)
-			#reconst_loss = F.binary_cross_entropy( Bernoulli(out).sample(), images, size_average=False)
-			#reconst_loss = torch.mean( (out.view(-1) - images.view(-1))**2 )
-			
-			# expected log likelyhood :
-			expected_log_lik = torch.mean( Bernoulli( out.view((-1)) ).log_prob( images.view((-1)) ) )
-			#expected_log_lik = torch.mean( Bernoulli( out ).log_prob( images ) )
-
-			# kl divergence :
-			kl_divergence = 0.5 * torch.mean( torch.sum( (mu**2 + torch.exp(log_var) - log_var -1), dim=1) )
-			#kl_divergence = 0.5 * torch.sum( (mu**2 + torch.exp(log_var) - log_var -1) )
-
-			# ELBO :
-			elbo = expected_log_lik - betavae.beta * kl_divergence
-			
-			# TOTAL LOSS :
-			total_loss = reconst_loss + betavae.beta*kl_divergence
-			#total_loss = reconst_loss
-			#total_loss = -elbo
-
-			# Backprop + Optimize :
-			optimizer.zero_grad()
-			total_loss.backward()
-			optimizer.step()
-
-			del images
-			
-			epoch_loss += total_loss.cpu().data[0]
-
-			if i % 100 == 0:
-			    print ("Epoch[%d/%d], Step [%d/%d], Total Loss: %.4f, "
-			           "Reconst Loss: %.4f, KL Div: %.7f, E[ |~| p(x|theta)]: %.7f " 
-			           %(epoch+1, 50, i+1, iter_per_epoch, total_loss.data[0], 
-			             reconst_loss.data[0], kl_divergence.data[0],expected_log_lik.exp().data[0]) )
-
-		if best_loss is None :
-			#first validation : let us set the initialization but not save it :
-			best_loss = epoch_loss
-			best_model_wts = betavae.state_dict()
-			# save best model weights :
-			torch.save( best_model_wts, os.path.join(SAVE_PATH,'weights') )
-			print('Model saved at : {}'.format(os.path.join(SAVE_PATH,'weights')) )
-		elif epoch_loss < best_loss:
-			best_loss = epoch_loss
-			best_model_wts = betavae.state_dict()
-			# save best model weights :
-			torch.save( best_model_wts, os.path.join(SAVE_PATH,'weights') )
-			print('Model saved at : {}'.format(os.path.join(SAVE_PATH,'weights')) )
+	train_model(betavae, data_loader, optimizer, SAVE_PATH, path, nbr_epoch=50, offset=offset, log_interval=100, resume=resume)
 
 
 def queryXYS():
@@ -616,7 +190,7 @@ def queryXYS():
 	img_dim = size
 	img_depth=1
 	conv_dim = 64
-	use_cuda = True#False
+	use_cuda = torch.cuda.is_available()
 	net_depth = 3
 	beta = 1e0
 	betavae = betaVAEdSprite(beta=beta,net_depth=net_depth,z_dim=z_dim,img_dim=img_dim,img_depth=img_depth,conv_dim=conv_dim, use_cuda=use_cuda)
@@ -626,7 +200,7 @@ def queryXYS():
 	img_dim = size
 	img_depth=3
 	conv_dim = 32
-	use_cuda = True#False
+	use_cuda = torch.cuda.is_available()
 	net_depth = 5
 	beta = 5000e0
 	betavae = betaVAEXYS(beta=beta,net_depth=net_depth,z_dim=z_dim,img_dim=img_dim,img_depth=img_depth,conv_dim=conv_dim, use_cuda=use_cuda)
@@ -646,11 +220,11 @@ def queryXYS():
 
 	path = 'test--XYS--img{}-lr{}-beta{}-layers{}-z{}-conv{}'.format(img_dim,lr,beta,net_depth,z_dim,conv_dim)
 	if not os.path.exists( './beta-data/{}/'.format(path) ) :
-		os.mkdir('./beta-data/{}/'.format(path))
+		os.makedirs('./beta-data/{}/'.format(path), exist_ok=True)
 	if not os.path.exists( './beta-data/{}/gen_images/'.format(path) ) :
-			os.mkdir('./beta-data/{}/gen_images/'.format(path))
+			os.makedirs('./beta-data/{}/gen_images/'.format(path), exist_ok=True)
 	if not os.path.exists( './beta-data/{}/reconst_images/'.format(path) ) :
-			os.mkdir('./beta-data/{}/reconst_images/'.format(path))
+			os.makedirs('./beta-data/{}/reconst_images/'.format(path), exist_ok=True)
 	
 	
 	fixed_x = fixed_x.view( (-1, img_depth, img_dim, img_dim) )
@@ -678,30 +252,7 @@ def queryXYS():
 
 	# Save generated variable images :
 	nbr_steps = 8
-	gen_images = torch.ones( (8, img_depth, img_dim, img_dim) )
-
-	for latent in range(z_dim) :
-		#var_z0 = torch.stack( [mu_mean]*nbr_steps, dim=0)
-		var_z0 = torch.zeros(nbr_steps, z_dim)
-		val = mu_mean[latent]-sigma_mean[latent]
-		step = 2.0*sigma_mean[latent]/nbr_steps
-		print(latent,mu_mean[latent]-sigma_mean[latent],mu_mean[latent],mu_mean[latent]+sigma_mean[latent])
-		for i in range(nbr_steps) :
-			var_z0[i] = mu_mean
-			var_z0[i][latent] = val
-			val += step
-
-		var_z0 = Variable(var_z0)
-		if use_cuda :
-			var_z0 = var_z0.cuda()
-
-
-		gen_images_latent = betavae.decoder(var_z0)
-		gen_images_latent = gen_images_latent.view(-1, img_depth, img_dim, img_dim).cpu().data
-		gen_images = torch.cat( [gen_images,gen_images_latent], dim=0)
-
-	#torchvision.utils.save_image(gen_images.data.cpu(),'./beta-data/{}/gen_images/dim{}/{}.png'.format(path,latent,(epoch+1)) )
-	torchvision.utils.save_image(gen_images,'./beta-data/{}/gen_images/query.png'.format(path) )
+	save_traversal(betavae.decoder, mu_mean, sigma_mean, './beta-data/{}/gen_images/query.png'.format(path), nbr_steps=nbr_steps, img_shape=(img_depth, img_dim, img_dim), blank_row=True)
 
 
 	reconst_images, _, _ = betavae(fixed_x)
@@ -716,11 +267,21 @@ if __name__ == '__main__' :
 	parser = argparse.ArgumentParser(description='beta-VAE')
 	parser.add_argument('--train',action='store_true',default=False)
 	parser.add_argument('--offset', type=int, default=0)
+	parser.add_argument('--dataset', type=str, default='XYS', choices=['XYS','dSprite','mnist'])
+	parser.add_argument('--bf16',action='store_true',default=False)
+	parser.add_argument('--rank', type=int, default=None, help='rank of the factorized dSprites layers')
+	parser.add_argument('--sparse_threshold', type=float, default=0.0, help='input density below which the first dSprites layer uses sparse matmuls')
+	parser.add_argument('--resume',action='store_true',default=False, help='resume the training from the latest full-state checkpoint (dSprite and XYS)')
+	parser.add_argument('--shared_dataset', type=str, default=None, help='train on the images published under this name by shared_dataset.py --serve (dSprite and XYS)')
 	args = parser.parse_args()
+	init_distributed()
 
 	if args.train :
-		#test_mnist()
-		#test_dSprite()
-		test_XYS(offset=args.offset)
+		if args.dataset == 'mnist' :
+			test_mnist(bf16=args.bf16)
+		elif args.dataset == 'dSprite' :
+			test_dSprite(bf16=args.bf16,rank=args.rank,sparse_threshold=args.sparse_threshold,resume=args.resume,shared_dataset=args.shared_dataset)
+		else :
+			test_XYS(offset=args.offset,bf16=args.bf16,resume=args.resume,shared_dataset=args.shared_dataset)
 	else :
 		queryXYS()
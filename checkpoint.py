@@ -0,0 +1,194 @@
+import json
+import os
+import queue
+import random
+import threading
+import time
+
+import numpy as np
+import torch
+
+
+def snapshot(obj) :
+	# copy of the tensors of a (nested) state to host memory, detached from the live parameters and buffers :
+	if torch.is_tensor(obj) :
+		obj = obj.detach()
+		if obj.device.type == 'cpu' :
+			return obj.clone()
+		return obj.to('cpu', copy=True)
+	if isinstance(obj, dict) :
+		copy = obj.__class__( (k, snapshot(v)) for k, v in obj.items() )
+		# the version metadata of a state_dict :
+		if hasattr(obj, '_metadata') :
+			copy._metadata = obj._metadata
+		return copy
+	if isinstance(obj, (list, tuple)) :
+		return obj.__class__( snapshot(v) for v in obj )
+	return obj
+
+def fsync_dir(path) :
+	# makes a rename in the directory durable, where the OS allows to open directories :
+	try :
+		fd = os.open(path, os.O_RDONLY)
+	except OSError :
+		return
+	try :
+		os.fsync(fd)
+	except OSError :
+		pass
+	finally :
+		os.close(fd)
+
+def atomic_save(obj, path) :
+	# written to a temporary file of the same directory, flushed to disk, then renamed over path :
+	# path is either the previous complete file or the new complete one, never a truncated one.
+	tmp = '{}.tmp-{}'.format(path, os.getpid())
+	try :
+		with open(tmp, 'wb') as f :
+			torch.save(obj, f)
+			f.flush()
+			os.fsync(f.fileno())
+		os.replace(tmp, path)
+	finally :
+		if os.path.exists(tmp) :
+			os.remove(tmp)
+	fsync_dir( os.path.dirname(os.path.abspath(path)) )
+
+def rng_state() :
+	# states of every random number generator used during the training :
+	state = dict( torch=torch.get_rng_state(), numpy=np.random.get_state(), python=random.getstate() )
+	if torch.cuda.is_available() :
+		state['cuda'] = torch.cuda.get_rng_state_all()
+	return state
+
+def seed_rng(seed) :
+	# seeds every random number generator used during the training :
+	torch.manual_seed(seed)
+	np.random.seed(seed % 2**32)
+	random.seed(seed)
+
+def set_rng_state(state) :
+	torch.set_rng_state(state['torch'])
+	np.random.set_state(state['numpy'])
+	random.setstate(state['python'])
+	if 'cuda' in state and torch.cuda.is_available() :
+		torch.cuda.set_rng_state_all(state['cuda'])
+
+def latest_checkpoint(SAVE_PATH) :
+	# the checkpoints are named after their global step, zero-padded :
+	folder = os.path.join(SAVE_PATH, 'checkpoints')
+	if not os.path.isdir(folder) :
+		return None
+	names = sorted( name for name in os.listdir(folder) if name.startswith('step-') and '.tmp-' not in name )
+	if len(names) == 0 :
+		return None
+	return os.path.join(folder, names[-1])
+
+
+class CheckpointWriter(object) :
+	# Checkpoints written on a background thread :
+	# the training thread only pays for the host snapshot of the state, the serialization and the disk writes overlap
+	# with the next steps. Each checkpoint is saved as SAVE_PATH/checkpoints/<label>, the keep_last latest and the keep_best
+	# lowest-loss ones are kept, and the weights of the best one (its weights_key entry) are also published as
+	# SAVE_PATH/<best_name>, the file loaded by the scripts.
+	def __init__(self, SAVE_PATH, keep_last=2, keep_best=1, best_name='weights', weights_key='model', max_pending=1) :
+		self.SAVE_PATH = SAVE_PATH
+		self.folder = os.path.join(SAVE_PATH, 'checkpoints')
+		os.makedirs(self.folder, exist_ok=True)
+		self.keep_last = keep_last
+		self.keep_best = keep_best
+		self.best_name = best_name
+		self.weights_key = weights_key
+
+		# (label, loss, path) of the checkpoints on disk, in writing order, including those of the previous processes
+		# (before a resume, or at an earlier rung of a sweep), so that they are pruned as well :
+		self.written = self.load_index()
+		self.errors = []
+		# at most max_pending snapshots wait for the disk in host memory : a save blocks while the writes are behind.
+		self.queue = queue.Queue(maxsize=max(1, max_pending))
+		self.thread = threading.Thread(target=self.work, name='checkpoint-writer', daemon=True)
+		self.thread.start()
+
+	def save(self, state, label, loss=None, best=False) :
+		# blocks for the copy of the tensors to host memory, and while max_pending snapshots are already waiting :
+		self.put( (self.write, (snapshot(state), label, loss, best)) )
+
+	def publish(self, obj, path) :
+		# obj saved as path on the same thread, e.g. the weights of one of the models of an ensemble :
+		self.put( (self.write_file, (snapshot(obj), path)) )
+
+	def put(self, job) :
+		try :
+			self.queue.put_nowait(job)
+		except queue.Full :
+			start = time.perf_counter()
+			self.queue.put(job)
+			print('CHECKPOINT : the training waited {:.2f} s for the previous checkpoints to be written.'.format(time.perf_counter()-start) )
+
+	def work(self) :
+		while True :
+			job = self.queue.get()
+			try :
+				if job is None :
+					return
+				fn, args = job
+				fn(*args)
+			except Exception as e :
+				self.errors.append(e)
+				print('EXCEPTION : CHECKPOINT : {}'.format(e) )
+			finally :
+				self.queue.task_done()
+
+	def write(self, state, label, loss, best) :
+		path = os.path.join(self.folder, str(label))
+		atomic_save(state, path)
+		self.written = [ w for w in self.written if w[2] != path ] + [ (label, loss, path) ]
+		if best :
+			best_path = os.path.join(self.SAVE_PATH, self.best_name)
+			weights = state[self.weights_key] if isinstance(state, dict) and self.weights_key in state else state
+			atomic_save(weights, best_path)
+			print('Model saved at : {}'.format(best_path) )
+		self.prune()
+		self.save_index()
+
+	def write_file(self, obj, path) :
+		atomic_save(obj, path)
+		print('Model saved at : {}'.format(path) )
+
+	def index_path(self) :
+		return os.path.join(self.folder, 'index.json')
+
+	def load_index(self) :
+		# the losses of the checkpoints are recorded in the index, the checkpoints missing from it (e.g. written before
+		# a crash) are ordered by label and have no loss :
+		written = []
+		if os.path.exists(self.index_path()) :
+			with open(self.index_path(), 'r') as f :
+				written = [ (label, loss, os.path.join(self.folder, label)) for label, loss in json.load(f) ]
+		indexed = set( w[0] for w in written )
+		names = sorted( name for name in os.listdir(self.folder) if name.startswith('step-') and '.tmp-' not in name and name not in indexed )
+		written = [ (name, None, os.path.join(self.folder, name)) for name in names ] + written
+		return sorted( [ w for w in written if os.path.exists(w[2]) ], key=lambda w : w[0] )
+
+	def save_index(self) :
+		tmp = '{}.tmp-{}'.format(self.index_path(), os.getpid())
+		with open(tmp, 'w') as f :
+			json.dump( [ (str(w[0]), w[1]) for w in self.written ], f)
+		os.replace(tmp, self.index_path())
+
+	def prune(self) :
+		keep = set( w[2] for w in self.written[-self.keep_last:] ) if self.keep_last > 0 else set()
+		ranked = sorted( [ w for w in self.written if w[1] is not None ], key=lambda w : w[1] )
+		keep.update( w[2] for w in ranked[:self.keep_best] )
+		for w in self.written :
+			if w[2] not in keep and os.path.exists(w[2]) :
+				os.remove(w[2])
+		self.written = [ w for w in self.written if w[2] in keep ]
+
+	def wait(self) :
+		# blocks until every submitted checkpoint is on disk :
+		self.queue.join()
+
+	def close(self) :
+		self.queue.put(None)
+		self.thread.join()
@@ -1,5 +1,5 @@
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
 from torchvision import transforms
 import numpy as np
 from PIL import Image 
@@ -34,6 +34,135 @@ class dSpriteDataset(Dataset) :
 		
 		return sample
 
+class ResumableSampler(Sampler) :
+	# random permutation of the dataset per epoch, drawn from its own generator seeded with (seed, epoch),
+	# that can restart in the middle of an epoch : the training can be resumed at the exact sample where it stopped.
+	# With num_replicas processes, each one iterates over its rank::num_replicas shard of the permutation,
+	# padded to the same length, as torch.utils.data.DistributedSampler does (the seed must then be the same for all of them).
+	def __init__(self, data_source, seed=None, num_replicas=1, rank=0) :
+		self.data_source = data_source
+		if seed is None :
+			seed = int( torch.randint(0, 2**31-1, (1,)).item() )
+		self.seed = seed
+		self.num_replicas = num_replicas
+		self.rank = rank
+		self.epoch = 0
+		self.start = 0
+		self.permutation = None
+
+	def set_epoch(self, epoch, start=0) :
+		# start : number of samples of the epoch already consumed :
+		if self.permutation is None or epoch != self.epoch :
+			generator = torch.Generator()
+			generator.manual_seed(self.seed + epoch)
+			self.permutation = torch.randperm(len(self.data_source), generator=generator)
+		self.epoch = epoch
+		self.start = start
+
+	def __iter__(self) :
+		if self.permutation is None :
+			self.set_epoch(self.epoch)
+		start = self.start
+		# the next iteration starts a full epoch :
+		self.start = 0
+		return iter( self.shard()[start:].tolist() )
+
+	def shard(self) :
+		if self.num_replicas == 1 :
+			return self.permutation
+		nbr_samples = self.shard_length()*self.num_replicas
+		padded = torch.cat( [self.permutation, self.permutation[:nbr_samples-len(self.permutation)] ] )
+		return padded[self.rank::self.num_replicas]
+
+	def shard_length(self) :
+		return -(-len(self.data_source) // self.num_replicas)
+
+	def __len__(self) :
+		return self.shard_length() - self.start
+
+	def state_dict(self, position=0) :
+		return dict( seed=self.seed, epoch=self.epoch, position=position, permutation=self.permutation )
+
+	def load_state_dict(self, state) :
+		self.seed = state['seed']
+		self.permutation = state['permutation']
+		self.epoch = state['epoch']
+		self.start = state['position']
+
+class CachedDataset(Dataset) :
+	# images of a dataset decoded and preprocessed once, kept as a single uint8 tensor : the images of every dataset are
+	# 8-bit pixels divided by 255, which the conversion keeps exactly, in a quarter of the float32 memory.
+	# Once moved to shared memory, the tensor is passed to other processes without being copied.
+	def __init__(self, images) :
+		self.images = images
+
+	def __len__(self) :
+		return self.images.size(0)
+
+	def __getitem__(self, idx) :
+		return (self.images[idx].float() / 255.0,)
+
+	def share_memory_(self) :
+		self.images.share_memory_()
+		return self
+
+def cache_dataset(dataset, batch_size=64, num_workers=0) :
+	# runs the decoding and the transforms of the dataset once, in order :
+	loader = torch.utils.data.DataLoader(dataset=dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+	images = None
+	start = 0
+	for sample in loader :
+		batch = sample['image'] if isinstance(sample, dict) else sample[0]
+		batch = ( batch.float()*255.0 ).round().clamp(0, 255).to(torch.uint8)
+		if images is None :
+			images = torch.empty( (len(dataset),)+tuple(batch.shape[1:]), dtype=torch.uint8)
+		images[start:start+batch.size(0)] = batch
+		start += batch.size(0)
+	print('DATASET CACHE : {} images of shape {}, {:.1f} MiB.'.format(len(dataset), tuple(images.shape[1:]), images.numel()/2**20) )
+	return CachedDataset(images)
+
+def make_data_loader(dataset, batch_size, seed=None, **kwargs) :
+	# shuffled data loader whose position can be saved and restored, sharded over the processes of a distributed training :
+	# the base seed of the loader iterators is drawn from its own generator rather than from the global one.
+	num_replicas, rank = 1, 0
+	if torch.distributed.is_available() and torch.distributed.is_initialized() :
+		num_replicas, rank = torch.distributed.get_world_size(), torch.distributed.get_rank()
+		if seed is None :
+			# the permutation of every process is drawn with the seed of the process of rank 0 :
+			seed = torch.randint(0, 2**31-1, (1,))
+			torch.distributed.broadcast(seed, src=0)
+			seed = int(seed.item())
+	sampler = ResumableSampler(dataset, seed=seed, num_replicas=num_replicas, rank=rank)
+	generator = torch.Generator()
+	generator.manual_seed(sampler.seed)
+	return torch.utils.data.DataLoader(dataset=dataset, batch_size=batch_size, sampler=sampler, generator=generator, **kwargs)
+
+DSPRITES_ROOT = './dsprites-dataset/dsprites_ndarray_co1sh3sc6or40x32y32_64x64.npz'
+
+def load_dSprite(img_dim=64, root=DSPRITES_ROOT, **kwargs) :
+	from models import Rescale
+	return dSpriteDataset(root=root, transform=transforms.Compose([ Rescale( (img_dim,img_dim) ), transforms.ToTensor()]) )
+
+def load_mnist(img_dim=64, root='./data', **kwargs) :
+	from torchvision import datasets
+	from models import Rescale
+	return datasets.MNIST(root=root, train=True, transform=transforms.Compose([ Rescale( (img_dim,img_dim) ), transforms.ToTensor()]), download=True)
+
+def load_XYS(img_dim=256, stacking=False, **kwargs) :
+	from datasetXYS import load_dataset_XYS
+	return load_dataset_XYS(img_dim=img_dim, stacking=stacking)
+
+# dataset registry, the counterpart of models.MODEL_SETTINGS :
+DATASETS = {
+	'dSprite' : load_dSprite,
+	'mnist' : load_mnist,
+	'XYS' : load_XYS,
+}
+
+def load_dataset(name, **kwargs) :
+	return DATASETS[name](**kwargs)
+
+
 def test_dSprite() :
 	import cv2
 	
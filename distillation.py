@@ -0,0 +1,157 @@
+import os
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.autograd import Variable
+
+from models import StudentEncoder
+from execution import format_input
+from quantization import encoder_latency
+
+
+class StudentVAE(nn.Module) :
+	# lightweight student encoder + the decoder of the teacher :
+	# same interface as the teacher, e.g. model(x) -> (out, mu, log_var), so that it can be queried and probed as such.
+	def __init__(self, teacher, width=16, depth=4) :
+		super(StudentVAE,self).__init__()
+		self.encoder = StudentEncoder(net_depth=depth, img_dim=teacher.img_dim, img_depth=teacher.img_depth, conv_dim=width, z_dim=2*teacher.z_dim)
+		self.decoder = teacher.decoder
+
+		self.z_dim = teacher.z_dim
+		self.img_dim = teacher.img_dim
+		self.img_depth = teacher.img_depth
+		self.channels_last = getattr(teacher, 'channels_last', False)
+
+		self.beta = teacher.beta
+		self.use_cuda = teacher.use_cuda
+
+		if self.use_cuda :
+			self = self.cuda()
+		if self.channels_last :
+			self.encoder = self.encoder.to(memory_format=torch.channels_last)
+
+	def reparameterize(self, mu,log_var) :
+		eps = torch.randn( (mu.size()[0], mu.size()[1]) )
+		veps = Variable( eps)
+		if self.use_cuda :
+			veps = veps.cuda()
+		z = mu + veps * torch.exp( log_var/2 )
+		return z
+
+	def forward(self,x) :
+		h = self.encoder( x)
+		mu, log_var = torch.chunk(h, 2, dim=1 )
+		z = self.reparameterize( mu,log_var)
+		out = self.decoder(z)
+
+		return out, mu, log_var
+
+def student_path(SAVE_PATH, width, depth) :
+	# only the student encoder is saved, the decoder is the teacher's one :
+	return os.path.join(SAVE_PATH, 'student-w{}-d{}'.format(width, depth) )
+
+def count_parameters(module) :
+	return sum( p.numel() for p in module.parameters() )
+
+def distillation_loss(h, teacher_h, log_var_weight=1.0) :
+	# regression of the teacher's (mu, log_var) :
+	mu, log_var = torch.chunk(h, 2, dim=1 )
+	teacher_mu, teacher_log_var = torch.chunk(teacher_h, 2, dim=1 )
+	return F.mse_loss(mu, teacher_mu) + log_var_weight*F.mse_loss(log_var, teacher_log_var)
+
+def distill(teacher, student, data_loader, nbr_epoch=10, lr=1e-3, log_var_weight=1.0) :
+	# trains the student encoder only, on the outputs of the frozen eval-mode teacher encoder :
+	teacher.eval()
+	student.encoder.train()
+	optimizer = torch.optim.Adam( student.encoder.parameters(), lr=lr)
+	iter_per_epoch = len(data_loader)
+
+	for epoch in range(nbr_epoch) :
+		epoch_loss = 0.0
+		for i, sample in enumerate(data_loader) :
+			images = sample['image'].float().view(-1, teacher.img_depth, teacher.img_dim, teacher.img_dim)
+			if teacher.use_cuda :
+				images = images.cuda()
+			images = format_input(teacher, images)
+
+			with torch.no_grad() :
+				teacher_h = teacher.encoder(images).float()
+			loss = distillation_loss( student.encoder(images), teacher_h, log_var_weight=log_var_weight)
+
+			optimizer.zero_grad()
+			loss.backward()
+			optimizer.step()
+
+			epoch_loss += loss.detach()
+			if i % 10 == 0 :
+				print('DISTILLATION : Epoch[{}/{}], Step [{}/{}], Loss: {:.6f}'.format(epoch+1, nbr_epoch, i+1, iter_per_epoch, loss.item()) )
+
+		print('DISTILLATION : Epoch[{}/{}] : mean loss : {:.6f}'.format(epoch+1, nbr_epoch, epoch_loss.item()/max(1,iter_per_epoch)) )
+
+	student.eval()
+	return student
+
+def latent_agreement(teacher, student, batches) :
+	# student vs teacher latents : errors on (mu, log_var) and coefficient of determination of each mu :
+	teacher.eval()
+	student.eval()
+	mus = []
+	teacher_mus = []
+	log_vars = []
+	teacher_log_vars = []
+	with torch.no_grad() :
+		for x in batches :
+			if teacher.use_cuda :
+				x = x.cuda()
+			x = format_input(teacher, x)
+			mu, log_var = torch.chunk( student.encoder(x).float(), 2, dim=1 )
+			teacher_mu, teacher_log_var = torch.chunk( teacher.encoder(x).float(), 2, dim=1 )
+			mus.append(mu.cpu())
+			teacher_mus.append(teacher_mu.cpu())
+			log_vars.append(log_var.cpu())
+			teacher_log_vars.append(teacher_log_var.cpu())
+	mu, teacher_mu = torch.cat(mus, dim=0), torch.cat(teacher_mus, dim=0)
+	log_var, teacher_log_var = torch.cat(log_vars, dim=0), torch.cat(teacher_log_vars, dim=0)
+
+	residuals = ( (mu-teacher_mu)**2 ).sum(dim=0)
+	variances = ( (teacher_mu-teacher_mu.mean(dim=0, keepdim=True))**2 ).sum(dim=0).clamp(min=1e-12)
+	r2 = 1.0 - residuals/variances
+
+	return dict( mu_mse=F.mse_loss(mu, teacher_mu).item(),
+				log_var_mse=F.mse_loss(log_var, teacher_log_var).item(),
+				mu_r2=r2.tolist(),
+				mean_mu_r2=r2.mean().item() )
+
+def report_distillation(teacher, student, batches) :
+	# latent agreement, number of parameters and latency per image of the teacher and student encoders :
+	batches = list(batches)
+	report = latent_agreement(teacher, student, batches)
+
+	x = batches[0][:1]
+	if teacher.use_cuda :
+		x = x.cuda()
+	x = format_input(teacher, x)
+	report.update( teacher_params=count_parameters(teacher.encoder),
+					student_params=count_parameters(student.encoder),
+					teacher_ms=encoder_latency(teacher.encoder, x),
+					student_ms=encoder_latency(student.encoder, x) )
+
+	print('DISTILLATION REPORT : mu MSE {mu_mse:.5f} // log_var MSE {log_var_mse:.5f} // mean mu R2 {mean_mu_r2:.4f} :: encoder parameters : teacher {teacher_params} // student {student_params} :: latency per image : teacher {teacher_ms:.3f} ms // student {student_ms:.3f} ms'.format(**report) )
+	print('DISTILLATION REPORT : mu R2 per latent : {}'.format( ', '.join( '{:.4f}'.format(r) for r in report['mu_r2'] ) ) )
+	return report
+
+def load_or_distill(teacher, data_loader, SAVE_PATH, width=16, depth=4, nbr_epoch=10, lr=1e-3) :
+	# loads the student encoder saved for this (width, depth), or distills and saves it :
+	student = StudentVAE(teacher, width=width, depth=depth)
+	path = student_path(SAVE_PATH, width, depth)
+	try :
+		student.encoder.load_state_dict( torch.load(path) )
+		print('STUDENT LOADING : OK.')
+	except Exception as e :
+		print('EXCEPTION : STUDENT LOADING : {} : distillation of the encoder...'.format(e) )
+		distill(teacher, student, data_loader, nbr_epoch=nbr_epoch, lr=lr)
+		torch.save( student.encoder.state_dict(), path)
+		print('Student encoder saved at : {}'.format(path) )
+
+	return student.eval()
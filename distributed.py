@@ -0,0 +1,107 @@
+import os
+import signal
+import subprocess
+import sys
+
+import torch
+import torch.distributed as dist
+
+from checkpoint import seed_rng
+
+
+def world_size() :
+	if dist.is_available() and dist.is_initialized() :
+		return dist.get_world_size()
+	return 1
+
+def rank() :
+	if dist.is_available() and dist.is_initialized() :
+		return dist.get_rank()
+	return 0
+
+def is_main_process() :
+	# checkpoints, images and logs are only written by the process of rank 0 :
+	return rank() == 0
+
+def init_distributed(backend='gloo', seed=None) :
+	# joins the process group described by the environment of the launcher (RANK, WORLD_SIZE, MASTER_ADDR, MASTER_PORT),
+	# and splits the cores of the node between its processes. Single-process runs are left untouched.
+	# The random generators of each process are seeded with seed+rank, so that the reparameterization noise and the dropout
+	# masks differ between the processes (seed : drawn by the process of rank 0 if None).
+	if int(os.environ.get('WORLD_SIZE', '1')) <= 1 or dist.is_initialized() :
+		return False
+	dist.init_process_group(backend=backend)
+	if seed is None :
+		seed = torch.tensor( [ int.from_bytes(os.urandom(4), 'little') // 2 if dist.get_rank() == 0 else 0 ] )
+		dist.all_reduce(seed)
+		seed = int(seed.item())
+	seed_rng(seed + dist.get_rank())
+	local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', dist.get_world_size()))
+	if 'OMP_NUM_THREADS' not in os.environ :
+		torch.set_num_threads( max(1, (os.cpu_count() or 1) // local_world_size) )
+	print('DISTRIBUTED : process {}/{} ({} backend, {} threads, seed {}).'.format(dist.get_rank(), dist.get_world_size(), backend, torch.get_num_threads(), seed + dist.get_rank()) )
+	return True
+
+def parallelize(model) :
+	# DistributedDataParallel wrapper of the model, whose gradients are averaged over the processes during the backward pass,
+	# or the model itself in a single-process run. The model keeps being used for everything but the training forward pass.
+	if world_size() == 1 :
+		return model
+	from torch.nn.parallel import DistributedDataParallel
+	return DistributedDataParallel(model, device_ids=[torch.cuda.current_device()] if model.use_cuda else None)
+
+def all_reduce(tensor, op='sum') :
+	# in place, over all the processes :
+	if world_size() > 1 :
+		dist.all_reduce(tensor, op=dist.ReduceOp.MAX if op == 'max' else dist.ReduceOp.SUM)
+	return tensor
+
+def all_gather_object(obj) :
+	# list of the obj of every process, indexed by rank :
+	if world_size() == 1 :
+		return [obj]
+	objects = [None]*world_size()
+	dist.all_gather_object(objects, obj)
+	return objects
+
+def launch(script_args, nproc=2, nnodes=1, node_rank=0, master_addr='127.0.0.1', master_port=29500) :
+	# runs nproc processes of the script on this node, out of the nproc*nnodes processes of the training :
+	# the same command is run on every node with its own node_rank, and the address of the node of rank 0.
+	threads = max(1, (os.cpu_count() or 1) // nproc)
+	processes = []
+	for local_rank in range(nproc) :
+		env = dict(os.environ,
+					RANK=str(node_rank*nproc+local_rank),
+					LOCAL_RANK=str(local_rank),
+					WORLD_SIZE=str(nnodes*nproc),
+					LOCAL_WORLD_SIZE=str(nproc),
+					MASTER_ADDR=master_addr,
+					MASTER_PORT=str(master_port) )
+		env.setdefault('OMP_NUM_THREADS', str(threads))
+		processes.append( subprocess.Popen( [sys.executable]+list(script_args), env=env) )
+
+	# the preemption signal is forwarded to the processes, which save the training state before exiting :
+	signal.signal(signal.SIGTERM, lambda signum, frame : [ process.send_signal(signal.SIGTERM) for process in processes ] )
+	returncode = 0
+	try :
+		for process in processes :
+			returncode = process.wait() or returncode
+	except KeyboardInterrupt :
+		for process in processes :
+			process.terminate()
+		returncode = 1
+	return returncode
+
+
+if __name__ == '__main__' :
+	import argparse
+	parser = argparse.ArgumentParser(description='Data-parallel launcher of the training scripts, e.g. : python distributed.py --nproc 4 beta-VAE-XYS.py --train')
+	parser.add_argument('--nproc', type=int, default=2, help='number of processes on this node')
+	parser.add_argument('--nnodes', type=int, default=1)
+	parser.add_argument('--node_rank', type=int, default=0)
+	parser.add_argument('--master_addr', type=str, default='127.0.0.1')
+	parser.add_argument('--master_port', type=int, default=29500)
+	parser.add_argument('script', nargs=argparse.REMAINDER, help='training script and its arguments')
+	args = parser.parse_args()
+
+	sys.exit( launch(args.script, nproc=args.nproc, nnodes=args.nnodes, node_rank=args.node_rank, master_addr=args.master_addr, master_port=args.master_port) )
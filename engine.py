@@ -0,0 +1,717 @@
+import json
+import math
+import os
+import signal
+import threading
+import time
+from collections import defaultdict
+from contextlib import nullcontext
+
+import torch
+import torch.nn.functional as F
+import torchvision
+
+from models import MODEL_SETTINGS, build_model
+from datasets import DATASETS, load_dataset, make_data_loader
+from execution import set_execution_mode, format_input, autocast, to_float
+from profiler import saved_activation_bytes
+from visualization import save_traversal, save_images, VisualizationWriter
+from checkpoint import CheckpointWriter, rng_state, set_rng_state, latest_checkpoint
+from shared_dataset import attach_dataset
+import distributed
+
+
+def batch_images(model, sample) :
+	# images of a XYS (dict) or dSprites/MNIST (tuple) batch, on the device and in the memory format of the model :
+	images = sample['image'] if isinstance(sample, dict) else sample[0]
+	images = images.float().view(-1, model.img_depth, model.img_dim, model.img_dim)
+	if model.use_cuda :
+		images = images.cuda(non_blocking=True)
+	return format_input(model, images)
+
+def vae_losses(model, out, images, mu, log_var, kl_reduction='mean', batch_size=None, beta=None) :
+	# reconstruction loss summed over the batch, KL divergence averaged ('mean') or summed ('sum') over the batch,
+	# weighted by beta (the beta of the model by default).
+	# images may be a micro-batch of a batch of batch_size images : every term is then its share of the loss of the
+	# whole batch, so that the losses (and the gradients) of the micro-batches add up to those of the batch.
+	if batch_size is None :
+		batch_size = images.size(0)
+	reconst_loss = F.binary_cross_entropy( out, images, reduction='sum')
+	kl_per_dim = ( 0.5 * (mu**2 + torch.exp(log_var) - log_var -1) ).sum(dim=0)
+	if kl_reduction == 'mean' :
+		kl_per_dim = kl_per_dim / batch_size
+	kl_divergence = kl_per_dim.sum()
+	if beta is None :
+		beta = model.beta
+	total_loss = reconst_loss + beta*kl_divergence
+	# mean log p(x|z) per pixel, i.e. the Bernoulli log-likelihood of binary images, without materializing the distribution :
+	expected_log_lik = -reconst_loss / (batch_size * images[0].numel())
+	return dict( total_loss=total_loss, reconst_loss=reconst_loss, kl_divergence=kl_divergence, kl_per_dim=kl_per_dim, expected_log_lik=expected_log_lik)
+
+
+class Callback(object) :
+	# hooks of the training engine, the metrics are detached device tensors :
+	# reading them (.item(), .cpu()) synchronizes the host with the device and should only happen at an interval.
+	def on_train_begin(self, engine) :
+		pass
+
+	def on_epoch_begin(self, engine) :
+		pass
+
+	def on_step_end(self, engine, metrics) :
+		pass
+
+	def on_epoch_end(self, engine) :
+		pass
+
+	def on_preempt(self, engine) :
+		# SIGTERM was received, the training stops at the end of the current step :
+		pass
+
+	def on_train_end(self, engine) :
+		pass
+
+
+class Engine(object) :
+	def __init__(self, model, optimizer, data_loader, nbr_epoch=100, offset=0, kl_reduction='mean', callbacks=None, sync_timings=False, scheduler=None, micro_batch=None, parallel_model=None, preemption_interval=10) :
+		if getattr(model, 'frozen', False) :
+			raise RuntimeError('{} : frozen models are eval-only, the BatchNorm layers have been folded (see inference.freeze).'.format(model.__class__.__name__) )
+		self.model = model
+		# wrapper of the model running the training forward pass, e.g. its DistributedDataParallel wrapper
+		# (the model itself is used for everything else, e.g. the callbacks and the state_dict) :
+		self.parallel_model = parallel_model if parallel_model is not None else model
+		self.world_size = distributed.world_size()
+		self.optimizer = optimizer
+		# maximal number of images per forward/backward pass, the gradients of the micro-batches of a batch
+		# being accumulated before a single optimizer step (None : the whole batch at once) :
+		self.micro_batch = micro_batch
+		# stepped at the end of each epoch :
+		self.scheduler = scheduler
+		self.data_loader = data_loader
+		self.nbr_epoch = nbr_epoch
+		# offset of the epoch numbers, e.g. when the training is continued from saved weights :
+		self.offset = offset
+		self.kl_reduction = kl_reduction
+		self.callbacks = list(callbacks) if callbacks is not None else []
+		# the phases are timed on the host, which only measures the kernel launches on CUDA,
+		# unless the device is synchronized at each phase boundary :
+		self.sync_timings = sync_timings
+		# in a distributed training, number of steps between two agreements of the processes on a preemption,
+		# which is also checked at the end of each epoch (a single process checks its own flag at every step) :
+		self.preemption_interval = max(1, preemption_interval)
+
+		self.device = next(model.parameters()).device
+		self.iter_per_epoch = len(data_loader)
+		self.epoch = 0
+		self.iteration = 0
+		# first batch of the next epoch, when resuming in the middle of an epoch :
+		self.resume_iteration = 0
+		self.step = 0
+		self.best_loss = None
+		self.stop = False
+		self.preempted = False
+		self.timings = defaultdict(float)
+		# random generator states of every process, gathered at the steps where rank 0 can write a checkpoint :
+		self.rng_states = None
+		# state of the generator of the data loader when the current epoch started :
+		self.loader_rng = None
+		self.reset_epoch_stats()
+
+	def label(self) :
+		# number of the current epoch in the file names and logs :
+		return self.epoch + self.offset + 1
+
+	def reset_epoch_stats(self) :
+		# accumulated on the device, without a host synchronization per step :
+		self.epoch_loss = torch.zeros( (), device=self.device)
+		self.mu_sum = torch.zeros( (self.model.z_dim), device=self.device)
+		self.sigma_sum = torch.zeros( (self.model.z_dim), device=self.device)
+		self.nbr_steps = 0
+
+	def latent_stats(self) :
+		# mean of the batch-mean mu and sigma over the steps of the last epoch, the prior before the first one :
+		if self.nbr_steps == 0 :
+			return torch.zeros( (self.model.z_dim) ), torch.ones( (self.model.z_dim) )
+		return self.mu_sum / self.nbr_steps, self.sigma_sum / self.nbr_steps
+
+	def synchronize(self) :
+		if self.sync_timings and self.device.type == 'cuda' :
+			torch.cuda.synchronize()
+
+	def tick(self, phase, start) :
+		self.synchronize()
+		now = time.perf_counter()
+		self.timings[phase] += now - start
+		return now
+
+	def call(self, hook, *args) :
+		for callback in self.callbacks :
+			getattr(callback, hook)(self, *args)
+
+	def forward(self, images, batch_size=None) :
+		with autocast(self.model, images.device.type) :
+			out, mu, log_var = self.parallel_model(images)
+		out, mu, log_var = to_float(out, mu, log_var)
+		return vae_losses(self.model, out, images, mu, log_var, kl_reduction=self.kl_reduction, batch_size=batch_size), mu, log_var
+
+	def train_step(self, images) :
+		# forward and backward passes on the micro-batches of the batch, and a single optimizer step,
+		# returns the detached metrics of the whole batch :
+		batch_size = images.size(0)
+		chunks = [images]
+		if self.micro_batch is not None and self.micro_batch < batch_size :
+			chunks = torch.split(images, self.micro_batch, dim=0)
+
+		self.optimizer.zero_grad(set_to_none=True)
+		metrics = None
+		for index, chunk in enumerate(chunks) :
+			# the gradients are only averaged over the processes during the backward pass of the last micro-batch :
+			last = index == len(chunks)-1
+			with nullcontext() if last or not hasattr(self.parallel_model, 'no_sync') else self.parallel_model.no_sync() :
+				start = time.perf_counter()
+				losses, mu, log_var = self.forward(chunk, batch_size=batch_size)
+				start = self.tick('forward', start)
+
+				self.backward_loss(losses).backward()
+				self.tick('backward', start)
+
+			chunk_metrics = dict( (k, v.detach()) for k, v in losses.items() )
+			# batch means of the posterior statistics :
+			chunk_metrics['mu_mean'] = mu.detach().sum(dim=0) / batch_size
+			chunk_metrics['sigma_mean'] = torch.exp( log_var.detach()/2 ).sum(dim=0) / batch_size
+			if metrics is None :
+				metrics = chunk_metrics
+			else :
+				for k, v in chunk_metrics.items() :
+					metrics[k] = metrics[k] + v
+
+		start = time.perf_counter()
+		self.optimizer.step()
+		self.tick('optimizer', start)
+
+		metrics['batch_size'] = batch_size
+		return metrics
+
+	def backward_loss(self, losses) :
+		# DistributedDataParallel averages the gradients over the processes : the terms summed over the images are scaled by
+		# the number of processes, so that the gradients are those of the loss of the global batch of all the processes.
+		if self.world_size == 1 :
+			return losses['total_loss']
+		kl_scale = 1 if self.kl_reduction == 'mean' else self.world_size
+		return self.world_size*losses['reconst_loss'] + self.model.beta*kl_scale*losses['kl_divergence']
+
+	def preempt(self, signum, frame) :
+		self.preempted = True
+
+	def check_preemption(self) :
+		# every process stops at the same step, the first boundary of preemption_interval steps after any of them
+		# received SIGTERM : the other steps run without a collective nor a host synchronization.
+		preempted = self.preempted
+		if self.world_size > 1 :
+			if self.step % self.preemption_interval != 0 :
+				return
+			preempted = bool( distributed.all_reduce( torch.tensor( [int(self.preempted)] ), op='max').item() )
+		if preempted :
+			self.preempted = True
+			self.call('on_preempt')
+			self.stop = True
+
+	def gather_rng_states(self, boundary=True) :
+		# collective : every process contributes the state of its own random generators, restored by rank on resume.
+		# The checkpoints of a distributed training are only written at these boundaries (see preemption_interval).
+		if self.world_size > 1 and boundary :
+			self.rng_states = distributed.all_gather_object( rng_state() )
+
+	def reduce_epoch_stats(self) :
+		# epoch loss summed and posterior statistics averaged over the processes, which also agree on a preemption :
+		if self.world_size == 1 :
+			return
+		preempted = torch.tensor( [float(self.preempted)], device=self.device)
+		stats = torch.cat( [ self.epoch_loss.view(1), self.mu_sum, self.sigma_sum, preempted ] ).cpu()
+		distributed.all_reduce(stats)
+		self.epoch_loss = stats[0].to(self.device)
+		self.mu_sum = ( stats[1:1+self.model.z_dim] / self.world_size ).to(self.device)
+		self.sigma_sum = ( stats[1+self.model.z_dim:1+2*self.model.z_dim] / self.world_size ).to(self.device)
+		self.preempted = bool( stats[-1].item() > 0 )
+
+	def resumable(self) :
+		# whether the data loader can restart at a given sample, e.g. with datasets.ResumableSampler :
+		return hasattr( getattr(self.data_loader, 'sampler', None), 'set_epoch')
+
+	def state_dict(self, epoch, iteration) :
+		# full training state, to be resumed at the batch iteration of the epoch :
+		state = dict( model=self.model.state_dict(),
+					optimizer=self.optimizer.state_dict(),
+					scheduler=self.scheduler.state_dict() if self.scheduler is not None else None,
+					rng=self.rng_states if self.world_size > 1 and self.rng_states is not None else rng_state(),
+					epoch=epoch, iteration=iteration, step=self.step, offset=self.offset, best_loss=self.best_loss,
+					# statistics of the epoch in progress :
+					epoch_loss=self.epoch_loss, mu_sum=self.mu_sum, sigma_sum=self.sigma_sum, nbr_steps=self.nbr_steps )
+		if self.resumable() :
+			state['sampler'] = self.data_loader.sampler.state_dict( position=iteration*self.data_loader.batch_size )
+		generator = getattr(self.data_loader, 'generator', None)
+		if generator is not None :
+			# the generator of the loader draws the base seed of its workers when an epoch starts : in the middle of an epoch,
+			# its state before that draw, so that the resumed epoch gets the same worker seeds :
+			state['loader_rng'] = self.loader_rng if iteration > 0 and self.loader_rng is not None else generator.get_state()
+		return state
+
+	def load_state_dict(self, state) :
+		self.model.load_state_dict(state['model'])
+		self.optimizer.load_state_dict(state['optimizer'])
+		if self.scheduler is not None and state['scheduler'] is not None :
+			self.scheduler.load_state_dict(state['scheduler'])
+		self.epoch = state['epoch']
+		self.resume_iteration = state['iteration']
+		self.step = state['step']
+		self.offset = state['offset']
+		self.best_loss = state['best_loss']
+		self.epoch_loss = state['epoch_loss'].to(self.device)
+		self.mu_sum = state['mu_sum'].to(self.device)
+		self.sigma_sum = state['sigma_sum'].to(self.device)
+		self.nbr_steps = state['nbr_steps']
+
+		if state.get('loader_rng') is not None and getattr(self.data_loader, 'generator', None) is not None :
+			self.data_loader.generator.set_state(state['loader_rng'])
+		if 'sampler' in state and self.resumable() :
+			self.data_loader.sampler.load_state_dict(state['sampler'])
+		elif self.resume_iteration :
+			print('EXCEPTION : RESUME : the data loader has no resumable sampler, epoch {} restarts from its first batch.'.format(self.label()) )
+			self.resume_iteration = 0
+			self.reset_epoch_stats()
+		# last, so that the random draws continue exactly where they stopped, each process with its own generators :
+		rng = state['rng']
+		if isinstance(rng, list) :
+			rng = rng[distributed.rank()] if len(rng) == self.world_size else rng[0]
+		set_rng_state(rng)
+
+	def run_epoch(self) :
+		self.model.train()
+		first = self.resume_iteration
+		self.resume_iteration = 0
+		if first == 0 :
+			self.reset_epoch_stats()
+		if self.resumable() :
+			self.data_loader.sampler.set_epoch(self.epoch, start=first*self.data_loader.batch_size)
+		generator = getattr(self.data_loader, 'generator', None)
+		self.loader_rng = generator.get_state() if generator is not None else None
+		start = time.perf_counter()
+		for i, sample in enumerate(self.data_loader, first) :
+			self.iteration = i
+			images = batch_images(self.model, sample)
+			start = self.tick('data', start)
+
+			metrics = self.train_step(images)
+			self.epoch_loss += metrics['total_loss']
+			self.mu_sum += metrics['mu_mean']
+			self.sigma_sum += metrics['sigma_mean']
+			self.nbr_steps += 1
+			self.step += 1
+
+			start = time.perf_counter()
+			self.gather_rng_states( boundary=self.step % self.preemption_interval == 0 )
+			self.call('on_step_end', metrics)
+			self.check_preemption()
+			start = self.tick('callbacks', start)
+			if self.stop :
+				break
+
+	def run(self) :
+		# signal handlers can only be installed from the main thread :
+		previous_handler = None
+		if threading.current_thread() is threading.main_thread() :
+			previous_handler = signal.signal(signal.SIGTERM, self.preempt)
+		try :
+			self.run_epochs()
+		finally :
+			if previous_handler is not None :
+				signal.signal(signal.SIGTERM, previous_handler)
+		return self.best_loss
+
+	def run_epochs(self) :
+		self.call('on_train_begin')
+		for epoch in range(self.epoch, self.nbr_epoch) :
+			self.epoch = epoch
+			start = time.perf_counter()
+			self.call('on_epoch_begin')
+			self.tick('callbacks', start)
+
+			self.run_epoch()
+			if self.stop :
+				# interrupted in the middle of the epoch :
+				break
+			self.reduce_epoch_stats()
+			self.gather_rng_states()
+			# before the callbacks, so that the checkpoint of the end of the epoch holds the learning rate of the next one :
+			if self.scheduler is not None :
+				self.scheduler.step()
+
+			start = time.perf_counter()
+			self.call('on_epoch_end')
+			self.tick('callbacks', start)
+			# preempted since the last check : the state of the end of the epoch is the one to resume from :
+			if self.preempted :
+				print('PREEMPTION : stopping at the end of epoch {}.'.format(self.label()) )
+				self.stop = True
+			if self.stop :
+				break
+		self.call('on_train_end')
+
+	def timing_report(self) :
+		# total seconds and milliseconds per step of each phase :
+		nbr_steps = max(1, self.step)
+		return dict( (phase, dict( total=total, ms_per_step=1e3*total/nbr_steps) ) for phase, total in self.timings.items() )
+
+
+def format_metric(value, fmt, fn=None) :
+	# a metric of the console logs, or the ' / '-separated values of the models of an ensemble :
+	if isinstance(value, list) :
+		return ' / '.join( format_metric(v, fmt, fn) for v in value )
+	return fmt.format( fn(value) if fn is not None else value )
+
+class LoggingCallback(Callback) :
+	# metrics summed on the device over the last interval steps, and materialized with a single host synchronization
+	# as one JSON line (step, epoch, mean losses, per-dimension KL, throughput, wall time), optionally echoed on the console :
+	SCALARS = ['total_loss', 'reconst_loss', 'kl_divergence', 'expected_log_lik']
+
+	def __init__(self, log_path=None, interval=10, echo=True) :
+		self.log_path = log_path
+		self.interval = interval
+		self.echo = echo
+		self.log_file = None
+		self.shapes = None
+		self.reset()
+
+	def reset(self) :
+		self.sums = None
+		self.nbr_steps = 0
+		self.nbr_images = 0
+		self.start = time.perf_counter()
+
+	def on_train_begin(self, engine) :
+		if self.log_path is not None :
+			# appended, so that a continued training keeps its history :
+			self.log_file = open(self.log_path, 'a')
+		self.train_start = time.perf_counter()
+		self.reset()
+
+	def on_step_end(self, engine, metrics) :
+		# the metrics are flattened into a single tensor, whatever their shape (e.g. [M] and [M, z_dim] for an ensemble) :
+		keys = self.SCALARS + ['kl_per_dim']
+		if self.shapes is None :
+			self.shapes = [ tuple(metrics[k].shape) for k in keys ]
+		values = torch.cat( [ metrics[k].reshape(-1) for k in keys ] )
+		self.sums = values if self.sums is None else self.sums + values
+		self.nbr_steps += 1
+		self.nbr_images += metrics['batch_size']
+		if self.nbr_steps >= self.interval :
+			self.flush(engine)
+
+	def on_epoch_end(self, engine) :
+		if self.nbr_steps :
+			self.flush(engine)
+		timings = engine.timing_report()
+		record = dict( type='epoch', step=engine.step, epoch=engine.label(), epoch_loss=engine.epoch_loss.tolist(),
+						timings_ms_per_step=dict( (phase, t['ms_per_step']) for phase, t in timings.items() ),
+						wall_time=time.perf_counter()-self.train_start )
+		self.write(record)
+		if self.echo :
+			print('TIMINGS : Epoch[{}/{}] : {}'.format(engine.epoch+1, engine.nbr_epoch, ' // '.join( '{} {:.2f} ms/step'.format(phase, ms) for phase, ms in record['timings_ms_per_step'].items() ) ) )
+
+	def on_train_end(self, engine) :
+		if self.log_file is not None :
+			self.log_file.close()
+			self.log_file = None
+
+	def flush(self, engine) :
+		# the only host synchronization of the logging :
+		values = (self.sums / self.nbr_steps).cpu()
+		elapsed = time.perf_counter() - self.start
+		keys = self.SCALARS + ['kl_per_dim']
+		values = torch.split(values, [ math.prod(shape) for shape in self.shapes ])
+		record = dict( type='step', step=engine.step, epoch=engine.label(), iteration=engine.iteration+1, nbr_steps=self.nbr_steps )
+		record.update( (k, v.view(shape).tolist()) for k, v, shape in zip(keys, values, self.shapes) )
+		record.update( images_per_sec=self.nbr_images/max(elapsed, 1e-9),
+						wall_time=time.perf_counter()-self.train_start )
+		self.write(record)
+		if self.echo :
+			print ("Epoch[%d/%d], Step [%d/%d], Total Loss: %s, "
+			       "Reconst Loss: %s, KL Div: %s, E[ |~| p(x|theta)]: %s, %.1f img/s"
+			       %(engine.epoch+1, engine.nbr_epoch, engine.iteration+1, engine.iter_per_epoch, format_metric(record['total_loss'], '{:.4f}'),
+			         format_metric(record['reconst_loss'], '{:.4f}'), format_metric(record['kl_divergence'], '{:.7f}'), format_metric(record['expected_log_lik'], '{:.7f}', math.exp), record['images_per_sec']) )
+		self.reset()
+
+	def write(self, record) :
+		if self.log_file is not None :
+			self.log_file.write( json.dumps(record)+'\n' )
+			self.log_file.flush()
+
+
+class ReconstructionCallback(Callback) :
+	# reconstructions of the fixed batch every interval steps (0 disables them), below the originals
+	# (or alone, as a column of stacked frames), encoded by the writer (a VisualizationWriter) if any :
+	def __init__(self, fixed_x, path, interval=100, scale=1.0, stacking=False, writer=None) :
+		self.fixed_x = fixed_x
+		self.path = path
+		self.interval = interval
+		self.scale = scale
+		self.stacking = stacking
+		self.writer = writer
+
+	def on_step_end(self, engine, metrics) :
+		if self.interval <= 0 or engine.iteration % self.interval != 0 :
+			return
+		model = engine.model
+		img_depth, img_dim = model.img_depth, model.img_dim
+		training = model.training
+		model.eval()
+		with torch.no_grad() :
+			with autocast(model, self.fixed_x.device.type) :
+				reconst_images, _, _ = model(self.fixed_x)
+		model.train(training)
+
+		reconst_images = reconst_images.float().cpu().view(-1, img_depth, img_dim, img_dim)
+		if self.stacking :
+			ri = reconst_images.view( (-1, 1, img_depth*img_dim, img_dim) )
+		else :
+			orimg = self.fixed_x.cpu().view(-1, img_depth, img_dim, img_dim)
+			ri = torch.cat( [orimg, reconst_images], dim=2)
+		save_images(self.scale*ri, './beta-data/{}/reconst_images/{}.png'.format(self.path, engine.label()), writer=self.writer)
+
+
+class TraversalCallback(Callback) :
+	# latent traversal around the mean posterior statistics of the previous epoch, every interval epochs (0 disables it) :
+	def __init__(self, path, nbr_steps=8, scale=1.0, stacking=False, blank_row=True, interval=1, writer=None) :
+		self.path = path
+		self.nbr_steps = nbr_steps
+		self.scale = scale
+		self.stacking = stacking
+		self.blank_row = blank_row
+		self.interval = interval
+		self.writer = writer
+
+	def on_epoch_begin(self, engine) :
+		if self.interval <= 0 or engine.epoch % self.interval != 0 :
+			return
+		model = engine.model
+		img_shape = (model.img_depth, model.img_dim, model.img_dim)
+		if self.stacking :
+			img_shape = (1, model.img_depth*model.img_dim, model.img_dim)
+		mu_mean, sigma_mean = engine.latent_stats()
+		save_traversal(model.decoder, mu_mean, sigma_mean, './beta-data/{}/gen_images/{}.png'.format(self.path, engine.label()), nbr_steps=self.nbr_steps, scale=self.scale, img_shape=img_shape, blank_row=self.blank_row, writer=self.writer)
+
+
+class CheckpointCallback(Callback) :
+	# full training state written in the background at the end of each epoch (and every interval steps if interval > 0),
+	# the weights of the epoch with the lowest training loss being published as SAVE_PATH/weights.
+	# On preemption (SIGTERM), the state is saved at the end of the current step before the training stops.
+	def __init__(self, SAVE_PATH, keep_last=2, keep_best=1, interval=0) :
+		self.SAVE_PATH = SAVE_PATH
+		self.keep_last = keep_last
+		self.keep_best = keep_best
+		self.interval = interval
+		self.writer = None
+
+	def on_train_begin(self, engine) :
+		self.writer = CheckpointWriter(self.SAVE_PATH, keep_last=self.keep_last, keep_best=self.keep_best)
+
+	def label(self, engine) :
+		# zero-padded global step, so that the names sort in training order :
+		return 'step-{:010d}'.format(engine.step)
+
+	def on_step_end(self, engine, metrics) :
+		if self.interval > 0 and engine.step % self.interval == 0 :
+			self.writer.save( engine.state_dict(engine.epoch, engine.iteration+1), self.label(engine) )
+
+	def on_preempt(self, engine) :
+		self.writer.save( engine.state_dict(engine.epoch, engine.iteration+1), self.label(engine) )
+		print('PREEMPTION : state saved at step {} (epoch {}, batch {}), stopping.'.format(engine.step, engine.label(), engine.iteration+1) )
+
+	def on_epoch_end(self, engine) :
+		# one host synchronization per epoch :
+		epoch_loss = engine.epoch_loss.item()
+		best = engine.best_loss is None or epoch_loss < engine.best_loss
+		if best :
+			engine.best_loss = epoch_loss
+		self.writer.save( engine.state_dict(engine.epoch+1, 0), self.label(engine), loss=epoch_loss, best=best)
+
+	def on_train_end(self, engine) :
+		self.writer.close()
+
+
+class EvaluationCallback(Callback) :
+	# calls fn(model) every interval epochs, e.g. an IWAE bound or a linear probe, and keeps its results :
+	def __init__(self, fn, interval=1) :
+		self.fn = fn
+		self.interval = interval
+		self.results = []
+
+	def on_epoch_end(self, engine) :
+		if (engine.epoch+1) % self.interval != 0 :
+			return
+		training = engine.model.training
+		result = self.fn(engine.model)
+		engine.model.train(training)
+		self.results.append( (engine.label(), result) )
+		print('EVALUATION : Epoch[{}/{}] : {}'.format(engine.epoch+1, engine.nbr_epoch, result) )
+
+
+def fixed_batch(model, data_loader, path, scale=1.0, stacking=False) :
+	# first batch of the data loader, saved as the reference of the reconstructions :
+	sample = next(iter(data_loader))
+	fixed_x = sample['image'] if isinstance(sample, dict) else sample[0]
+	fixed_x = fixed_x.float().view( (-1, model.img_depth, model.img_dim, model.img_dim) )
+	real_images = fixed_x
+	if stacking :
+		real_images = fixed_x.view( (-1, 1, model.img_depth*model.img_dim, model.img_dim) )
+	torchvision.utils.save_image(scale*real_images, './beta-data/{}/real_images.png'.format(path))
+	return batch_images(model, [fixed_x])
+
+def default_memory_budget(device) :
+	# bytes available for a training step : most of the free memory of a CUDA device, half of the available RAM otherwise :
+	if device.type == 'cuda' :
+		free, total = torch.cuda.mem_get_info(device)
+		return int(0.8*free)
+	try :
+		return int( 0.5 * os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') )
+	except (ValueError, OSError, AttributeError) :
+		return 4*2**30
+
+def probe_micro_batch(model, batch_size, memory_budget=None, probe_size=2) :
+	# largest micro-batch (at most batch_size) whose training step fits in memory_budget bytes :
+	# the weights, gradients and Adam moments, plus the activations saved for the backward pass,
+	# measured per image on a probe batch of probe_size images.
+	device = next(model.parameters()).device
+	if memory_budget is None :
+		memory_budget = default_memory_budget(device)
+	param_bytes = sum( p.numel()*p.element_size() for p in model.parameters() )
+	x = format_input(model, torch.rand( (probe_size, model.img_depth, model.img_dim, model.img_dim), device=device) )
+
+	# the probe must not update the BatchNorm running statistics :
+	buffers = dict( (name, b.clone()) for name, b in model.named_buffers() )
+	training = model.training
+	model.train()
+	per_image = saved_activation_bytes(model, x) / probe_size
+	with torch.no_grad() :
+		for name, b in model.named_buffers() :
+			b.copy_(buffers[name])
+	model.train(training)
+
+	micro_batch = int( (memory_budget - 4*param_bytes) // max(1.0, per_image) )
+	micro_batch = max(1, min(batch_size, micro_batch))
+	print('MICRO-BATCH : {:.1f} MiB of saved activations per image, budget {:.1f} MiB : {} images per pass for a batch of {}.'.format(per_image/2**20, memory_budget/2**20, micro_batch, batch_size) )
+	return micro_batch
+
+def resume_training(engine, SAVE_PATH) :
+	# restores the latest full-state checkpoint of SAVE_PATH, if any :
+	path = latest_checkpoint(SAVE_PATH)
+	if path is None :
+		print('EXCEPTION : RESUME : no checkpoint in {} : starting from scratch.'.format(os.path.join(SAVE_PATH,'checkpoints')) )
+		return False
+	engine.load_state_dict( torch.load(path, map_location='cpu', weights_only=False) )
+	print('RESUME : {} : epoch {}, batch {}, step {}.'.format(path, engine.label(), engine.resume_iteration+1, engine.step) )
+	return True
+
+def train_model(betavae, data_loader, optimizer, SAVE_PATH, path, nbr_epoch=100, offset=0, stacking=False, scale=1.0, kl_reduction='mean', log_interval=10, reconst_interval=100, traversal_interval=1, background_visualization=True, image_format='png', compress_level=6, save=True, keep_last=2, keep_best=1, checkpoint_interval=0, resume=False, scheduler=None, micro_batch=0, memory_budget=None, callbacks=None, sync_timings=False) :
+	# the training loop shared by all the scripts : logging, reconstructions and traversals of the fixed batch,
+	# and best-weights checkpointing, followed by the extra callbacks.
+	# The images are encoded in a background process unless background_visualization is False.
+	# micro_batch : number of images per forward/backward pass (0 : the whole batch, -1 : the largest one that fits
+	# in memory_budget bytes, probed on the model), the optimizer stepping once per batch.
+	# In a distributed training (see distributed.py), the model is wrapped in DistributedDataParallel, data_loader is the
+	# shard of the process, and only the process of rank 0 logs, saves the images and writes the checkpoints.
+	main = distributed.is_main_process()
+	if main :
+		for folder in ['gen_images', 'reconst_images'] :
+			os.makedirs( './beta-data/{}/{}/'.format(path, folder), exist_ok=True)
+
+	writer = None
+	if background_visualization and main :
+		try :
+			writer = VisualizationWriter(image_format=image_format, compress_level=compress_level)
+		except Exception as e :
+			print('EXCEPTION : VISUALIZATION : {} : the images are encoded on the training thread.'.format(e) )
+
+	if micro_batch < 0 :
+		micro_batch = probe_micro_batch(betavae, data_loader.batch_size, memory_budget=memory_budget)
+
+	standard = []
+	if main :
+		fixed_x = fixed_batch(betavae, data_loader, path, scale=scale, stacking=stacking)
+		standard = [ TraversalCallback(path, scale=scale, stacking=stacking, interval=traversal_interval, writer=writer),
+					ReconstructionCallback(fixed_x, path, interval=reconst_interval, scale=scale, stacking=stacking, writer=writer),
+					LoggingCallback(log_path=os.path.join(SAVE_PATH,'metrics.jsonl'), interval=log_interval) ]
+		if save :
+			standard.append( CheckpointCallback(SAVE_PATH, keep_last=keep_last, keep_best=keep_best, interval=checkpoint_interval) )
+
+	engine = Engine(betavae, optimizer, data_loader, nbr_epoch=nbr_epoch, offset=offset, kl_reduction=kl_reduction, callbacks=standard+list(callbacks or []), sync_timings=sync_timings, scheduler=scheduler, micro_batch=micro_batch if micro_batch > 0 else None, parallel_model=distributed.parallelize(betavae), preemption_interval=checkpoint_interval if checkpoint_interval > 0 else log_interval)
+	if resume :
+		resume_training(engine, SAVE_PATH)
+	try :
+		engine.run()
+	finally :
+		if writer is not None :
+			writer.close()
+	return engine
+
+
+if __name__ == '__main__' :
+	import argparse
+	parser = argparse.ArgumentParser(description='Training of any registered model on any registered dataset')
+	parser.add_argument('--model', type=str, default='betaVAEXYS2', choices=list(MODEL_SETTINGS.keys()))
+	parser.add_argument('--dataset', type=str, default='XYS', choices=list(DATASETS.keys()))
+	parser.add_argument('--stacked',action='store_true',default=False)
+	parser.add_argument('--epoch', type=int, default=100)
+	parser.add_argument('--offset', type=int, default=0)
+	parser.add_argument('--batch', type=int, default=32)
+	parser.add_argument('--lr', type=float, default=1e-4)
+	parser.add_argument('--beta', type=float, default=1.0)
+	parser.add_argument('--latent', type=int, default=None)
+	parser.add_argument('--conv_dim', type=int, default=None)
+	parser.add_argument('--net_depth', type=int, default=None)
+	parser.add_argument('--kl_reduction', type=str, default='mean', choices=['mean','sum'])
+	parser.add_argument('--log_interval', type=int, default=10)
+	parser.add_argument('--resume',action='store_true',default=False, help='resume the training from the latest full-state checkpoint')
+	parser.add_argument('--reconst_interval', type=int, default=100, help='number of steps between two reconstruction grids (0 disables them)')
+	parser.add_argument('--traversal_interval', type=int, default=1, help='number of epochs between two traversal grids (0 disables them)')
+	parser.add_argument('--image_format', type=str, default='png', choices=['png','bmp'])
+	parser.add_argument('--compress_level', type=int, default=6, help='zlib level of the png grids, from 0 (uncompressed) to 9')
+	parser.add_argument('--micro_batch', type=int, default=0, help='images per forward/backward pass, the gradients being accumulated over the batch (0 : whole batch, -1 : probed from --memory_budget)')
+	parser.add_argument('--memory_budget', type=float, default=0, help='memory budget of a training step for --micro_batch -1, in MiB (0 : detected)')
+	parser.add_argument('--sync_visualization',action='store_true',default=False, help='encode the grids on the training thread')
+	parser.add_argument('--checkpoint_interval', type=int, default=0, help='number of steps between two full-state checkpoints inside an epoch (0 : at the end of the epochs only)')
+	parser.add_argument('--sync_timings',action='store_true',default=False, help='synchronize the device at each phase boundary for exact per-phase timings')
+	parser.add_argument('--channels_last',action='store_true',default=False)
+	parser.add_argument('--compile',action='store_true',default=False)
+	parser.add_argument('--bf16',action='store_true',default=False)
+	parser.add_argument('--shared_dataset', type=str, default=None, help='train on the images published under this name by shared_dataset.py --serve')
+	args = parser.parse_args()
+	distributed.init_distributed()
+
+	setting = dict( (k,v) for k,v in [('z_dim',args.latent), ('conv_dim',args.conv_dim), ('net_depth',args.net_depth)] if v is not None )
+	use_cuda = torch.cuda.is_available()
+	betavae = build_model(args.model, beta=args.beta, use_cuda=use_cuda, **setting)
+	print(betavae)
+
+	if args.shared_dataset is not None :
+		dataset = attach_dataset(args.shared_dataset, expected=dict(dataset=args.dataset, img_dim=betavae.img_dim, stacking=args.stacked))
+	else :
+		dataset = load_dataset(args.dataset, img_dim=betavae.img_dim, stacking=args.stacked)
+	data_loader = make_data_loader(dataset, batch_size=args.batch)
+	optimizer = torch.optim.Adam( betavae.parameters(), lr=args.lr)
+
+	path = 'engine--{}--{}-img{}-lr{}-beta{}-z{}'.format(args.model, args.dataset, betavae.img_dim, args.lr, args.beta, betavae.z_dim)
+	if args.stacked :
+		path+= '-stacked'
+	SAVE_PATH = './beta-data/{}'.format(path)
+	os.makedirs(SAVE_PATH, exist_ok=True)
+	try :
+		betavae.load_state_dict( torch.load( os.path.join(SAVE_PATH,'weights')) )
+		print('NET LOADING : OK.')
+	except Exception as e :
+		print('EXCEPTION : NET LOADING : {}'.format(e) )
+	betavae = set_execution_mode(betavae, channels_last=args.channels_last, compile=args.compile, bf16=args.bf16)
+
+	scale = 255.0 if args.dataset == 'dSprite' else 1.0
+	engine = train_model(betavae, data_loader, optimizer, SAVE_PATH, path, nbr_epoch=args.epoch, offset=args.offset, stacking=args.stacked, scale=scale, kl_reduction=args.kl_reduction, log_interval=args.log_interval, checkpoint_interval=args.checkpoint_interval, resume=args.resume, reconst_interval=args.reconst_interval, traversal_interval=args.traversal_interval, background_visualization=not args.sync_visualization, image_format=args.image_format, compress_level=args.compress_level, micro_batch=args.micro_batch, memory_budget=args.memory_budget*2**20 if args.memory_budget > 0 else None, sync_timings=args.sync_timings)
+	print('TIMINGS : {}'.format(engine.timing_report()) )
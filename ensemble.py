@@ -0,0 +1,238 @@
+import copy
+import math
+import os
+import time
+
+import torch
+from torch.func import stack_module_state, functional_call, vmap
+
+from models import MODEL_SETTINGS, build_model
+from datasets import DATASETS, load_dataset, make_data_loader
+from engine import Engine, LoggingCallback, CheckpointCallback, vae_losses, resume_training
+
+
+def parse_values(text, cast=float) :
+	# comma-separated list of the command line, e.g. '1,10,100' :
+	return [ cast(v) for v in text.split(',') if v != '' ]
+
+def broadcast_settings(betas, lrs, seeds) :
+	# one (beta, lr, seed) per model, a single value being shared by all the models :
+	nbr_models = max( len(betas), len(lrs), len(seeds) )
+	for values in [betas, lrs, seeds] :
+		if len(values) not in [1, nbr_models] :
+			raise ValueError('the lists of betas, lrs and seeds must have the same length or a single value : {} / {} / {}'.format(betas, lrs, seeds) )
+	expand = lambda values : list(values) if len(values) == nbr_models else list(values)*nbr_models
+	return expand(betas), expand(lrs), expand(seeds)
+
+def substate(state, prefix) :
+	# the entries of a (stacked) state of the model that belong to one of its submodules :
+	return dict( (k[len(prefix):], v) for k, v in state.items() if k.startswith(prefix) )
+
+
+class StackedAdam(torch.optim.Optimizer) :
+	# Adam over parameters stacked along a leading model dimension, with one learning rate per model ([M] tensor lr) :
+	# each model gets the update of torch.optim.Adam with its own learning rate, in place. Adam being invariant to the
+	# scale of the gradients, the learning rates cannot be applied by scaling the gradients of the models.
+	def __init__(self, params, lr, betas=(0.9, 0.999), eps=1e-8) :
+		super(StackedAdam, self).__init__(params, dict(lr=lr, betas=betas, eps=eps) )
+
+	@torch.no_grad()
+	def step(self) :
+		for group in self.param_groups :
+			beta1, beta2 = group['betas']
+			for p in group['params'] :
+				if p.grad is None :
+					continue
+				state = self.state[p]
+				if len(state) == 0 :
+					state['step'] = 0
+					state['exp_avg'] = torch.zeros_like(p)
+					state['exp_avg_sq'] = torch.zeros_like(p)
+				state['step'] += 1
+				exp_avg, exp_avg_sq = state['exp_avg'], state['exp_avg_sq']
+				exp_avg.lerp_(p.grad, 1-beta1)
+				exp_avg_sq.mul_(beta2).addcmul_(p.grad, p.grad, value=1-beta2)
+				bias_correction1 = 1 - beta1**state['step']
+				bias_correction2 = 1 - beta2**state['step']
+				lr = torch.as_tensor(group['lr'], device=p.device).view( [-1]+[1]*(p.dim()-1) )
+				# p -= lr/bias_correction1 * exp_avg / (sqrt(exp_avg_sq/bias_correction2) + eps), the only temporary
+				# being the denominator of the current parameter :
+				denom = ( exp_avg_sq.sqrt() / math.sqrt(bias_correction2) ).add_(group['eps'])
+				denom.mul_( bias_correction1 / lr )
+				p.addcdiv_(exp_avg, denom, value=-1)
+
+
+class ModelEnsemble(object) :
+	# M copies of a model trained side by side on the same batches, each with its own beta, learning rate and
+	# initialization seed : their parameters and buffers are stacked along a leading model dimension and a single
+	# vmap-ed forward/backward pass runs all of them, the convolutions and linear layers becoming batched (grouped)
+	# kernels over the models, so that the data loading and the kernel launches are shared.
+	# Trained by an EnsembleEngine, for which it stands for the model.
+	def __init__(self, name, betas, lrs, seeds, use_cuda=False, kl_reduction='mean', **setting) :
+		self.name = name
+		self.betas, self.lrs, self.seeds = broadcast_settings(betas, lrs, seeds)
+		self.nbr_models = len(self.betas)
+		self.kl_reduction = kl_reduction
+
+		models = []
+		for beta, seed in zip(self.betas, self.seeds) :
+			torch.manual_seed(seed)
+			models.append( build_model(name, beta=beta, use_cuda=use_cuda, **setting) )
+		self.params, self.buffers = stack_module_state(models)
+		# stateless skeleton of the architecture, whose tensors are supplied by functional_call :
+		self.model = copy.deepcopy(models[0]).to('meta')
+		self.model.train()
+		# the attributes of the model used by the training loop (see engine.batch_images) :
+		self.img_dim, self.img_depth, self.z_dim, self.use_cuda = self.model.img_dim, self.model.img_depth, self.model.z_dim, use_cuda
+
+		self.device = next(iter(self.params.values())).device
+		self.beta = torch.tensor(self.betas, device=self.device)
+		self.lr = torch.tensor(self.lrs, device=self.device)
+		self.optimizer = StackedAdam( self.parameters(), lr=self.lr)
+
+	def run_name(self, index) :
+		return 'beta{}-lr{}-seed{}'.format(self.betas[index], self.lrs[index], self.seeds[index])
+
+	def parameters(self) :
+		return iter(self.params.values())
+
+	def train(self, mode=True) :
+		# the skeleton only holds the mode of the layers (e.g. batch normalization) :
+		self.model.train(mode)
+		return self
+
+	def losses(self, params, buffers, beta, images) :
+		# training losses of a single model (vmap-ed over the models). The reparameterization noise is drawn here rather
+		# than by the reparameterize method of the model, so that each model gets its own noise under vmap :
+		h = functional_call(self.model.encoder, ( substate(params,'encoder.'), substate(buffers,'encoder.') ), (images,) )
+		mu, log_var = torch.chunk(h.float(), 2, dim=1 )
+		z = mu + torch.randn_like(mu) * torch.exp( log_var/2 )
+		out = functional_call(self.model.decoder, ( substate(params,'decoder.'), substate(buffers,'decoder.') ), (z,) )
+		losses = vae_losses(self.model, out.float(), images, mu, log_var, self.kl_reduction, beta=beta)
+		# batch means of the posterior statistics, as in Engine.train_step :
+		losses['mu_mean'] = mu.sum(dim=0) / images.size(0)
+		losses['sigma_mean'] = torch.exp( log_var/2 ).sum(dim=0) / images.size(0)
+		return losses
+
+	def forward(self, images) :
+		# dict of the [M, ...] losses of the models, the batch being shared by the models :
+		return vmap(self.losses, in_dims=(0,0,0,None), randomness='different')(self.params, self.buffers, self.beta, images)
+
+	def state_dict(self) :
+		# the stacked parameters and buffers of all the models, for the full-state checkpoints :
+		return dict(self.params, **self.buffers)
+
+	def load_state_dict(self, state_dict) :
+		state = self.state_dict()
+		with torch.no_grad() :
+			for k, v in state_dict.items() :
+				state[k].copy_(v)
+
+	def model_state_dict(self, index) :
+		# the state_dict of the index-th model, loadable into build_model(name, ...) :
+		# the slices are cloned, torch.save would otherwise write the storage of every model.
+		return dict( (k, v[index].detach().clone()) for k, v in self.state_dict().items() )
+
+	def load_model_state_dict(self, index, state_dict) :
+		state = self.state_dict()
+		with torch.no_grad() :
+			for k, v in state_dict.items() :
+				state[k][index].copy_(v)
+
+
+class EnsembleEngine(Engine) :
+	# Engine of a ModelEnsemble : the metrics and the statistics of the epochs have a leading model dimension,
+	# e.g. the epoch loss is a [M] tensor and the posterior statistics [M, z_dim] ones.
+	def reset_epoch_stats(self) :
+		self.epoch_loss = torch.zeros( (self.model.nbr_models), device=self.device)
+		self.mu_sum = torch.zeros( (self.model.nbr_models, self.model.z_dim), device=self.device)
+		self.sigma_sum = torch.zeros( (self.model.nbr_models, self.model.z_dim), device=self.device)
+		self.nbr_steps = 0
+
+	def train_step(self, images) :
+		start = time.perf_counter()
+		losses = self.model.forward(images)
+		start = self.tick('forward', start)
+
+		self.optimizer.zero_grad(set_to_none=True)
+		# the models are independent, the gradient of the sum is the gradient of each loss w.r.t. its own parameters :
+		losses['total_loss'].sum().backward()
+		start = self.tick('backward', start)
+
+		self.optimizer.step()
+		self.tick('optimizer', start)
+
+		metrics = dict( (k, v.detach()) for k, v in losses.items() )
+		metrics['batch_size'] = images.size(0)
+		return metrics
+
+
+class EnsembleCheckpointCallback(CheckpointCallback) :
+	# full training state of the ensemble written as by CheckpointCallback (ranked by the sum of the epoch losses),
+	# the weights of each model being published as SAVE_PATH/<run name>/weights at its own lowest-loss epoch :
+	def on_epoch_end(self, engine) :
+		ensemble = engine.model
+		epoch_loss = engine.epoch_loss.tolist()
+		if engine.best_loss is None :
+			engine.best_loss = [None]*ensemble.nbr_models
+		for index, loss in enumerate(epoch_loss) :
+			if engine.best_loss[index] is None or loss < engine.best_loss[index] :
+				engine.best_loss[index] = loss
+				self.writer.publish( ensemble.model_state_dict(index), os.path.join(self.SAVE_PATH, ensemble.run_name(index), 'weights') )
+		self.writer.save( engine.state_dict(engine.epoch+1, 0), self.label(engine), loss=sum(epoch_loss) )
+
+
+def train_ensemble(ensemble, data_loader, SAVE_PATH, nbr_epoch=100, log_interval=10, keep_last=2, checkpoint_interval=0, resume=False, callbacks=None, sync_timings=False) :
+	# trains the models of the ensemble on the same batches, with the logging and checkpointing of engine.train_model :
+	# the metrics are logged to SAVE_PATH/metrics.jsonl as lists over the models, and the training can be resumed
+	# from the full-state checkpoints of SAVE_PATH/checkpoints.
+	for index in range(ensemble.nbr_models) :
+		os.makedirs( os.path.join(SAVE_PATH, ensemble.run_name(index)), exist_ok=True)
+	standard = [ LoggingCallback(log_path=os.path.join(SAVE_PATH,'metrics.jsonl'), interval=log_interval),
+				EnsembleCheckpointCallback(SAVE_PATH, keep_last=keep_last, keep_best=1, interval=checkpoint_interval) ]
+	engine = EnsembleEngine(ensemble, ensemble.optimizer, data_loader, nbr_epoch=nbr_epoch, kl_reduction=ensemble.kl_reduction, callbacks=standard+list(callbacks or []), sync_timings=sync_timings)
+	if resume :
+		resume_training(engine, SAVE_PATH)
+	engine.run()
+	return engine
+
+
+if __name__ == '__main__' :
+	import argparse
+	parser = argparse.ArgumentParser(description='Training of several copies of a model with different beta, lr and seed, in a single vmap-ed pass over the same batches')
+	parser.add_argument('--model', type=str, default='betaVAEXYS2', choices=list(MODEL_SETTINGS.keys()))
+	parser.add_argument('--dataset', type=str, default='XYS', choices=list(DATASETS.keys()))
+	parser.add_argument('--stacked',action='store_true',default=False)
+	parser.add_argument('--betas', type=str, default='1,10,100', help='comma-separated betas, one per model')
+	parser.add_argument('--lrs', type=str, default='1e-4', help='comma-separated learning rates, one per model or a single shared one')
+	parser.add_argument('--seeds', type=str, default='0', help='comma-separated initialization seeds, one per model or a single shared one')
+	parser.add_argument('--epoch', type=int, default=100)
+	parser.add_argument('--batch', type=int, default=32)
+	parser.add_argument('--latent', type=int, default=None)
+	parser.add_argument('--conv_dim', type=int, default=None)
+	parser.add_argument('--net_depth', type=int, default=None)
+	parser.add_argument('--kl_reduction', type=str, default='mean', choices=['mean','sum'])
+	parser.add_argument('--log_interval', type=int, default=10)
+	parser.add_argument('--checkpoint_interval', type=int, default=0, help='number of steps between two full-state checkpoints inside an epoch (0 : at the end of the epochs only)')
+	parser.add_argument('--resume',action='store_true',default=False, help='resume the training from the latest full-state checkpoint')
+	args = parser.parse_args()
+
+	setting = dict( (k,v) for k,v in [('z_dim',args.latent), ('conv_dim',args.conv_dim), ('net_depth',args.net_depth)] if v is not None )
+	use_cuda = torch.cuda.is_available()
+	ensemble = ModelEnsemble(args.model, parse_values(args.betas), parse_values(args.lrs), parse_values(args.seeds, int), use_cuda=use_cuda, kl_reduction=args.kl_reduction, **setting)
+
+	path = 'ensemble--{}--{}-img{}-z{}'.format(args.model, args.dataset, ensemble.model.img_dim, ensemble.model.z_dim)
+	if args.stacked :
+		path+= '-stacked'
+	SAVE_PATH = './beta-data/{}'.format(path)
+	for index in range(ensemble.nbr_models) :
+		try :
+			ensemble.load_model_state_dict(index, torch.load( os.path.join(SAVE_PATH, ensemble.run_name(index), 'weights'), map_location=ensemble.device) )
+			print('NET LOADING : {} : OK.'.format(ensemble.run_name(index)) )
+		except Exception as e :
+			print('EXCEPTION : NET LOADING : {} : {}'.format(ensemble.run_name(index), e) )
+
+	dataset = load_dataset(args.dataset, img_dim=ensemble.model.img_dim, stacking=args.stacked)
+	data_loader = make_data_loader(dataset, batch_size=args.batch)
+	engine = train_ensemble(ensemble, data_loader, SAVE_PATH, nbr_epoch=args.epoch, log_interval=args.log_interval, checkpoint_interval=args.checkpoint_interval, resume=args.resume)
+	print('BEST LOSSES : {}'.format( dict( (ensemble.run_name(m), l) for m, l in enumerate(engine.best_loss or []) ) ) )
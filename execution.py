@@ -0,0 +1,129 @@
+import copy
+import types
+from contextlib import nullcontext
+
+import torch
+import torch.nn as nn
+
+
+def channels_last(x) :
+	# only 4D activations have a channels_last layout :
+	if x.dim() == 4 :
+		return x.contiguous(memory_format=torch.channels_last)
+	return x
+
+def format_input(model, x) :
+	# convert the inputs to the memory format expected by the model :
+	if getattr(model, 'channels_last', False) :
+		return channels_last(x)
+	return x
+
+def compilation_errors() :
+	# errors of the graph capture and of the compiler backends, after which the eager method is used instead :
+	# any other exception (shapes, dtypes, out of memory) is raised as in eager mode.
+	try :
+		from torch._dynamo import exc
+	except ImportError :
+		return ()
+	return tuple( getattr(exc, name) for name in ['BackendCompilerFailed', 'Unsupported', 'InternalTorchDynamoError'] if hasattr(exc, name) )
+
+class CompiledMethod(object) :
+	# torch.compile of the method module.name, stored on the module instance so that the state_dict keys are left untouched.
+	# A deep copy of the module (freeze, quantization, distillation, low-rank compression) gets its own CompiledMethod,
+	# bound to the copy : the copy never runs the weights of the original module.
+	def __init__(self, module, name, mode=None) :
+		self.module = module
+		self.name = name
+		self.mode = mode
+		# the method of the class, the instance attribute being this object :
+		self.eager = types.MethodType( getattr(type(module), name), module)
+		self.compiled = torch.compile(self.eager, mode=mode)
+
+	def __call__(self, *args, **kwargs) :
+		try :
+			return self.compiled(*args, **kwargs)
+		except compilation_errors() as e :
+			# compilation happens lazily on the first call(s), fall back to eager mode for good :
+			print('EXCEPTION : COMPILATION : {}.{} : {} : falling back to eager mode.'.format(self.module.__class__.__name__,self.name,e) )
+			delattr(self.module, self.name)
+			return self.eager(*args, **kwargs)
+
+	def __deepcopy__(self, memo) :
+		# the copy of the module is already in memo when its attributes are copied :
+		return CompiledMethod( copy.deepcopy(self.module, memo), self.name, self.mode)
+
+def compile_method(module, name, mode=None) :
+	# compile the method module.name in place, see CompiledMethod :
+	if not hasattr(torch, 'compile') :
+		print('EXCEPTION : COMPILATION : torch.compile is not available, running {}.{} eagerly.'.format(module.__class__.__name__,name) )
+		return False
+
+	try :
+		setattr(module, name, CompiledMethod(module, name, mode=mode) )
+	except Exception as e :
+		print('EXCEPTION : COMPILATION : {}'.format(e) )
+		return False
+	return True
+
+def autocast(model, device_type='cpu') :
+	# bfloat16 autocast of the forward pass (and thus of its backward), if enabled on the model :
+	if not getattr(model, 'bf16', False) :
+		return nullcontext()
+	return torch.autocast(device_type=device_type, dtype=torch.bfloat16)
+
+def to_float(*tensors) :
+	# the losses, the KL term and the statistics are always computed in float32 :
+	return tuple( t.float() for t in tensors )
+
+def set_checkpointing(model, encoder_segments=0, decoder_segments=0) :
+	# activation checkpointing of the encoder cvs and decoder dcs stacks,
+	# with the number of recomputed chunks configured per stage (0 disables it) :
+	for name, segments in [('encoder', encoder_segments), ('decoder', decoder_segments)] :
+		module = getattr(model, name)
+		if not hasattr(module, 'checkpoint_segments') :
+			if segments :
+				print('EXCEPTION : CHECKPOINTING : {} has no convolution stack to checkpoint.'.format(module.__class__.__name__) )
+			continue
+		module.checkpoint_segments = segments
+	return model
+
+def set_sparse_input(model, threshold=0.0) :
+	# sparse input path of the first encoder layer, taken when the density of the first batch is below threshold (0 disables it) :
+	# the sparse matmul reads the dense float weight of a plain nn.Linear : a low-rank or a quantized first layer has none.
+	if not hasattr(model.encoder, 'sparse_threshold') or type(getattr(model.encoder, 'fc', None)) is not nn.Linear :
+		if threshold :
+			print('EXCEPTION : SPARSE INPUT : {} has no sparse input path.'.format(model.encoder.__class__.__name__) )
+		return model
+	model.encoder.sparse_threshold = threshold
+	# decided again on the next batch :
+	model.encoder.sparse_path = None
+	return model
+
+def set_execution_mode(model, channels_last=False, compile=False, compile_mode=None, bf16=False, checkpoint_encoder=0, checkpoint_decoder=0, sparse_threshold=0.0) :
+	# Opt-in CPU execution mode :
+	# - channels_last : NHWC weights and activations, which lets oneDNN pick its blocked conv kernels
+	#   and fuse the conv/bn/leaky_relu sequences without reordering,
+	# - compile : torch.compile of the encoder and decoder,
+	# - bf16 : mixed precision, the encoder/decoder run under bfloat16 autocast while the parameters,
+	#   and therefore the optimizer state, remain in float32,
+	# - checkpoint_encoder/checkpoint_decoder : activation checkpointing of each stage, see set_checkpointing.
+	# - sparse_threshold : sparse input path of the first layer of EncoderdSprite, see set_sparse_input.
+	model.channels_last = channels_last
+	model.compiled = False
+	model.bf16 = bf16
+	if bf16 and not hasattr(torch, 'autocast') :
+		print('EXCEPTION : BF16 : torch.autocast is not available, running in float32.')
+		model.bf16 = False
+
+	set_checkpointing(model, encoder_segments=checkpoint_encoder, decoder_segments=checkpoint_decoder)
+	set_sparse_input(model, threshold=sparse_threshold)
+
+	if channels_last :
+		model = model.to(memory_format=torch.channels_last)
+
+	if compile :
+		compiled_encoder = compile_method(model.encoder, 'encode', mode=compile_mode)
+		compiled_decoder = compile_method(model.decoder, 'decode', mode=compile_mode)
+		model.compiled = compiled_encoder and compiled_decoder
+
+	return model
@@ -0,0 +1,210 @@
+import copy
+import os
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from models import EncoderXYS3, MODEL_SETTINGS, build_model
+
+
+# Linear layers followed by a BatchNorm1d in the forward pass of some encoders :
+LINEAR_BN_PAIRS = {
+	EncoderXYS3 : [('fc1','bn1'), ('fc2','bn2')],
+}
+
+def batchnorm_scale(bn) :
+	# eval-mode BN(x) = scale*x + shift :
+	scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+	shift = bn.bias - bn.running_mean*scale
+	return scale, shift
+
+def fold_batchnorm_into(layer, bn) :
+	# fold bn into the weights and bias of the preceding Conv2d, ConvTranspose2d or Linear layer :
+	with torch.no_grad() :
+		scale, shift = batchnorm_scale(bn)
+		weight = layer.weight
+		if isinstance(layer, nn.ConvTranspose2d) :
+			# weight : (in, out/groups, k, k), the output channels are on dim 1 within each group :
+			groups = layer.groups
+			w = weight.view( groups, weight.size(0)//groups, weight.size(1), *weight.shape[2:] )
+			w.mul_( scale.view( groups, 1, weight.size(1), *([1]*(weight.dim()-2)) ) )
+		else :
+			# Conv2d weight : (out, in/groups, k, k), Linear weight : (out, in) :
+			weight.mul_( scale.view( -1, *([1]*(weight.dim()-1)) ) )
+
+		if layer.bias is None :
+			layer.bias = nn.Parameter( torch.zeros_like(shift) )
+		layer.bias.mul_(scale).add_(shift)
+
+def fold_batchnorm(model) :
+	# in place : the BatchNorm2d of every block emitted by the conv()/deconv() helpers is folded
+	# into the last conv layer of the block, and every Linear+BatchNorm1d pair a single Linear layer.
+	nbr_folded = 0
+	for module in list(model.modules()) :
+		# [conv, BN] or, for the separable blocks, [depthwise/pointwise conv, pointwise/depthwise conv, BN] :
+		if isinstance(module, nn.Sequential) and len(module) in [2,3] \
+			and isinstance(module[-2], (nn.Conv2d, nn.ConvTranspose2d)) and isinstance(module[-1], nn.BatchNorm2d) :
+			fold_batchnorm_into(module[-2], module[-1])
+			del module[-1]
+			nbr_folded += 1
+
+		for layer_name, bn_name in LINEAR_BN_PAIRS.get(type(module), []) :
+			bn = getattr(module, bn_name)
+			if isinstance(bn, nn.BatchNorm1d) :
+				fold_batchnorm_into( getattr(module, layer_name), bn)
+				setattr(module, bn_name, nn.Identity() )
+				nbr_folded += 1
+
+	return nbr_folded
+
+def freeze(model) :
+	# returns an eval-only copy of the model with every BatchNorm folded into its preceding layer :
+	model = copy.deepcopy(model).eval()
+	nbr_folded = fold_batchnorm(model)
+	for p in model.parameters() :
+		p.requires_grad = False
+	# plain attribute, kept by torch.save and copy.deepcopy : the training loop refuses frozen models (see engine.Engine).
+	model.frozen = True
+
+	print('FREEZE : {} BatchNorm layers folded.'.format(nbr_folded) )
+	return model
+
+def check_freeze(model, frozen, x, tolerance=1e-4) :
+	# the frozen model must match the original one in eval mode, on both the encoder and the decoder :
+	model.eval()
+	with torch.no_grad() :
+		h = model.encoder(x)
+		fh = frozen.encoder(x)
+		mu, _ = torch.chunk(h, 2, dim=1 )
+		out = model.decoder(mu)
+		fout = frozen.decoder(mu)
+
+	# errors relative to the magnitude of the outputs :
+	encoder_error = ( (fh-h).abs().max() / h.abs().max().clamp(min=1.0) ).item()
+	decoder_error = (fout-out).abs().max().item()
+	ok = encoder_error <= tolerance and decoder_error <= tolerance
+	print('FREEZE CHECK : {} :: max relative encoder error = {:.2e} // max decoder error = {:.2e} (tolerance {})'.format('OK' if ok else 'FAILED', encoder_error, decoder_error, tolerance) )
+	return ok
+
+
+class EncoderGraph(nn.Module) :
+	# image -> (mu, log_var)
+	def __init__(self, model) :
+		super(EncoderGraph,self).__init__()
+		self.encoder = model.encoder
+
+	def forward(self,x) :
+		h = self.encoder(x)
+		mu, log_var = torch.chunk(h, 2, dim=1 )
+		return mu, log_var
+
+class DecoderGraph(nn.Module) :
+	# z -> image
+	def __init__(self, model) :
+		super(DecoderGraph,self).__init__()
+		self.decoder = model.decoder
+
+	def forward(self,z) :
+		return self.decoder(z)
+
+def onnx_paths(output_dir, name) :
+	return os.path.join(output_dir, '{}-encoder.onnx'.format(name)), os.path.join(output_dir, '{}-decoder.onnx'.format(name))
+
+def export_onnx(model, output_dir, name, opset_version=17) :
+	# separate encoder and decoder graphs, with a dynamic batch dimension :
+	model = model.cpu().eval()
+	if not os.path.exists(output_dir) :
+		os.makedirs(output_dir)
+	encoder_path, decoder_path = onnx_paths(output_dir, name)
+
+	x = torch.rand( (2, model.img_depth, model.img_dim, model.img_dim) )
+	z = torch.randn( (2, model.z_dim) )
+	with torch.no_grad() :
+		torch.onnx.export( EncoderGraph(model), x, encoder_path,
+			input_names=['image'], output_names=['mu', 'log_var'],
+			dynamic_axes={'image':{0:'batch'}, 'mu':{0:'batch'}, 'log_var':{0:'batch'}},
+			opset_version=opset_version)
+		torch.onnx.export( DecoderGraph(model), z, decoder_path,
+			input_names=['z'], output_names=['image'],
+			dynamic_axes={'z':{0:'batch'}, 'image':{0:'batch'}},
+			opset_version=opset_version)
+
+	print('ONNX EXPORT : encoder saved at : {} // decoder saved at : {}'.format(encoder_path, decoder_path) )
+	return encoder_path, decoder_path
+
+class ONNXModel(object) :
+	# ONNX Runtime CPU inference backend for the exported encoder and decoder graphs :
+	def __init__(self, encoder_path, decoder_path, intra_op_threads=0, inter_op_threads=0, parallel=False) :
+		import onnxruntime as ort
+
+		options = ort.SessionOptions()
+		# 0 lets ONNX Runtime pick the number of threads :
+		options.intra_op_num_threads = intra_op_threads
+		options.inter_op_num_threads = inter_op_threads
+		options.execution_mode = ort.ExecutionMode.ORT_PARALLEL if parallel else ort.ExecutionMode.ORT_SEQUENTIAL
+		options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+		providers = ['CPUExecutionProvider']
+		self.encoder = ort.InferenceSession(encoder_path, sess_options=options, providers=providers)
+		self.decoder = ort.InferenceSession(decoder_path, sess_options=options, providers=providers)
+
+	def encode(self, x) :
+		x = np.ascontiguousarray(x, dtype=np.float32)
+		mu, log_var = self.encoder.run( ['mu', 'log_var'], {'image':x} )
+		return mu, log_var
+
+	def decode(self, z) :
+		z = np.ascontiguousarray(z, dtype=np.float32)
+		return self.decoder.run( ['image'], {'z':z} )[0]
+
+	def __call__(self, x) :
+		# deterministic reconstruction from mu :
+		mu, log_var = self.encode(x)
+		return self.decode(mu), mu, log_var
+
+def test_onnx_parity(model, onnx_model, x, tolerance=1e-4) :
+	# the ONNX Runtime outputs must match the PyTorch ones :
+	model = model.cpu().eval()
+	with torch.no_grad() :
+		mu, log_var = EncoderGraph(model)(x)
+		out = model.decoder(mu)
+	omu, olog_var = onnx_model.encode(x.numpy())
+	oout = onnx_model.decode(mu.numpy())
+
+	errors = dict( mu=np.abs(omu-mu.numpy()).max(), log_var=np.abs(olog_var-log_var.numpy()).max(), image=np.abs(oout-out.numpy()).max() )
+	scale = max( 1.0, np.abs(mu.numpy()).max(), np.abs(log_var.numpy()).max() )
+	ok = errors['mu'] <= tolerance*scale and errors['log_var'] <= tolerance*scale and errors['image'] <= tolerance
+	print('ONNX PARITY : {} :: max errors : mu {mu:.2e} // log_var {log_var:.2e} // image {image:.2e}'.format('OK' if ok else 'FAILED', **errors) )
+	return ok
+
+
+if __name__ == '__main__' :
+	import argparse
+	parser = argparse.ArgumentParser(description='ONNX export of the encoder and decoder')
+	parser.add_argument('--model', type=str, default='betaVAEXYS2', choices=list(MODEL_SETTINGS.keys()))
+	parser.add_argument('--weights', type=str, default=None, help='path to the weights saved by the training loop')
+	parser.add_argument('--output', type=str, default='./onnx')
+	parser.add_argument('--latent', type=int, default=None)
+	parser.add_argument('--img_dim', type=int, default=None)
+	parser.add_argument('--img_depth', type=int, default=None)
+	parser.add_argument('--conv_dim', type=int, default=None)
+	parser.add_argument('--net_depth', type=int, default=None)
+	parser.add_argument('--freeze', action='store_true', default=False, help='fold the BatchNorm layers before the export')
+	parser.add_argument('--threads', type=int, default=0, help='intra-op threads of ONNX Runtime (0 : picked by ONNX Runtime)')
+	parser.add_argument('--inter_op_threads', type=int, default=0, help='inter-op threads of ONNX Runtime, used with --parallel (0 : picked by ONNX Runtime)')
+	parser.add_argument('--parallel',action='store_true',default=False, help='run the independent nodes of the graphs concurrently (ORT_PARALLEL)')
+	args = parser.parse_args()
+
+	setting = dict( (k,v) for k,v in [('z_dim',args.latent), ('img_dim',args.img_dim), ('img_depth',args.img_depth), ('conv_dim',args.conv_dim), ('net_depth',args.net_depth)] if v is not None )
+	model = build_model(args.model, **setting)
+	if args.weights is not None :
+		model.load_state_dict( torch.load(args.weights, map_location='cpu') )
+	model.eval()
+	if args.freeze :
+		model = freeze(model)
+
+	encoder_path, decoder_path = export_onnx(model, args.output, args.model)
+	onnx_model = ONNXModel(encoder_path, decoder_path, intra_op_threads=args.threads, inter_op_threads=args.inter_op_threads, parallel=args.parallel)
+	test_onnx_parity(model, onnx_model, torch.rand( (4, model.img_depth, model.img_dim, model.img_dim) ) )
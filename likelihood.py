@@ -0,0 +1,115 @@
+import math
+
+import torch
+import torch.nn.functional as F
+
+from models import MODEL_SETTINGS, build_model
+from execution import format_input
+from quantization import calibration_batches
+from profiler import profile_layers
+from datasets import load_dataset, DSPRITES_ROOT
+
+
+LOG_2PI = math.log(2.0*math.pi)
+
+def bernoulli_log_likelihood(out, x) :
+	# log p(x|z) of each sample, with the same (clamped) binary cross entropy as the training loss :
+	out = out.view(out.size(0), -1)
+	x = x.view(x.size(0), -1)
+	return -F.binary_cross_entropy(out, x, reduction='none').sum(dim=1)
+
+def gaussian_log_prob(z, mu=None, log_var=None) :
+	# log N(z; mu, exp(log_var)) of each sample, log N(z; 0, I) by default :
+	if mu is None :
+		return -0.5*( z**2 + LOG_2PI ).sum(dim=-1)
+	return -0.5*( (z-mu)**2/torch.exp(log_var) + log_var + LOG_2PI ).sum(dim=-1)
+
+def decoder_sample_bytes(model) :
+	# activation bytes of the decoder for a single latent sample :
+	device = next(model.parameters()).device
+	z = torch.zeros( (1, model.z_dim), device=device)
+	return sum( r['activation_bytes'] for r in profile_layers(model.decoder, z) )
+
+def chunk_size_for(model, memory_budget) :
+	# number of latent samples decoded per call so that the decoder activations fit in memory_budget bytes :
+	return max(1, int(memory_budget // max(1, decoder_sample_bytes(model))) )
+
+def iwae_bound(model, x, K=50, chunk_size=None) :
+	# K-sample importance-weighted bound of log p(x) for each image of the batch x, and the 1-sample ELBO estimate :
+	# the [K*B] latent samples are drawn at once and decoded chunk_size samples at a time.
+	batch_size = x.size(0)
+	with torch.no_grad() :
+		mu, log_var = torch.chunk( model.encoder(x).float(), 2, dim=1 )
+		# layout : sample k of image b is at k*B+b
+		eps = torch.randn( (K, batch_size, mu.size(1)), device=mu.device)
+		z = ( mu.unsqueeze(0) + eps*torch.exp(log_var/2).unsqueeze(0) ).view(K*batch_size, -1)
+		log_qz = gaussian_log_prob(z.view(K, batch_size, -1), mu.unsqueeze(0), log_var.unsqueeze(0) ).view(-1)
+		log_pz = gaussian_log_prob(z)
+
+		if chunk_size is None :
+			chunk_size = K*batch_size
+		log_px = []
+		for start in range(0, K*batch_size, chunk_size) :
+			z_chunk = z[start:start+chunk_size]
+			images = x[ torch.arange(start, start+z_chunk.size(0), device=x.device) % batch_size ]
+			log_px.append( bernoulli_log_likelihood( model.decoder(z_chunk).float(), images.float() ) )
+		log_px = torch.cat(log_px, dim=0)
+
+		log_w = (log_px + log_pz - log_qz).view(K, batch_size)
+		bound = torch.logsumexp(log_w, dim=0) - math.log(K)
+		elbo = log_w.mean(dim=0)
+	return bound, elbo
+
+def evaluate_iwae(model, data_loader, K=50, memory_budget=256*2**20, nbr_batches=None) :
+	# streams over the data loader and returns the mean K-sample bound and ELBO per image, in nats :
+	model.eval()
+	device = next(model.parameters()).device
+	chunk_size = chunk_size_for(model, memory_budget)
+	if nbr_batches is None :
+		nbr_batches = len(data_loader)
+	print('IWAE : K = {} samples per image, decoded {} at a time.'.format(K, chunk_size) )
+
+	# accumulated on the device, without a host synchronization per batch :
+	bound_sum = torch.zeros( (), device=device, dtype=torch.float64)
+	elbo_sum = torch.zeros( (), device=device, dtype=torch.float64)
+	nbr_images = 0
+	for x in calibration_batches(data_loader, nbr_batches=nbr_batches) :
+		x = x.view(-1, model.img_depth, model.img_dim, model.img_dim).to(device)
+		x = format_input(model, x)
+		bound, elbo = iwae_bound(model, x, K=K, chunk_size=chunk_size)
+		bound_sum += bound.double().sum()
+		elbo_sum += elbo.double().sum()
+		nbr_images += x.size(0)
+
+	report = dict( K=K, nbr_images=nbr_images, iwae=bound_sum.item()/nbr_images, elbo=elbo_sum.item()/nbr_images )
+	print('IWAE : {nbr_images} images :: log p(x) >= IWAE-{K} bound {iwae:.3f} nats // ELBO {elbo:.3f} nats'.format(**report) )
+	return report
+
+
+if __name__ == '__main__' :
+	import argparse
+	parser = argparse.ArgumentParser(description='K-sample importance-weighted bound of log p(x) over a dataset')
+	parser.add_argument('--model', type=str, default='betaVAEdSprite', choices=list(MODEL_SETTINGS.keys()))
+	parser.add_argument('--weights', type=str, required=True, help='path to the weights saved by the training loop')
+	parser.add_argument('--dataset', type=str, default='dSprite', choices=['dSprite','XYS'])
+	parser.add_argument('--root', type=str, default=DSPRITES_ROOT, help='dSprites archive')
+	parser.add_argument('--stacked',action='store_true',default=False)
+	parser.add_argument('--latent', type=int, default=None)
+	parser.add_argument('--conv_dim', type=int, default=None)
+	parser.add_argument('--net_depth', type=int, default=None)
+	parser.add_argument('--K', type=int, default=50)
+	parser.add_argument('--batch', type=int, default=64)
+	parser.add_argument('--budget', type=float, default=256, help='memory budget of the decoder activations, in MiB')
+	parser.add_argument('--nbr_batches', type=int, default=None)
+	args = parser.parse_args()
+
+	setting = dict( (k,v) for k,v in [('z_dim',args.latent), ('conv_dim',args.conv_dim), ('net_depth',args.net_depth)] if v is not None )
+	use_cuda = torch.cuda.is_available()
+	model = build_model(args.model, use_cuda=use_cuda, **setting)
+	model.load_state_dict( torch.load(args.weights, map_location='cuda' if use_cuda else 'cpu') )
+
+	# preprocessed as in training :
+	dataset = load_dataset(args.dataset, img_dim=model.img_dim, stacking=args.stacked, root=args.root)
+	data_loader = torch.utils.data.DataLoader(dataset=dataset, batch_size=args.batch, shuffle=False)
+
+	evaluate_iwae(model, data_loader, K=args.K, memory_budget=args.budget*2**20, nbr_batches=args.nbr_batches)
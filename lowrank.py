@@ -0,0 +1,61 @@
+import copy
+
+import torch
+import torch.nn as nn
+
+from models import LowRankLinear, betaVAEdSprite
+
+
+def svd_factorize(layer, rank) :
+	# best rank-r approximation of the weight of a Linear layer, W ~ (U.sqrt(S)) . (sqrt(S).Vh),
+	# and the fraction of the squared singular values (energy) it retains :
+	with torch.no_grad() :
+		U, S, Vh = torch.linalg.svd(layer.weight.float(), full_matrices=False)
+		root = torch.sqrt(S[:rank])
+		factorized = LowRankLinear( layer.in_features, layer.out_features, rank, bias=layer.bias is not None)
+		factorized.v.weight.copy_( root.unsqueeze(1)*Vh[:rank] )
+		factorized.u.weight.copy_( U[:,:rank]*root.unsqueeze(0) )
+		if layer.bias is not None :
+			factorized.u.bias.copy_(layer.bias)
+		energy = ( (S[:rank]**2).sum() / (S**2).sum() ).item()
+	return factorized.to(layer.weight.device), energy
+
+def compress_low_rank(model, rank) :
+	# returns a copy of a trained model whose low_rank_layers are replaced by their rank-r SVD factorizations :
+	# its state_dict can then be loaded into a model built with the same rank, e.g. betaVAEdSprite(rank=rank).
+	model = copy.deepcopy(model)
+	energies = {}
+	for name, module in model.named_modules() :
+		for layer_name in getattr(module, 'low_rank_layers', []) :
+			layer = getattr(module, layer_name)
+			if not isinstance(layer, nn.Linear) :
+				continue
+			if rank*(layer.in_features+layer.out_features) >= layer.in_features*layer.out_features :
+				continue
+			factorized, energy = svd_factorize(layer, rank)
+			setattr(module, layer_name, factorized)
+			energies['{}.{}'.format(name, layer_name)] = energy
+	model.rank = rank
+
+	print('LOW RANK : rank {} : retained energy : {}'.format(rank, ' // '.join( '{} {:.4f}'.format(k,v) for k,v in energies.items() ) ) )
+	return model, energies
+
+
+if __name__ == '__main__' :
+	import argparse
+	parser = argparse.ArgumentParser(description='SVD compression of a trained betaVAEdSprite into low-rank layers')
+	parser.add_argument('--weights', type=str, required=True, help='path to the dense weights saved by the training loop')
+	parser.add_argument('--rank', type=int, required=True)
+	parser.add_argument('--output', type=str, default=None)
+	parser.add_argument('--latent', type=int, default=10)
+	args = parser.parse_args()
+
+	model = betaVAEdSprite(z_dim=args.latent, img_dim=64, img_depth=1, use_cuda=False)
+	model.load_state_dict( torch.load(args.weights, map_location='cpu') )
+	compressed, _ = compress_low_rank(model, args.rank)
+
+	output = args.output
+	if output is None :
+		output = '{}-rank{}'.format(args.weights, args.rank)
+	torch.save( compressed.state_dict(), output)
+	print('Low-rank model saved at : {}'.format(output) )
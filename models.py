@@ -2,6 +2,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.autograd import Variable
+from torch.utils.checkpoint import checkpoint
 
 import numpy as np
 
@@ -29,20 +30,94 @@ class Bernoulli(Distribution) :
 
 		#return -F.binary_cross_entropy_with_logits(self.probs, values)
 
-def conv( sin, sout,k,stride=2,pad=1,batchNorm=True) :
+def conv( sin, sout,k,stride=2,pad=1,batchNorm=True,separable=False) :
 	layers = []
-	layers.append( nn.Conv2d( sin,sout, k, stride,pad) )
+	if separable and k > 1 :
+		# depthwise kxk convolution followed by a pointwise 1x1 convolution :
+		layers.append( nn.Conv2d( sin,sin, k, stride,pad, groups=sin) )
+		layers.append( nn.Conv2d( sin,sout, 1) )
+	else :
+		layers.append( nn.Conv2d( sin,sout, k, stride,pad) )
 	if batchNorm :
 		layers.append( nn.BatchNorm2d( sout) )
 	return nn.Sequential( *layers )
 
-def deconv( sin, sout,k,stride=2,pad=1,batchNorm=True) :
+def deconv( sin, sout,k,stride=2,pad=1,batchNorm=True,separable=False) :
 	layers = []
-	layers.append( nn.ConvTranspose2d( sin,sout, k, stride,pad) )
+	if separable and k > 1 :
+		# pointwise 1x1 convolution at the input resolution, followed by a depthwise kxk transposed convolution :
+		layers.append( nn.Conv2d( sin,sout, 1) )
+		layers.append( nn.ConvTranspose2d( sout,sout, k, stride,pad, groups=sout) )
+	else :
+		layers.append( nn.ConvTranspose2d( sin,sout, k, stride,pad) )
 	if batchNorm :
 		layers.append( nn.BatchNorm2d( sout) )
 	return nn.Sequential( *layers )
 
+class LowRankLinear(nn.Module) :
+	# rank-r factorization of a Linear layer : W (out x in) ~ U (out x r) . V (r x in)
+	def __init__(self, in_features, out_features, rank, bias=True) :
+		super(LowRankLinear,self).__init__()
+		self.in_features = in_features
+		self.out_features = out_features
+		self.rank = rank
+		self.v = nn.Linear( in_features, rank, bias=False)
+		self.u = nn.Linear( rank, out_features, bias=bias)
+
+	def forward(self,x) :
+		return self.u( self.v(x) )
+
+def linear( sin, sout, rank=None) :
+	# the factorization only saves compute if r*(in+out) < in*out :
+	if rank is not None and rank*(sin+sout) < sin*sout :
+		return LowRankLinear( sin, sout, rank)
+	return nn.Linear( sin, sout)
+
+def input_density(x) :
+	# fraction of non-zero values of the batch (synchronizes with the host) :
+	return (x != 0).float().mean().item()
+
+def sparse_input_linear(layer, x) :
+	# layer(x) for a mostly-zero (B, in) batch x and a plain nn.Linear layer : x is converted to CSR (COO on older versions)
+	# and multiplied with the dense weight, which remains differentiable.
+	if hasattr(x, 'to_sparse_csr') :
+		xs = x.to_sparse_csr()
+	else :
+		xs = x.to_sparse()
+	out = torch.sparse.mm(xs, layer.weight.t())
+	if layer.bias is not None :
+		out = out + layer.bias
+	return out
+
+def run_stack(stack, x, segments=0) :
+	# Runs the nn.Sequential stack, optionally with activation checkpointing :
+	# the stack is split into `segments` chunks, only the input of each chunk is kept alive
+	# and the activations inside the chunk are recomputed during backward.
+	# The buffers of the chunk (the BatchNorm running statistics) are restored after the recomputation,
+	# so that they are updated once per step, as without checkpointing.
+	if segments <= 0 or not torch.is_grad_enabled() :
+		return stack(x)
+
+	modules = list(stack.children())
+	size = max(1, -(-len(modules)//segments) )
+	for start in range(0, len(modules), size) :
+		# calls : number of runs of this chunk in this step, the first one being the forward pass :
+		def run(x, chunk=modules[start:start+size], calls=[0]) :
+			recompute = calls[0] > 0
+			calls[0] += 1
+			if recompute :
+				buffers = [ b for module in chunk for b in module.buffers() ]
+				saved = [ b.clone() for b in buffers ]
+			for module in chunk :
+				x = module(x)
+			if recompute :
+				with torch.no_grad() :
+					for b, s in zip(buffers, saved) :
+						b.copy_(s)
+			return x
+		x = checkpoint(run, x, use_reentrant=False)
+	return x
+
 class Decoder(nn.Module) :
 	def __init__(self,net_depth=3, z_dim=32, img_dim=128, conv_dim=64,img_depth=3 ) :
 		super(Decoder,self).__init__()
@@ -64,6 +139,7 @@ class Decoder(nn.Module) :
 			self.dcs.append( nn.LeakyReLU(0.05) )
 			dim = k-2*pad + stride*(dim-1)
 		self.dcs = nn.Sequential( *self.dcs) 
+		self.checkpoint_segments = 0
 			
 		ind = outd
 		outd = 1
@@ -77,7 +153,7 @@ class Decoder(nn.Module) :
 	def decode(self, z) :
 		z = z.view( z.size(0), z.size(1), 1, 1)
 		out = F.leaky_relu( self.fc(z), 0.05)
-		out = F.leaky_relu( self.dcs(out), 0.05)
+		out = F.leaky_relu( run_stack(self.dcs, out, self.checkpoint_segments), 0.05)
 		out = F.sigmoid( self.dcout(out))
 		return out
 
@@ -108,6 +184,7 @@ class Encoder(nn.Module) :
 			self.cvs.append( nn.LeakyReLU(0.05) )
 			dim = (dim-k+2*pad)/stride +1
 		self.cvs = nn.Sequential( *self.cvs)
+		self.checkpoint_segments = 0
 
 		ind = outd
 		outd = 64
@@ -128,9 +205,9 @@ class Encoder(nn.Module) :
 		self.fc2 = nn.Linear( 1024, z_dim)
 		
 	def encode(self, x) :
-		out = self.cvs(x)
+		out = run_stack(self.cvs, x, self.checkpoint_segments)
 
-		out = out.view( (-1, self.num_features(out) ) )
+		out = out.contiguous().view( (-1, self.num_features(out) ) )
 		#print(out.size() )
 
 		out = F.leaky_relu( self.fc(out), 0.05 )
@@ -156,6 +233,10 @@ class betaVAE(nn.Module) :
 		self.encoder = Encoder(net_depth=net_depth,img_dim=img_dim, img_depth=img_depth,conv_dim=conv_dim, z_dim=2*z_dim)
 		self.decoder = Decoder(net_depth=net_depth,img_dim=img_dim, img_depth=img_depth, conv_dim=conv_dim, z_dim=z_dim)
 
+		self.z_dim = z_dim
+		self.img_dim=img_dim
+		self.img_depth=img_depth
+
 		self.beta = beta
 		self.use_cuda = use_cuda
 
@@ -180,16 +261,19 @@ class betaVAE(nn.Module) :
 		return out, mu, log_var
 
 class DecoderdSprite(nn.Module) :
-	def __init__(self,z_dim=32, img_dim=128,img_depth=3 ) :
+	# layers that can be built as (or SVD-compressed into) rank-r factorizations :
+	low_rank_layers = ['fc1', 'fc2', 'fc3']
+
+	def __init__(self,z_dim=32, img_dim=128,img_depth=3, rank=None ) :
 		super(DecoderdSprite,self).__init__()
 		
 		self.img_dim = img_dim
 		self.img_depth = img_depth
 
 		self.fc = nn.Linear( z_dim, 1200)
-		self.fc1 = nn.Linear( 1200, 1200)
-		self.fc2 = nn.Linear( 1200, 1200)
-		self.fc3 = nn.Linear( 1200, 4096)
+		self.fc1 = linear( 1200, 1200, rank)
+		self.fc2 = linear( 1200, 1200, rank)
+		self.fc3 = linear( 1200, 4096, rank)
 		
 	def decode(self, x) :
 		
@@ -206,17 +290,30 @@ class DecoderdSprite(nn.Module) :
 		return self.decode(z)
 
 class EncoderdSprite(nn.Module) :
-	def __init__(self, z_dim=310 ) :
+	low_rank_layers = ['fc', 'fc1']
+
+	def __init__(self, z_dim=310, rank=None ) :
 		super(EncoderdSprite,self).__init__()
 		
-		self.fc = nn.Linear( 4096, 1200)
-		self.fc1 = nn.Linear( 1200, 1200)
+		self.fc = linear( 4096, 1200, rank)
+		self.fc1 = linear( 1200, 1200, rank)
 		self.fc2 = nn.Linear( 1200, z_dim)
+		# the first layer takes the sparse input path when the density of the batch is below sparse_threshold (0 disables it) :
+		self.sparse_threshold = 0.0
+		# whether it does, decided on the first batch, the density being that of the dataset rather than of a batch :
+		# measuring it on every batch would synchronize each forward pass with the host (None : not decided yet).
+		self.sparse_path = None
 		
 	def encode(self, x) :
 		out = x.view( (-1, self.num_features(x) ) )
 		
-		out = F.relu( self.fc(out) )
+		if self.sparse_threshold > 0.0 and self.sparse_path is None :
+			# fc may have been replaced since set_sparse_input, e.g. by a quantized or a low-rank layer :
+			self.sparse_path = type(self.fc) is nn.Linear and input_density(out) < self.sparse_threshold
+		if self.sparse_threshold > 0.0 and self.sparse_path :
+			out = F.relu( sparse_input_linear(self.fc, out) )
+		else :
+			out = F.relu( self.fc(out) )
 		out = F.relu( self.fc1(out) )
 		out = F.relu( self.fc2(out) )
 		
@@ -234,10 +331,15 @@ class EncoderdSprite(nn.Module) :
 		return num_features
 
 class betaVAEdSprite(nn.Module) :
-	def __init__(self, beta=1.0,net_depth=4,img_dim=224, z_dim=32, conv_dim=64, use_cuda=True, img_depth=3) :
+	def __init__(self, beta=1.0,net_depth=4,img_dim=224, z_dim=32, conv_dim=64, use_cuda=True, img_depth=3, rank=None) :
 		super(betaVAEdSprite,self).__init__()
-		self.encoder = EncoderdSprite(z_dim=2*z_dim)
-		self.decoder = DecoderdSprite(z_dim=z_dim, img_dim=img_dim, img_depth=img_depth)
+		self.encoder = EncoderdSprite(z_dim=2*z_dim, rank=rank)
+		self.decoder = DecoderdSprite(z_dim=z_dim, img_dim=img_dim, img_depth=img_depth, rank=rank)
+
+		self.z_dim = z_dim
+		self.img_dim=img_dim
+		self.img_depth=img_depth
+		self.rank=rank
 
 		self.beta = beta
 		self.use_cuda = use_cuda
@@ -264,7 +366,7 @@ class betaVAEdSprite(nn.Module) :
 
 
 class DecoderXYS(nn.Module) :
-	def __init__(self,net_depth=3, z_dim=32, img_dim=128, conv_dim=64,img_depth=3 ) :
+	def __init__(self,net_depth=3, z_dim=32, img_dim=128, conv_dim=64,img_depth=3, separable=False ) :
 		super(DecoderXYS,self).__init__()
 		
 		self.net_depth = net_depth
@@ -275,15 +377,16 @@ class DecoderXYS(nn.Module) :
 		dim = k
 		pad = 1
 		stride = 2
-		self.fc = deconv( ind, outd, k, stride=1, pad=0, batchNorm=False)
+		self.fc = deconv( ind, outd, k, stride=1, pad=0, batchNorm=False, separable=separable)
 		
 		for i in reversed(range(self.net_depth)) :
 			ind = outd
 			outd = 32#conv_dim*(2**i)
-			self.dcs.append( deconv( ind, outd,k,stride=stride,pad=pad) )
+			self.dcs.append( deconv( ind, outd,k,stride=stride,pad=pad, separable=separable) )
 			self.dcs.append( nn.LeakyReLU(0.05) )
 			dim = k-2*pad + stride*(dim-1)
 		self.dcs = nn.Sequential( *self.dcs) 
+		self.checkpoint_segments = 0
 			
 		ind = outd
 		self.img_depth=img_depth
@@ -293,12 +396,12 @@ class DecoderXYS(nn.Module) :
 		pad = 0
 		stride = 1
 		k = outdim +2*pad -stride*(indim-1)
-		self.dcout = deconv( ind, outd, k, stride=stride, pad=pad, batchNorm=False)
+		self.dcout = deconv( ind, outd, k, stride=stride, pad=pad, batchNorm=False, separable=separable)
 		
 	def decode(self, z) :
 		z = z.view( z.size(0), z.size(1), 1, 1)
 		out = F.leaky_relu( self.fc(z), 0.05)
-		out = F.leaky_relu( self.dcs(out), 0.05)
+		out = F.leaky_relu( run_stack(self.dcs, out, self.checkpoint_segments), 0.05)
 		out = F.sigmoid( self.dcout(out))
 		return out
 
@@ -306,7 +409,7 @@ class DecoderXYS(nn.Module) :
 		return self.decode(z)
 
 class EncoderXYS(nn.Module) :
-	def __init__(self,net_depth=3, img_dim=128, img_depth=3, conv_dim=64, z_dim=32 ) :
+	def __init__(self,net_depth=3, img_dim=128, img_depth=3, conv_dim=64, z_dim=32, separable=False ) :
 		super(EncoderXYS,self).__init__()
 		
 		self.net_depth = net_depth
@@ -318,17 +421,18 @@ class EncoderXYS(nn.Module) :
 		pad = 1
 		stride = 2
 		self.cvs = []
-		self.cvs.append( conv( img_depth, conv_dim, 4, batchNorm=False))
+		self.cvs.append( conv( img_depth, conv_dim, 4, batchNorm=False, separable=separable))
 		self.cvs.append( nn.LeakyReLU(0.05) )
 		dim = (dim-k+2*pad)/stride +1
 
 		for i in range(1,self.net_depth,1) :
 			ind = outd
 			outd = 32#conv_dim*(2**i)
-			self.cvs.append( conv( ind, outd,k,stride=stride,pad=pad) )
+			self.cvs.append( conv( ind, outd,k,stride=stride,pad=pad, separable=separable) )
 			self.cvs.append( nn.LeakyReLU(0.05) )
 			dim = (dim-k+2*pad)/stride +1
 		self.cvs = nn.Sequential( *self.cvs)
+		self.checkpoint_segments = 0
 
 		ind = outd
 		outd = 64
@@ -350,9 +454,9 @@ class EncoderXYS(nn.Module) :
 		self.fc2 = nn.Linear( 1024, z_dim)
 		
 	def encode(self, x) :
-		out = self.cvs(x)
+		out = run_stack(self.cvs, x, self.checkpoint_segments)
 
-		out = out.view( (-1, self.num_features(out) ) )
+		out = out.contiguous().view( (-1, self.num_features(out) ) )
 		#print(out.size() )
 
 		out = F.leaky_relu( self.fc(out), 0.05 )
@@ -374,14 +478,15 @@ class EncoderXYS(nn.Module) :
 
 
 class betaVAEXYS(nn.Module) :
-	def __init__(self, beta=1.0,net_depth=4,img_dim=224, z_dim=32, conv_dim=64, use_cuda=True, img_depth=3) :
+	def __init__(self, beta=1.0,net_depth=4,img_dim=224, z_dim=32, conv_dim=64, use_cuda=True, img_depth=3, separable=False) :
 		super(betaVAEXYS,self).__init__()
-		self.encoder = EncoderXYS(z_dim=2*z_dim, img_depth=img_depth, img_dim=img_dim, conv_dim=conv_dim,net_depth=net_depth)
-		self.decoder = DecoderXYS(z_dim=z_dim, img_dim=img_dim, img_depth=img_depth, net_depth=net_depth)
+		self.encoder = EncoderXYS(z_dim=2*z_dim, img_depth=img_depth, img_dim=img_dim, conv_dim=conv_dim,net_depth=net_depth, separable=separable)
+		self.decoder = DecoderXYS(z_dim=z_dim, img_dim=img_dim, img_depth=img_depth, net_depth=net_depth, separable=separable)
 
 		self.z_dim = z_dim
 		self.img_dim=img_dim
 		self.img_depth=img_depth
+		self.separable=separable
 		
 		self.beta = beta
 		self.use_cuda = use_cuda
@@ -408,7 +513,7 @@ class betaVAEXYS(nn.Module) :
 
 
 class DecoderXYS2(nn.Module) :
-	def __init__(self,net_depth=3, z_dim=32, img_dim=128, conv_dim=64,img_depth=3 ) :
+	def __init__(self,net_depth=3, z_dim=32, img_dim=128, conv_dim=64,img_depth=3, separable=False ) :
 		super(DecoderXYS2,self).__init__()
 		
 		self.net_depth = net_depth
@@ -419,15 +524,16 @@ class DecoderXYS2(nn.Module) :
 		dim = k
 		pad = 1
 		stride = 2
-		self.fc = deconv( ind, outd, k, stride=1, pad=0, batchNorm=False)
+		self.fc = deconv( ind, outd, k, stride=1, pad=0, batchNorm=False, separable=separable)
 		
 		for i in reversed(range(self.net_depth)) :
 			ind = outd
 			outd = conv_dim*(2**i)
-			self.dcs.append( deconv( ind, outd,k,stride=stride,pad=pad) )
+			self.dcs.append( deconv( ind, outd,k,stride=stride,pad=pad, separable=separable) )
 			self.dcs.append( nn.LeakyReLU(0.05) )
 			dim = k-2*pad + stride*(dim-1)
 		self.dcs = nn.Sequential( *self.dcs) 
+		self.checkpoint_segments = 0
 			
 		ind = outd
 		self.img_depth=img_depth
@@ -437,12 +543,12 @@ class DecoderXYS2(nn.Module) :
 		pad = 0
 		stride = 1
 		k = outdim +2*pad -stride*(indim-1)
-		self.dcout = deconv( ind, outd, k, stride=stride, pad=pad, batchNorm=False)
+		self.dcout = deconv( ind, outd, k, stride=stride, pad=pad, batchNorm=False, separable=separable)
 		
 	def decode(self, z) :
 		z = z.view( z.size(0), z.size(1), 1, 1)
 		out = F.leaky_relu( self.fc(z), 0.05)
-		out = F.leaky_relu( self.dcs(out), 0.05)
+		out = F.leaky_relu( run_stack(self.dcs, out, self.checkpoint_segments), 0.05)
 		out = F.sigmoid( self.dcout(out))
 		return out
 
@@ -450,7 +556,7 @@ class DecoderXYS2(nn.Module) :
 		return self.decode(z)
 
 class EncoderXYS2(nn.Module) :
-	def __init__(self,net_depth=3, img_dim=128, img_depth=3, conv_dim=64, z_dim=32 ) :
+	def __init__(self,net_depth=3, img_dim=128, img_depth=3, conv_dim=64, z_dim=32, separable=False ) :
 		super(EncoderXYS2,self).__init__()
 		
 		self.net_depth = net_depth
@@ -462,17 +568,18 @@ class EncoderXYS2(nn.Module) :
 		pad = 1
 		stride = 2
 		self.cvs = []
-		self.cvs.append( conv( img_depth, conv_dim, 4, batchNorm=False))
+		self.cvs.append( conv( img_depth, conv_dim, 4, batchNorm=False, separable=separable))
 		self.cvs.append( nn.LeakyReLU(0.05) )
 		dim = (dim-k+2*pad)/stride +1
 
 		for i in range(1,self.net_depth,1) :
 			ind = outd
 			outd = conv_dim*(2**i)
-			self.cvs.append( conv( ind, outd,k,stride=stride,pad=pad) )
+			self.cvs.append( conv( ind, outd,k,stride=stride,pad=pad, separable=separable) )
 			self.cvs.append( nn.LeakyReLU(0.05) )
 			dim = (dim-k+2*pad)/stride +1
 		self.cvs = nn.Sequential( *self.cvs)
+		self.checkpoint_segments = 0
 
 		ind = outd
 		outd = 64
@@ -491,9 +598,9 @@ class EncoderXYS2(nn.Module) :
 		self.fc2 = nn.Linear( 1024, z_dim)
 		
 	def encode(self, x) :
-		out = self.cvs(x)
+		out = run_stack(self.cvs, x, self.checkpoint_segments)
 
-		out = out.view( (-1, self.num_features(out) ) )
+		out = out.contiguous().view( (-1, self.num_features(out) ) )
 		#print(out.size() )
 
 		out = F.leaky_relu( self.fc(out), 0.05 )
@@ -515,14 +622,15 @@ class EncoderXYS2(nn.Module) :
 
 
 class betaVAEXYS2(nn.Module) :
-	def __init__(self, beta=1.0,net_depth=4,img_dim=224, z_dim=32, conv_dim=64, use_cuda=True, img_depth=3) :
+	def __init__(self, beta=1.0,net_depth=4,img_dim=224, z_dim=32, conv_dim=64, use_cuda=True, img_depth=3, separable=False) :
 		super(betaVAEXYS2,self).__init__()
-		self.encoder = EncoderXYS2(z_dim=2*z_dim, img_depth=img_depth, img_dim=img_dim, conv_dim=conv_dim,net_depth=net_depth)
-		self.decoder = DecoderXYS2(z_dim=z_dim, img_dim=img_dim, img_depth=img_depth, net_depth=net_depth)
+		self.encoder = EncoderXYS2(z_dim=2*z_dim, img_depth=img_depth, img_dim=img_dim, conv_dim=conv_dim,net_depth=net_depth, separable=separable)
+		self.decoder = DecoderXYS2(z_dim=z_dim, img_dim=img_dim, img_depth=img_depth, net_depth=net_depth, separable=separable)
 
 		self.z_dim = z_dim
 		self.img_dim=img_dim
 		self.img_depth=img_depth
+		self.separable=separable
 		
 		self.beta = beta
 		self.use_cuda = use_cuda
@@ -550,7 +658,7 @@ class betaVAEXYS2(nn.Module) :
 
 
 class DecoderXYS3(nn.Module) :
-	def __init__(self,net_depth=3, z_dim=32, img_dim=128, conv_dim=64,img_depth=3 ) :
+	def __init__(self,net_depth=3, z_dim=32, img_dim=128, conv_dim=64,img_depth=3, separable=False ) :
 		super(DecoderXYS3,self).__init__()
 		
 		self.net_depth = net_depth
@@ -561,15 +669,16 @@ class DecoderXYS3(nn.Module) :
 		dim = k
 		pad = 1
 		stride = 2
-		self.fc = deconv( ind, outd, k, stride=1, pad=0, batchNorm=False)
+		self.fc = deconv( ind, outd, k, stride=1, pad=0, batchNorm=False, separable=separable)
 		
 		for i in reversed(range(self.net_depth)) :
 			ind = outd
 			outd = conv_dim*(2**i)
-			self.dcs.append( deconv( ind, outd,k,stride=stride,pad=pad) )
+			self.dcs.append( deconv( ind, outd,k,stride=stride,pad=pad, separable=separable) )
 			self.dcs.append( nn.LeakyReLU(0.05) )
 			dim = k-2*pad + stride*(dim-1)
 		self.dcs = nn.Sequential( *self.dcs) 
+		self.checkpoint_segments = 0
 			
 		ind = outd
 		self.img_depth=img_depth
@@ -579,12 +688,12 @@ class DecoderXYS3(nn.Module) :
 		pad = 0
 		stride = 1
 		k = outdim +2*pad -stride*(indim-1)
-		self.dcout = deconv( ind, outd, k, stride=stride, pad=pad, batchNorm=False)
+		self.dcout = deconv( ind, outd, k, stride=stride, pad=pad, batchNorm=False, separable=separable)
 		
 	def decode(self, z) :
 		z = z.view( z.size(0), z.size(1), 1, 1)
 		out = F.leaky_relu( self.fc(z), 0.05)
-		out = F.leaky_relu( self.dcs(out), 0.05)
+		out = F.leaky_relu( run_stack(self.dcs, out, self.checkpoint_segments), 0.05)
 		out = F.sigmoid( self.dcout(out))
 		return out
 
@@ -592,26 +701,26 @@ class DecoderXYS3(nn.Module) :
 		return self.decode(z)
 
 class EncoderXYS3(nn.Module) :
-	def __init__(self,net_depth=3, img_dim=128, img_depth=3, conv_dim=64, z_dim=32 ) :
+	def __init__(self,net_depth=3, img_dim=128, img_depth=3, conv_dim=64, z_dim=32, separable=False ) :
 		super(EncoderXYS3,self).__init__()
 		
 		self.net_depth = net_depth
 		self.img_depth= img_depth
 		self.z_dim = z_dim
 		# 224
-		self.cv1 = conv( self.img_depth, 96, 11, batchNorm=False)
+		self.cv1 = conv( self.img_depth, 96, 11, batchNorm=False, separable=separable)
 		# 108/109 = E( (224-11+2*1)/2 ) + 1
 		self.d1 = nn.Dropout2d(p=0.8)
-		self.cv2 = conv( 96, 256, 5)
+		self.cv2 = conv( 96, 256, 5, separable=separable)
 		# 53 / 54
 		self.d2 = nn.Dropout2d(p=0.8)
-		self.cv3 = conv( 256, 384, 3)
+		self.cv3 = conv( 256, 384, 3, separable=separable)
 		# 27 / 27
 		self.d3 = nn.Dropout2d(p=0.5)
-		self.cv4 = conv( 384, 64, 1)
+		self.cv4 = conv( 384, 64, 1, separable=separable)
 		# 15
 		self.d4 = nn.Dropout2d(p=0.5)
-		self.fc = conv( 64, 64, 4, stride=1,pad=0, batchNorm=False)
+		self.fc = conv( 64, 64, 4, stride=1,pad=0, batchNorm=False, separable=separable)
 		# 12
 		#self.fc1 = nn.Linear(64 * (12**2), 128)
 		self.fc1 = nn.Linear(64 * (14**2), 128)
@@ -631,7 +740,7 @@ class EncoderXYS3(nn.Module) :
 		out = self.d4(out)
 		out = F.leaky_relu( self.fc(out))
 		#print(out.size())
-		out = out.view( -1, self.num_flat_features(out) )
+		out = out.contiguous().view( -1, self.num_flat_features(out) )
 		#print(out.size())
 		out = F.leaky_relu( self.bn1( self.fc1( out) ), 0.15 )
 		out = F.leaky_relu( self.bn2( self.fc2( out) ), 0.15)
@@ -654,14 +763,15 @@ class EncoderXYS3(nn.Module) :
 
 
 class betaVAEXYS3(nn.Module) :
-	def __init__(self, beta=1.0,net_depth=4,img_dim=224, z_dim=32, conv_dim=64, use_cuda=True, img_depth=3) :
+	def __init__(self, beta=1.0,net_depth=4,img_dim=224, z_dim=32, conv_dim=64, use_cuda=True, img_depth=3, separable=False) :
 		super(betaVAEXYS3,self).__init__()
-		self.encoder = EncoderXYS3(z_dim=2*z_dim, img_depth=img_depth, img_dim=img_dim, conv_dim=conv_dim,net_depth=net_depth)
-		self.decoder = DecoderXYS3(z_dim=z_dim, img_dim=img_dim, img_depth=img_depth, net_depth=net_depth)
+		self.encoder = EncoderXYS3(z_dim=2*z_dim, img_depth=img_depth, img_dim=img_dim, conv_dim=conv_dim,net_depth=net_depth, separable=separable)
+		self.decoder = DecoderXYS3(z_dim=z_dim, img_dim=img_dim, img_depth=img_depth, net_depth=net_depth, separable=separable)
 
 		self.z_dim = z_dim
 		self.img_dim=img_dim
 		self.img_depth=img_depth
+		self.separable=separable
 		
 		self.beta = beta
 		self.use_cuda = use_cuda
@@ -686,6 +796,148 @@ class betaVAEXYS3(nn.Module) :
 
 		return out, mu, log_var
 
+
+class EncoderXYSMultiRes(nn.Module) :
+	def __init__(self,net_depth=5, img_dim=256, img_depth=3, conv_dim=8, z_dim=32, patch_dim=32, eye_conv_dim=8, eye_depth=3, pool_dim=4, separable=False ) :
+		super(EncoderXYSMultiRes,self).__init__()
+		# stacked inputs : [full frame, right-eye patch, left-eye patch] on the channel dimension.
+		# The full frame goes through the cvs stem at img_dim, while both eye patches are brought back to patch_dim
+		# and go through a single, shared, eye_cvs stem. The three streams are fused before the latent head.
+		self.net_depth = net_depth
+		self.img_dim = img_dim
+		self.img_depth = img_depth
+		self.patch_dim = patch_dim
+		self.z_dim = z_dim
+		# the eye patches are only ever downsampled from img_dim, and every stride-2 layer of a stem halves its input :
+		if patch_dim > img_dim :
+			raise ValueError('the eye patches ({}x{}) must not be larger than the frame ({}x{}).'.format(patch_dim, patch_dim, img_dim, img_dim) )
+		if img_dim < 2**net_depth or patch_dim < 2**eye_depth :
+			raise ValueError('the frame ({}) and the eye patches ({}) must be at least {} and {} pixels wide for {} and {} stride-2 layers.'.format(img_dim, patch_dim, 2**net_depth, 2**eye_depth, net_depth, eye_depth) )
+
+		self.cvs = []
+		outd = conv_dim
+		self.cvs.append( conv( 1, outd, 4, batchNorm=False, separable=separable))
+		self.cvs.append( nn.LeakyReLU(0.05) )
+		for i in range(1,self.net_depth,1) :
+			ind = outd
+			outd = conv_dim*(2**i)
+			self.cvs.append( conv( ind, outd, 4, separable=separable) )
+			self.cvs.append( nn.LeakyReLU(0.05) )
+		self.cvs = nn.Sequential( *self.cvs)
+		self.checkpoint_segments = 0
+		frame_features = outd*pool_dim*pool_dim
+
+		self.eye_cvs = []
+		outd = eye_conv_dim
+		self.eye_cvs.append( conv( 1, outd, 4, batchNorm=False, separable=separable))
+		self.eye_cvs.append( nn.LeakyReLU(0.05) )
+		for i in range(1,eye_depth,1) :
+			ind = outd
+			outd = eye_conv_dim*(2**i)
+			self.eye_cvs.append( conv( ind, outd, 4, separable=separable) )
+			self.eye_cvs.append( nn.LeakyReLU(0.05) )
+		self.eye_cvs = nn.Sequential( *self.eye_cvs)
+		eye_features = outd*pool_dim*pool_dim
+
+		self.pool = nn.AdaptiveAvgPool2d(pool_dim)
+		self.fc = nn.Linear( frame_features+2*eye_features, 256)
+		self.fc1 = nn.Linear( 256, z_dim)
+
+	def patches(self, x) :
+		# the eye crops are stacked on channels 1 and 2, upsampled to img_dim by the dataset :
+		# area-downsampling them to patch_dim brings them back close to their original resolution.
+		eyes = x[:,1:3]
+		if eyes.size(-1) != self.patch_dim :
+			eyes = F.adaptive_avg_pool2d(eyes, self.patch_dim)
+		return eyes
+
+	def encode(self, x) :
+		batch_size = x.size(0)
+		frame = run_stack(self.cvs, x[:,0:1], self.checkpoint_segments)
+		frame = self.pool(frame).contiguous().view( (batch_size, -1) )
+
+		# both eyes go through the shared stem in a single call :
+		eyes = self.patches(x).contiguous().view( (2*batch_size, 1, self.patch_dim, self.patch_dim) )
+		eyes = self.pool( self.eye_cvs(eyes) ).contiguous().view( (batch_size, -1) )
+
+		out = torch.cat( [frame, eyes], dim=1)
+		out = F.leaky_relu( self.fc(out), 0.05 )
+		out = self.fc1(out)
+
+		return out
+
+	def forward(self,x) :
+		return self.encode(x)
+
+
+class betaVAEXYSMultiRes(nn.Module) :
+	def __init__(self, beta=1.0,net_depth=5,img_dim=256, z_dim=32, conv_dim=8, use_cuda=True, img_depth=3, patch_dim=32, separable=False) :
+		super(betaVAEXYSMultiRes,self).__init__()
+		self.encoder = EncoderXYSMultiRes(z_dim=2*z_dim, img_depth=img_depth, img_dim=img_dim, conv_dim=conv_dim,net_depth=net_depth, patch_dim=patch_dim, separable=separable)
+		self.decoder = DecoderXYS2(z_dim=z_dim, img_dim=img_dim, img_depth=img_depth, net_depth=net_depth, separable=separable)
+
+		self.z_dim = z_dim
+		self.img_dim=img_dim
+		self.img_depth=img_depth
+		self.patch_dim=patch_dim
+		self.separable=separable
+		
+		self.beta = beta
+		self.use_cuda = use_cuda
+
+		if self.use_cuda :
+			self = self.cuda()
+
+	def reparameterize(self, mu,log_var) :
+		eps = torch.randn( (mu.size()[0], mu.size()[1]) )
+		veps = Variable( eps)
+		if self.use_cuda :
+			veps = veps.cuda()
+		z = mu + veps * torch.exp( log_var/2 )
+		return z
+
+	def forward(self,x) :
+		h = self.encoder( x)
+		mu, log_var = torch.chunk(h, 2, dim=1 )
+		z = self.reparameterize( mu,log_var)
+		out = self.decoder(z)
+
+		return out, mu, log_var
+
+
+class StudentEncoder(nn.Module) :
+	def __init__(self,net_depth=4, img_dim=256, img_depth=3, conv_dim=16, z_dim=32, pool_dim=4 ) :
+		super(StudentEncoder,self).__init__()
+		# lightweight encoder : net_depth strided convolutions, whose width doubles up to 8*conv_dim,
+		# followed by an adaptive average pooling to pool_dim x pool_dim and a single linear head.
+		self.net_depth = net_depth
+		self.img_depth = img_depth
+		self.z_dim = z_dim
+
+		self.cvs = []
+		outd = conv_dim
+		self.cvs.append( conv( img_depth, outd, 4, batchNorm=False))
+		self.cvs.append( nn.LeakyReLU(0.05) )
+		for i in range(1,self.net_depth,1) :
+			ind = outd
+			outd = conv_dim*min(2**i, 8)
+			self.cvs.append( conv( ind, outd, 4) )
+			self.cvs.append( nn.LeakyReLU(0.05) )
+		self.cvs = nn.Sequential( *self.cvs)
+		self.checkpoint_segments = 0
+
+		self.pool = nn.AdaptiveAvgPool2d(pool_dim)
+		self.fc = nn.Linear( outd*pool_dim*pool_dim, z_dim)
+
+	def encode(self, x) :
+		out = run_stack(self.cvs, x, self.checkpoint_segments)
+		out = self.pool(out)
+		out = out.contiguous().view( (out.size(0), -1) )
+		return self.fc(out)
+
+	def forward(self,x) :
+		return self.encode(x)
+
 class Rescale(object) :
 	def __init__(self, output_size) :
 		assert( isinstance(output_size, (int, tuple) ) )
@@ -734,6 +986,23 @@ class VAE(nn.Module) :
 
 		return out, mu, log_var
 
+# Settings with which each model class is actually trained in the scripts :
+MODEL_SETTINGS = {
+	'betaVAE' : dict(model=betaVAE, img_dim=64, img_depth=1, conv_dim=32, net_depth=3, z_dim=12),
+	'betaVAEdSprite' : dict(model=betaVAEdSprite, img_dim=64, img_depth=1, conv_dim=64, net_depth=3, z_dim=10),
+	'betaVAEXYS' : dict(model=betaVAEXYS, img_dim=256, img_depth=3, conv_dim=32, net_depth=5, z_dim=10),
+	'betaVAEXYS2' : dict(model=betaVAEXYS2, img_dim=256, img_depth=3, conv_dim=8, net_depth=5, z_dim=10),
+	'betaVAEXYS3' : dict(model=betaVAEXYS3, img_dim=256, img_depth=3, conv_dim=8, net_depth=6, z_dim=10),
+	'betaVAEXYSMultiRes' : dict(model=betaVAEXYSMultiRes, img_dim=256, img_depth=3, conv_dim=8, net_depth=5, z_dim=10),
+}
+
+def build_model(name, beta=1.0, use_cuda=False, **kwargs) :
+	setting = dict(MODEL_SETTINGS[name])
+	setting.update(kwargs)
+	model_class = setting.pop('model')
+	return model_class(beta=beta, use_cuda=use_cuda, **setting)
+
+
 def test_mnist():
 	import os
 	import torchvision
@@ -0,0 +1,137 @@
+import json
+
+import torch
+import torch.nn as nn
+
+from models import MODEL_SETTINGS, build_model
+from execution import autocast
+
+
+def layer_macs(layer, inputs, output) :
+	# multiply-accumulates of the Conv2d, ConvTranspose2d and Linear layers for the whole batch, 0 for the other layers :
+	if isinstance(layer, nn.Conv2d) :
+		return output.numel() * (layer.in_channels//layer.groups) * layer.kernel_size[0]*layer.kernel_size[1]
+	if isinstance(layer, nn.ConvTranspose2d) :
+		return inputs[0].numel() * (layer.out_channels//layer.groups) * layer.kernel_size[0]*layer.kernel_size[1]
+	if isinstance(layer, nn.Linear) :
+		return output.numel() * layer.in_features
+	return 0
+
+def profile_layers(module, x) :
+	# one record per leaf module, in execution order, from a no-grad forward pass on the batch x.
+	# The functional ops (e.g. F.leaky_relu in the encode/decode methods) are not modules and are not listed.
+	records = []
+	def hook(layer, inputs, output, name=None) :
+		if not torch.is_tensor(output) :
+			return
+		records.append( dict( name=name,
+							type=layer.__class__.__name__,
+							params=sum( p.numel() for p in layer.parameters(recurse=False) ),
+							macs=layer_macs(layer, inputs, output),
+							output_shape=list(output.shape),
+							activation_bytes=output.numel()*output.element_size() ) )
+
+	handles = []
+	for name, layer in module.named_modules() :
+		if len(list(layer.children())) == 0 :
+			handles.append( layer.register_forward_hook( lambda layer, inputs, output, name=name : hook(layer, inputs, output, name=name) ) )
+	try :
+		with torch.no_grad() :
+			module(x)
+	finally :
+		for handle in handles :
+			handle.remove()
+	return records
+
+def count_macs(module, x) :
+	# multiply-accumulates per image :
+	return sum( r['macs'] for r in profile_layers(module, x[:1]) )
+
+def saved_activation_bytes(model, x) :
+	# bytes of the distinct tensors saved by autograd during a forward pass, for the backward pass :
+	saved = {}
+	def pack(t) :
+		saved[ (t.data_ptr(), t.numel(), t.dtype) ] = t.numel()*t.element_size()
+		return t
+	with torch.autograd.graph.saved_tensors_hooks(pack, lambda t : t) :
+		with autocast(model, x.device.type) :
+			model(x)
+	return sum(saved.values())
+
+def profile_model(model, x) :
+	# per-layer costs and totals for one training step on the batch x :
+	records = profile_layers(model, x)
+	params = sum( p.numel() for p in model.parameters() )
+	param_bytes = sum( p.numel()*p.element_size() for p in model.parameters() )
+	forward_macs = sum( r['macs'] for r in records )
+	saved_bytes = saved_activation_bytes(model, x)
+
+	totals = dict( batch_size=x.size(0),
+				params=params,
+				param_bytes=param_bytes,
+				forward_macs=forward_macs,
+				# gradients w.r.t. the inputs and w.r.t. the weights of each layer :
+				backward_macs=2*forward_macs,
+				forward_activation_bytes=sum( r['activation_bytes'] for r in records ),
+				saved_activation_bytes=saved_bytes,
+				# weights + gradients + Adam moments + activations saved for the backward pass :
+				training_bytes=4*param_bytes + saved_bytes )
+	return dict( model=model.__class__.__name__, layers=records, totals=totals )
+
+def human(value, unit='') :
+	for prefix in ['', 'K', 'M', 'G', 'T'] :
+		if abs(value) < 1000.0 or prefix == 'T' :
+			return '{:.1f}{}{}'.format(value, prefix, unit) if prefix else '{}{}'.format(value, unit)
+		value /= 1000.0
+
+def human_bytes(value) :
+	for prefix in ['B', 'KiB', 'MiB', 'GiB'] :
+		if abs(value) < 1024.0 or prefix == 'GiB' :
+			return '{:.1f} {}'.format(value, prefix) if prefix != 'B' else '{} B'.format(value)
+		value /= 1024.0
+
+def print_profile(profile) :
+	rows = [ [r['name'], r['type'], human(r['params']), human(r['macs']), 'x'.join( str(d) for d in r['output_shape'] ), human_bytes(r['activation_bytes'])] for r in profile['layers'] ]
+	header = ['layer', 'type', 'params', 'MACs', 'output shape', 'activation']
+	widths = [ max( len(str(r[i])) for r in [header]+rows ) for i in range(len(header)) ]
+	line = ' | '.join( '{:<'+str(w)+'}' for w in widths )
+	print(line.format(*header))
+	print('-+-'.join( '-'*w for w in widths ))
+	for r in rows :
+		print(line.format(*r))
+
+	totals = profile['totals']
+	print('')
+	print('{} :: batch {} :: params {} ({}) :: forward {} MACs // backward ~{} MACs'.format(profile['model'], totals['batch_size'], human(totals['params']), human_bytes(totals['param_bytes']), human(totals['forward_macs']), human(totals['backward_macs'])) )
+	print('activations : forward outputs {} // saved for backward {} :: training step estimate (weights, gradients, Adam, saved activations) : {}'.format(human_bytes(totals['forward_activation_bytes']), human_bytes(totals['saved_activation_bytes']), human_bytes(totals['training_bytes'])) )
+
+
+if __name__ == '__main__' :
+	import argparse
+	parser = argparse.ArgumentParser(description='Per-layer parameters, MACs and activation memory of a model')
+	parser.add_argument('--model', type=str, default='betaVAEXYS2', choices=list(MODEL_SETTINGS.keys()))
+	parser.add_argument('--batch', type=int, default=32)
+	parser.add_argument('--latent', type=int, default=None)
+	parser.add_argument('--img_dim', type=int, default=None)
+	parser.add_argument('--img_depth', type=int, default=None)
+	parser.add_argument('--conv_dim', type=int, default=None)
+	parser.add_argument('--net_depth', type=int, default=None)
+	parser.add_argument('--separable',action='store_true',default=False)
+	parser.add_argument('--json', type=str, default=None, help='path of the JSON report')
+	args = parser.parse_args()
+
+	setting = dict( (k,v) for k,v in [('z_dim',args.latent), ('img_dim',args.img_dim), ('img_depth',args.img_depth), ('conv_dim',args.conv_dim), ('net_depth',args.net_depth)] if v is not None )
+	if args.separable :
+		setting['separable'] = True
+	model = build_model(args.model, **setting)
+	x = torch.rand( (args.batch, model.img_depth, model.img_dim, model.img_dim) )
+
+	profile = profile_model(model, x)
+	profile['settings'] = dict( (k,v) for k,v in MODEL_SETTINGS[args.model].items() if k != 'model' )
+	profile['settings'].update(setting)
+	print_profile(profile)
+
+	if args.json is not None :
+		with open(args.json, 'w') as f :
+			json.dump(profile, f, indent=2)
+		print('Profile saved at : {}'.format(args.json) )
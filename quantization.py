@@ -0,0 +1,193 @@
+import copy
+import time
+
+import torch
+import torch.nn as nn
+
+from models import betaVAEdSprite, EncoderXYSMultiRes
+from inference import LINEAR_BN_PAIRS
+
+try :
+	from torch.ao import quantization as tq
+except ImportError :
+	from torch import quantization as tq
+
+
+def encode_decode(model, x) :
+	# deterministic inference path : x -> (mu, log_var) -> decoder(mu)
+	h = model.encoder(x)
+	mu, log_var = torch.chunk(h, 2, dim=1 )
+	return model.decoder(mu), mu, log_var
+
+def quantize_dynamic_dSprite(model, dtype=torch.qint8) :
+	# EncoderdSprite and DecoderdSprite are pure nn.Linear stacks :
+	# their weights are quantized to int8 once, and the activations are quantized on the fly.
+	model = copy.deepcopy(model).cpu().eval()
+	model.use_cuda = False
+	return tq.quantize_dynamic(model, {nn.Linear}, dtype=dtype)
+
+def save_quantized(model, path) :
+	torch.save( model.state_dict(), path)
+	print('Quantized model saved at : {}'.format(path) )
+
+def load_quantized_dSprite(path, z_dim=10, img_dim=64, img_depth=1, beta=1.0) :
+	# the packed int8 parameters can only be loaded into an already quantized structure :
+	model = betaVAEdSprite(beta=beta, z_dim=z_dim, img_dim=img_dim, img_depth=img_depth, use_cuda=False)
+	model = quantize_dynamic_dSprite(model)
+	model.load_state_dict( torch.load(path) )
+	return model
+
+def check_quantization(model, quantized, x, mu_tolerance=5e-2, reconst_tolerance=2e-2) :
+	# compares mu and the reconstructions (decoded from mu) of the quantized model to the float ones,
+	# on a CPU copy of the float model, whose device and mode are left as they are :
+	model = copy.deepcopy(model).cpu().eval()
+	with torch.no_grad() :
+		reconst, mu, _ = encode_decode(model, x)
+		qreconst, qmu, _ = encode_decode(quantized, x)
+
+	mu_error = (qmu-mu).abs().max().item()
+	reconst_error = (qreconst-reconst).abs().mean().item()
+	ok = mu_error <= mu_tolerance and reconst_error <= reconst_tolerance
+	print('QUANTIZATION CHECK : {} :: max |mu error| = {:.5f} (tolerance {}) // mean |reconstruction error| = {:.5f} (tolerance {})'.format('OK' if ok else 'FAILED', mu_error, mu_tolerance, reconst_error, reconst_tolerance) )
+	return ok, mu_error, reconst_error
+
+
+def quantization_backend() :
+	# x86 (fbgemm+onednn) on recent versions, fbgemm otherwise :
+	engines = torch.backends.quantized.supported_engines
+	for backend in ['x86', 'fbgemm', 'onednn', 'qnnpack'] :
+		if backend in engines :
+			return backend
+	return None
+
+class QuantizedEncoder(nn.Module) :
+	# quantizes the images on the way in and dequantizes (mu, log_var) on the way out :
+	def __init__(self, encoder) :
+		super(QuantizedEncoder,self).__init__()
+		self.quant = tq.QuantStub()
+		self.encoder = encoder
+		self.dequant = tq.DeQuantStub()
+
+	def forward(self,x) :
+		return self.dequant( self.encoder( self.quant(x) ) )
+
+def fuse_conv_bn(encoder) :
+	# fuse the Conv2d+BatchNorm2d pairs emitted by the conv() helper (the pointwise conv and the BN of the separable blocks)
+	# wherever they are in the encoder, and its Linear+BatchNorm1d pairs (see inference.LINEAR_BN_PAIRS), as fold_batchnorm does.
+	# Eager mode has no conv+bn+leaky_relu pattern : the LeakyReLU modules become separate int8 ops.
+	modules = []
+	for name, module in encoder.named_modules() :
+		prefix = name+'.' if name else ''
+		if isinstance(module, nn.Sequential) and len(module) in [2,3] and isinstance(module[-2], nn.Conv2d) and isinstance(module[-1], nn.BatchNorm2d) :
+			modules.append( [prefix+str(len(module)-2), prefix+str(len(module)-1)] )
+		for layer_name, bn_name in LINEAR_BN_PAIRS.get(type(module), []) :
+			if isinstance(getattr(module, bn_name), nn.BatchNorm1d) :
+				modules.append( [prefix+layer_name, prefix+bn_name] )
+	if len(modules) :
+		tq.fuse_modules(encoder, modules, inplace=True)
+	return encoder
+
+# encoders whose forward pass cannot run on int8 tensors in eager mode : the frame and eye features of EncoderXYSMultiRes
+# are quantized with their own scales and concatenated by torch.cat.
+UNSUPPORTED_ENCODERS = (EncoderXYSMultiRes,)
+
+def check_static_quantization(model) :
+	if isinstance(model.encoder, UNSUPPORTED_ENCODERS) :
+		raise ValueError('{} : the encoder {} cannot be statically quantized.'.format(model.__class__.__name__, model.encoder.__class__.__name__) )
+
+def calibration_batches(data_loader, nbr_batches=200) :
+	# images of the first nbr_batches batches of a XYS or dSprites data loader :
+	for i, sample in enumerate(data_loader) :
+		if i >= nbr_batches :
+			break
+		if isinstance(sample, dict) :
+			yield sample['image'].float()
+		else :
+			yield sample[0].float()
+
+def quantize_static_encoder(model, batches, backend=None) :
+	# Post-training static int8 quantization of the encoder of betaVAE, betaVAEXYS, betaVAEXYS2 or betaVAEXYS3 :
+	# the returned model keeps a float decoder and can be used as the original one, e.g. model(x) -> (out, mu, log_var).
+	check_static_quantization(model)
+	if backend is None :
+		backend = quantization_backend()
+	torch.backends.quantized.engine = backend
+
+	model = copy.deepcopy(model).cpu().eval()
+	model.use_cuda = False
+
+	encoder = QuantizedEncoder( fuse_conv_bn(model.encoder) )
+	encoder.qconfig = tq.get_default_qconfig(backend)
+	tq.prepare(encoder, inplace=True)
+
+	# calibration of the activation observers :
+	nbr_images = 0
+	with torch.no_grad() :
+		for x in batches :
+			encoder(x)
+			nbr_images += x.size(0)
+	print('QUANTIZATION : calibrated on {} images.'.format(nbr_images) )
+
+	tq.convert(encoder, inplace=True)
+	model.encoder = encoder
+	return model
+
+def encoder_latency(encoder, x, nbr_iter=20) :
+	# mean latency per image in milliseconds :
+	with torch.no_grad() :
+		encoder(x)
+		start = time.perf_counter()
+		for _ in range(nbr_iter) :
+			encoder(x)
+	return 1e3*(time.perf_counter()-start)/(nbr_iter*x.size(0))
+
+def report_static_quantization(model, quantized, batches) :
+	# drift of mu between the float and the quantized encoders, and their latency per image :
+	# measured on a CPU copy of the float model, whose device and mode are left as they are.
+	model = copy.deepcopy(model).cpu().eval()
+	errors = []
+	norms = []
+	x = None
+	with torch.no_grad() :
+		for x in batches :
+			mu, _ = torch.chunk( model.encoder(x), 2, dim=1 )
+			qmu, _ = torch.chunk( quantized.encoder(x), 2, dim=1 )
+			errors.append( (qmu-mu).abs() )
+			norms.append( mu.abs() )
+	errors = torch.cat(errors, dim=0)
+	norms = torch.cat(norms, dim=0)
+
+	report = dict( mu_mean_error=errors.mean().item(),
+				mu_max_error=errors.max().item(),
+				mu_relative_error=(errors.mean()/norms.mean()).item(),
+				fp32_ms=encoder_latency(model.encoder, x[:1]),
+				int8_ms=encoder_latency(quantized.encoder, x[:1]) )
+	print('QUANTIZATION REPORT : mu drift : mean {mu_mean_error:.5f} // max {mu_max_error:.5f} // relative {mu_relative_error:.4f} :: latency per image : fp32 {fp32_ms:.3f} ms // int8 {int8_ms:.3f} ms'.format(**report) )
+	return report
+
+
+if __name__ == '__main__' :
+	import argparse
+	parser = argparse.ArgumentParser(description='Dynamic int8 quantization of betaVAEdSprite')
+	parser.add_argument('--weights', type=str, required=True, help='path to the float weights saved by the training loop')
+	parser.add_argument('--output', type=str, default=None)
+	parser.add_argument('--root', type=str, default='./dsprites-dataset/dsprites_ndarray_co1sh3sc6or40x32y32_64x64.npz')
+	parser.add_argument('--latent', type=int, default=10)
+	parser.add_argument('--nbr_check', type=int, default=1024)
+	args = parser.parse_args()
+
+	model = betaVAEdSprite(z_dim=args.latent, img_dim=64, img_depth=1, use_cuda=False)
+	model.load_state_dict( torch.load(args.weights, map_location='cpu') )
+	quantized = quantize_dynamic_dSprite(model)
+
+	# check on random dSprites images, preprocessed as in training :
+	from datasets import load_dataset
+	dataset = load_dataset('dSprite', img_dim=64, root=args.root)
+	data_loader = torch.utils.data.DataLoader(dataset=dataset, batch_size=args.nbr_check, shuffle=True)
+	x = next( calibration_batches(data_loader, nbr_batches=1) ).view(-1, 1, 64, 64)
+	check_quantization(model, quantized, x)
+
+	output = args.output
+	if output is None :
+		output = args.weights+'-int8'
+	save_quantized(quantized, output)
@@ -0,0 +1,205 @@
+import atexit
+import fcntl
+import json
+import os
+import signal
+import time
+from contextlib import contextmanager
+
+import torch
+
+from datasets import DATASETS, CachedDataset, load_dataset, cache_dataset
+
+
+# POSIX shared memory : the segments are files of this tmpfs, mapped by the processes that attach them :
+SHM_DIR = '/dev/shm'
+# namespace of the segments, registries and locks of the datasets in SHM_DIR :
+PREFIX = 'betavae-dataset-'
+
+
+def segment_path(name) :
+	return os.path.join(SHM_DIR, PREFIX+name)
+
+def registry_path(name) :
+	# shape of the images, description of the dataset, and the pids of the processes attached to it :
+	return segment_path(name)+'.json'
+
+@contextmanager
+def registry_lock(name) :
+	# the registry of a dataset is only read and written under an exclusive lock :
+	with open(segment_path(name)+'.lock', 'a') as f :
+		fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+		try :
+			yield
+		finally :
+			fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+def read_registry(name) :
+	with open(registry_path(name), 'r') as f :
+		return json.load(f)
+
+def write_registry(name, registry) :
+	tmp = '{}.tmp-{}'.format(registry_path(name), os.getpid())
+	with open(tmp, 'w') as f :
+		json.dump(registry, f)
+	os.replace(tmp, registry_path(name))
+
+def alive(pid) :
+	try :
+		os.kill(pid, 0)
+	except ProcessLookupError :
+		return False
+	except PermissionError :
+		return True
+	return True
+
+def remove(name) :
+	# the mappings of the processes still attached remain valid, the memory is freed when the last one is unmapped :
+	# (the empty lock file is kept : a process may be waiting on it)
+	for path in [ segment_path(name), registry_path(name) ] :
+		if os.path.exists(path) :
+			os.remove(path)
+
+def map_images(name, shape, create=False) :
+	# uint8 tensor over the whole segment, mapped MAP_SHARED : reading it does not copy the data.
+	nbytes = 1
+	for s in shape :
+		nbytes *= s
+	if create :
+		with open(segment_path(name), 'wb') as f :
+			f.truncate(nbytes)
+	images = torch.from_file(segment_path(name), shared=True, size=nbytes, dtype=torch.uint8)
+	return images.view(shape)
+
+
+class SharedDataset(CachedDataset) :
+	# CachedDataset whose images are a segment of POSIX shared memory, attached by name : any number of processes read
+	# the same physical pages. The processes attached to a dataset are counted in its registry, and the segment is removed
+	# by the last one to detach ; the processes that died without detaching are not counted.
+	# Pickled by name, e.g. for the workers of a data loader or of a sweep, which attach the segment themselves.
+	def __init__(self, name, images, description=None) :
+		super(SharedDataset, self).__init__(images)
+		self.name = name
+		self.description = description or {}
+		self.attached = True
+		atexit.register(self.detach)
+
+	def __reduce__(self) :
+		return (attach_dataset, (self.name,) )
+
+	def share_memory_(self) :
+		return self
+
+	def detach(self) :
+		if not self.attached :
+			return
+		self.attached = False
+		self.images = None
+		release(self.name, os.getpid())
+
+
+def publish_dataset(name, dataset, description=None, batch_size=64, num_workers=0) :
+	# decodes and preprocesses the dataset once, and copies its images to a new shared-memory segment :
+	if not os.path.isdir(SHM_DIR) :
+		raise RuntimeError('{} is not available : POSIX shared memory is required.'.format(SHM_DIR) )
+	cached = cache_dataset(dataset, batch_size=batch_size, num_workers=num_workers)
+	shape = list(cached.images.shape)
+	with registry_lock(name) :
+		if os.path.exists(registry_path(name)) and any( alive(pid) for pid in read_registry(name)['holders'] ) :
+			raise RuntimeError('the shared dataset {} is already published.'.format(name) )
+		images = map_images(name, shape, create=True)
+		images.copy_(cached.images)
+		del cached
+		write_registry(name, dict( shape=shape, dtype='uint8', description=description or {}, holders=[os.getpid()] ) )
+	print('SHARED DATASET : {} : {} images of shape {}, {:.1f} MiB in {}.'.format(name, shape[0], tuple(shape[1:]), images.numel()/2**20, segment_path(name)) )
+	return SharedDataset(name, images, description)
+
+def attach_dataset(name, expected=None) :
+	# zero-copy view of a published dataset, counted as one more reference.
+	# expected : description (dataset, img_dim, stacking) that the published dataset must match, e.g. that of the model :
+	with registry_lock(name) :
+		if not os.path.exists(registry_path(name)) :
+			raise FileNotFoundError('no shared dataset {} in {} : start it with python shared_dataset.py --serve --name {} ...'.format(name, SHM_DIR, name) )
+		registry = read_registry(name)
+		mismatch = dict( (k, (registry['description'].get(k), v)) for k, v in (expected or {}).items() if registry['description'].get(k) != v )
+		if mismatch :
+			raise ValueError('the shared dataset {} does not match : {}'.format(name, ' // '.join( '{} : published {}, expected {}'.format(k, *v) for k, v in mismatch.items() ) ) )
+		registry['holders'] = [ pid for pid in registry['holders'] if alive(pid) ] + [os.getpid()]
+		write_registry(name, registry)
+		images = map_images(name, registry['shape'])
+	print('SHARED DATASET : {} attached : {} images of shape {}, {} processes.'.format(name, registry['shape'][0], tuple(registry['shape'][1:]), len(registry['holders'])) )
+	return SharedDataset(name, images, registry['description'])
+
+def release(name, pid) :
+	# removes one reference of the process pid, and the dataset once no live process holds it :
+	with registry_lock(name) :
+		if not os.path.exists(registry_path(name)) :
+			return
+		registry = read_registry(name)
+		if pid in registry['holders'] :
+			registry['holders'].remove(pid)
+		registry['holders'] = [ p for p in registry['holders'] if alive(p) ]
+		if len(registry['holders']) == 0 :
+			remove(name)
+			print('SHARED DATASET : {} removed.'.format(name) )
+		else :
+			write_registry(name, registry)
+
+def holders(name) :
+	with registry_lock(name) :
+		return [ pid for pid in read_registry(name)['holders'] if alive(pid) ]
+
+def list_datasets() :
+	names = [ f[len(PREFIX):-len('.json')] for f in os.listdir(SHM_DIR) if f.startswith(PREFIX) and f.endswith('.json') ]
+	return dict( (name, read_registry(name)) for name in sorted(names) )
+
+def default_name(dataset, img_dim, stacking=False) :
+	return '{}-img{}{}'.format(dataset, img_dim, '-stacked' if stacking else '')
+
+def serve(name, dataset, description=None, exit_when_unused=False, poll_interval=5.0) :
+	# holds the dataset until SIGTERM/SIGINT, or until no other process is attached to it (exit_when_unused),
+	# then detaches : the segment is removed when the last process attached to it detaches.
+	shared = publish_dataset(name, dataset, description=description)
+	stop = []
+	signal.signal(signal.SIGTERM, lambda signum, frame : stop.append(signum) )
+	used = False
+	try :
+		while not stop :
+			time.sleep(poll_interval)
+			if not os.path.exists(registry_path(name)) :
+				# removed with --cleanup :
+				break
+			clients = len(holders(name)) - 1
+			used = used or clients > 0
+			if exit_when_unused and used and clients == 0 :
+				break
+	except KeyboardInterrupt :
+		pass
+	finally :
+		shared.detach()
+
+
+if __name__ == '__main__' :
+	import argparse
+	parser = argparse.ArgumentParser(description='Shared-memory dataset server : the dataset is decoded once into {} and attached by name by the training processes (--shared_dataset NAME)'.format(SHM_DIR) )
+	parser.add_argument('--serve',action='store_true',default=False, help='publish the dataset and hold it until SIGTERM/Ctrl-C')
+	parser.add_argument('--list',action='store_true',default=False, help='list the published datasets and their processes')
+	parser.add_argument('--cleanup', type=str, default=None, help='remove the dataset of this name, whether processes are attached or not')
+	parser.add_argument('--name', type=str, default=None, help='default : <dataset>-img<img_dim>[-stacked]')
+	parser.add_argument('--dataset', type=str, default='XYS', choices=list(DATASETS.keys()))
+	parser.add_argument('--img_dim', type=int, default=256)
+	parser.add_argument('--stacked',action='store_true',default=False)
+	parser.add_argument('--exit_when_unused',action='store_true',default=False, help='stop serving once the last training process detached')
+	args = parser.parse_args()
+
+	if args.list :
+		for name, registry in list_datasets().items() :
+			live = [ pid for pid in registry['holders'] if alive(pid) ]
+			print('{} : {} images of shape {} : {} : processes {}'.format(name, registry['shape'][0], tuple(registry['shape'][1:]), registry['description'], live) )
+	elif args.cleanup is not None :
+		with registry_lock(args.cleanup) :
+			remove(args.cleanup)
+	elif args.serve :
+		name = args.name or default_name(args.dataset, args.img_dim, args.stacked)
+		description = dict( dataset=args.dataset, img_dim=args.img_dim, stacking=args.stacked )
+		serve(name, load_dataset(args.dataset, img_dim=args.img_dim, stacking=args.stacked), description=description, exit_when_unused=args.exit_when_unused)
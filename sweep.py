@@ -0,0 +1,243 @@
+import itertools
+import json
+import math
+import os
+import time
+
+import torch
+import torch.multiprocessing as multiprocessing
+
+from models import MODEL_SETTINGS, build_model
+from datasets import DATASETS, load_dataset, cache_dataset, make_data_loader
+from engine import train_model, default_memory_budget
+from profiler import saved_activation_bytes
+from likelihood import evaluate_iwae
+from shared_dataset import attach_dataset
+
+
+# values of the keys that a configuration does not set :
+DEFAULTS = dict( model='betaVAEXYS2', beta=1.0, lr=1e-4, seed=0, batch_size=32 )
+# keys of a configuration forwarded to build_model :
+MODEL_KEYS = ['z_dim', 'conv_dim', 'net_depth', 'separable']
+# memory of a worker besides its model and activations (interpreter, torch, data loader) :
+WORKER_OVERHEAD = 512*2**20
+
+
+def parse_value(text) :
+	for cast in [int, float] :
+		try :
+			return cast(text)
+		except ValueError :
+			pass
+	return {'True':True, 'False':False}.get(text, text)
+
+def parse_grid(items) :
+	# ['beta=1,10,100', 'lr=1e-4'] -> {'beta':[1,10,100], 'lr':[1e-4]} :
+	grid = {}
+	for item in items :
+		key, values = item.split('=', 1)
+		grid[key] = [ parse_value(v) for v in values.split(',') ]
+	return grid
+
+def expand_grid(grid, base=None) :
+	# every combination of the values of the grid, on top of the base configuration :
+	keys = sorted(grid.keys())
+	configs = []
+	for values in itertools.product( *[ grid[k] for k in keys ] ) :
+		config = dict(base or {})
+		config.update( zip(keys, values) )
+		configs.append(config)
+	return configs
+
+def load_configurations(path) :
+	# JSON file : either a list of configurations, or {"base": {...}, "grid": {key: [values]}} :
+	with open(path, 'r') as f :
+		spec = json.load(f)
+	if isinstance(spec, list) :
+		return spec
+	return expand_grid( spec.get('grid', {}), base=spec.get('base') )
+
+def complete(config) :
+	full = dict(DEFAULTS)
+	full.update(config)
+	return full
+
+def config_name(config) :
+	# unique and readable name of a configuration, used as the folder of its run :
+	return '-'.join( '{}{}'.format(k, config[k]) for k in sorted(config.keys()) )
+
+def model_setting(config, img_dim) :
+	setting = dict( (k, config[k]) for k in MODEL_KEYS if k in config )
+	setting['img_dim'] = img_dim
+	return setting
+
+def job_memory_bytes(config, img_dim, probe_size=2) :
+	# resident memory of a training process : the weights, gradients and Adam moments, the activations of a batch
+	# (measured per image on a probe batch), and the fixed overhead of a worker. The dataset is shared, thus not counted.
+	model = build_model(config['model'], beta=config['beta'], **model_setting(config, img_dim) )
+	param_bytes = sum( p.numel()*p.element_size() for p in model.parameters() )
+	x = torch.rand( (probe_size, model.img_depth, model.img_dim, model.img_dim) )
+	per_image = saved_activation_bytes(model, x) / probe_size
+	return 4*param_bytes + per_image*config['batch_size'] + WORKER_OVERHEAD
+
+def pool_size(configs, img_dim, threads=None, memory_budget=None) :
+	# number of concurrent training processes, bounded by the cores (threads per process) and the memory of the host,
+	# and the number of threads of each process :
+	cores = os.cpu_count() or 1
+	if memory_budget is None :
+		memory_budget = default_memory_budget( torch.device('cpu') )
+	# one probe per distinct architecture and batch size :
+	architectures = dict( ( json.dumps( [ config.get(k) for k in ['model','batch_size']+MODEL_KEYS ] ), config ) for config in configs )
+	job_bytes = max( job_memory_bytes(config, img_dim) for config in architectures.values() )
+	by_memory = max(1, int(memory_budget // job_bytes) )
+	by_cores = max(1, cores // threads) if threads else cores
+	nbr_workers = max(1, min( len(configs), by_memory, by_cores ) )
+	if not threads :
+		threads = max(1, cores // nbr_workers)
+	print('SWEEP : {} processes of {} threads ({} cores, {:.1f} MiB per process out of {:.1f} MiB).'.format(nbr_workers, threads, cores, job_bytes/2**20, memory_budget/2**20) )
+	return nbr_workers, threads
+
+def rung_epochs(min_epoch, max_epoch, eta) :
+	# number of epochs reached by the surviving configurations at each rung of successive halving :
+	# min_epoch, eta*min_epoch, eta^2*min_epoch, ..., max_epoch.
+	if eta <= 1 or min_epoch >= max_epoch :
+		return [max_epoch]
+	epochs = []
+	epoch = min_epoch
+	while epoch < max_epoch :
+		epochs.append(epoch)
+		epoch *= eta
+	return epochs + [max_epoch]
+
+
+# state of a worker process, set once by init_worker :
+WORKER = {}
+
+def init_worker(dataset, eval_dataset, threads, options) :
+	# the training and held-out subsets are received once per process, the storage of the dataset being shared with the parent :
+	WORKER['dataset'] = dataset
+	WORKER['eval_dataset'] = eval_dataset
+	WORKER['options'] = options
+	torch.set_num_threads(threads)
+
+def run_trial(job) :
+	# trains a configuration up to nbr_epoch epochs, continuing from its own checkpoint after the first rung,
+	# and scores it with the ELBO (log p(x) lower bound per image, which does not depend on beta) of the held-out images,
+	# the same for every trial and never trained on :
+	config, nbr_epoch, resume = job
+	options = WORKER['options']
+	dataset = WORKER['dataset']
+	name = config_name(config)
+	path = '{}/{}'.format(options['sweep'], name)
+	SAVE_PATH = './beta-data/{}'.format(path)
+	start = time.perf_counter()
+	try :
+		torch.manual_seed(config['seed'])
+		use_cuda = torch.cuda.is_available()
+		betavae = build_model(config['model'], beta=config['beta'], use_cuda=use_cuda, **model_setting(config, options['img_dim']) )
+		optimizer = torch.optim.Adam( betavae.parameters(), lr=config['lr'])
+		data_loader = make_data_loader(dataset, batch_size=config['batch_size'], seed=config['seed'])
+		os.makedirs(SAVE_PATH, exist_ok=True)
+		engine = train_model(betavae, data_loader, optimizer, SAVE_PATH, path, nbr_epoch=nbr_epoch, stacking=options['stacking'], scale=options['scale'], log_interval=options['log_interval'], reconst_interval=0, traversal_interval=0, background_visualization=False, keep_last=1, keep_best=1, resume=resume)
+
+		eval_loader = torch.utils.data.DataLoader(dataset=WORKER['eval_dataset'], batch_size=config['batch_size'], shuffle=False)
+		report = evaluate_iwae(betavae, eval_loader, K=options['eval_K'], nbr_batches=options['eval_batches'])
+		return dict( status='ok', name=name, config=config, epochs=nbr_epoch, score=-report['elbo'], elbo=report['elbo'], iwae=report['iwae'], train_loss=engine.best_loss, wall_time=time.perf_counter()-start )
+	except Exception as e :
+		print('EXCEPTION : SWEEP : {} : {}'.format(name, e) )
+		return dict( status='failed', name=name, config=config, epochs=nbr_epoch, error=repr(e), wall_time=time.perf_counter()-start )
+
+
+def split_dataset(dataset, held_out=0.1, seed=0) :
+	# (training, held-out) subsets of the dataset, drawn once with their own generator :
+	nbr_held_out = max(1, int( round(held_out*len(dataset)) ))
+	generator = torch.Generator()
+	generator.manual_seed(seed)
+	indexes = torch.randperm(len(dataset), generator=generator).tolist()
+	return torch.utils.data.Subset(dataset, indexes[nbr_held_out:]), torch.utils.data.Subset(dataset, indexes[:nbr_held_out])
+
+def run_sweep(configs, dataset, sweep='sweep', img_dim=256, stacking=False, scale=1.0, min_epoch=1, max_epoch=100, eta=3, threads=None, memory_budget=None, log_interval=100, eval_K=1, eval_batches=10, held_out=0.1, split_seed=0) :
+	# Successive halving over the configurations : every configuration is trained for min_epoch epochs, then only the best
+	# 1/eta of them (lowest negative ELBO) continue up to eta times more epochs, and so on up to max_epoch.
+	# The trainings of a rung run concurrently in a process pool, sharing the (read-only) dataset, and every result is
+	# appended to the index ./beta-data/<sweep>/index.jsonl.
+	# The configurations are trained on the same (1-held_out) part of the dataset and scored on the rest.
+	configs = [ complete(config) for config in configs ]
+	folder = './beta-data/{}'.format(sweep)
+	os.makedirs(folder, exist_ok=True)
+	index_path = os.path.join(folder, 'index.jsonl')
+
+	nbr_workers, threads = pool_size(configs, img_dim, threads=threads, memory_budget=memory_budget)
+	options = dict( sweep=sweep, img_dim=img_dim, stacking=stacking, scale=scale, log_interval=log_interval, eval_K=eval_K, eval_batches=eval_batches )
+	context = multiprocessing.get_context('spawn')
+	train_dataset, eval_dataset = split_dataset(dataset, held_out=held_out, seed=split_seed)
+	print('SWEEP : {} training images, {} held-out images.'.format(len(train_dataset), len(eval_dataset)) )
+	pool = context.Pool(processes=nbr_workers, initializer=init_worker, initargs=(train_dataset, eval_dataset, threads, options) )
+
+	survivors = configs
+	results = []
+	try :
+		rungs = rung_epochs(min_epoch, max_epoch, eta)
+		for rung, nbr_epoch in enumerate(rungs) :
+			print('SWEEP : rung {}/{} : {} configurations up to epoch {}.'.format(rung+1, len(rungs), len(survivors), nbr_epoch) )
+			jobs = [ (config, nbr_epoch, rung > 0) for config in survivors ]
+			rung_results = []
+			with open(index_path, 'a') as index :
+				for result in pool.imap_unordered(run_trial, jobs) :
+					result['rung'] = rung
+					rung_results.append(result)
+					index.write( json.dumps(result)+'\n' )
+					index.flush()
+			results += rung_results
+
+			ranked = sorted( [ r for r in rung_results if r['status'] == 'ok' ], key=lambda r : r['score'] )
+			if rung < len(rungs)-1 :
+				survivors = [ r['config'] for r in ranked[:max(1, int(math.ceil(len(ranked)/eta)) )] ]
+			if len(survivors) == 0 :
+				break
+	finally :
+		pool.close()
+		pool.join()
+
+	final = sorted( [ r for r in results if r['status'] == 'ok' and r['epochs'] == max_epoch ], key=lambda r : r['score'] )
+	for r in final :
+		print('SWEEP : {} : -ELBO {:.3f} nats after {} epochs.'.format(r['name'], r['score'], r['epochs']) )
+	return results
+
+
+if __name__ == '__main__' :
+	import argparse
+	parser = argparse.ArgumentParser(description='Hyperparameter sweep with successive halving, over a pool of training processes sharing one cached dataset')
+	parser.add_argument('--configs', type=str, default=None, help='JSON file : a list of configurations, or {"base": {...}, "grid": {key: [values]}}')
+	parser.add_argument('--grid', type=str, nargs='*', default=[], help='key=v1,v2,... items, e.g. model=betaVAEXYS2,betaVAEXYS3 beta=1,10,100 lr=1e-4')
+	parser.add_argument('--sweep', type=str, default='sweep', help='name of the sweep folder in ./beta-data')
+	parser.add_argument('--dataset', type=str, default='XYS', choices=list(DATASETS.keys()))
+	parser.add_argument('--img_dim', type=int, default=256)
+	parser.add_argument('--stacked',action='store_true',default=False)
+	parser.add_argument('--min_epoch', type=int, default=1, help='epochs of the first rung')
+	parser.add_argument('--max_epoch', type=int, default=100, help='epochs of the configurations that survive every rung')
+	parser.add_argument('--eta', type=int, default=3, help='only the best 1/eta of the configurations continue at each rung (1 : plain grid search)')
+	parser.add_argument('--threads', type=int, default=None, help='threads per training process (default : the cores split between the processes)')
+	parser.add_argument('--memory_budget', type=float, default=0, help='memory available to the training processes, in MiB (0 : detected)')
+	parser.add_argument('--log_interval', type=int, default=100)
+	parser.add_argument('--eval_K', type=int, default=1, help='importance samples of the evaluation bound (1 : ELBO)')
+	parser.add_argument('--eval_batches', type=int, default=10, help='batches of the held-out images the configurations are scored on')
+	parser.add_argument('--held_out', type=float, default=0.1, help='fraction of the dataset held out of the trainings to score the configurations')
+	parser.add_argument('--split_seed', type=int, default=0)
+	parser.add_argument('--shared_dataset', type=str, default=None, help='use the images published under this name by shared_dataset.py --serve instead of decoding the dataset')
+	args = parser.parse_args()
+
+	# the grid of the command line is expanded on top of each configuration of the file :
+	bases = load_configurations(args.configs) if args.configs is not None else [ {} ]
+	configs = [ config for base in bases for config in expand_grid( parse_grid(args.grid), base=base) ]
+	for config in configs :
+		if complete(config)['model'] not in MODEL_SETTINGS :
+			raise ValueError('unknown model : {}'.format(complete(config)['model']) )
+
+	if args.shared_dataset is not None :
+		# pickled by name : every worker attaches the segment of the dataset server :
+		dataset = attach_dataset(args.shared_dataset, expected=dict(dataset=args.dataset, img_dim=args.img_dim, stacking=args.stacked))
+	else :
+		dataset = cache_dataset( load_dataset(args.dataset, img_dim=args.img_dim, stacking=args.stacked) ).share_memory_()
+	scale = 255.0 if args.dataset == 'dSprite' else 1.0
+	run_sweep(configs, dataset, sweep=args.sweep, img_dim=args.img_dim, stacking=args.stacked, scale=scale, min_epoch=args.min_epoch, max_epoch=args.max_epoch, eta=args.eta, threads=args.threads, memory_budget=args.memory_budget*2**20 if args.memory_budget > 0 else None, log_interval=args.log_interval, eval_K=args.eval_K, eval_batches=args.eval_batches, held_out=args.held_out, split_seed=args.split_seed)
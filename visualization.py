@@ -0,0 +1,107 @@
+import multiprocessing
+import os
+import queue
+
+import torch
+import torchvision
+from PIL import Image
+
+
+def traversal_grid(mu_mean, sigma_mean, nbr_steps=8) :
+	# [z_dim*nbr_steps, z_dim] latent grid : the rows latent*nbr_steps+i are equal to mu_mean,
+	# except for the latent-th variable which is set to mu_mean-sigma_mean + i*2*sigma_mean/nbr_steps.
+	z_dim = mu_mean.size(0)
+	steps = torch.arange(nbr_steps, dtype=mu_mean.dtype, device=mu_mean.device)
+	values = (mu_mean-sigma_mean).unsqueeze(1) + steps.unsqueeze(0)*(2.0*sigma_mean/nbr_steps).unsqueeze(1)
+
+	grid = mu_mean.view(1, 1, z_dim).repeat(z_dim, nbr_steps, 1)
+	latents = torch.arange(z_dim, device=mu_mean.device)
+	grid[latents, :, latents] = values
+	return grid.view(z_dim*nbr_steps, z_dim)
+
+def render_traversal(decoder, mu_mean, sigma_mean, nbr_steps=8, chunk_size=None, img_shape=None, blank_row=False) :
+	# decodes the whole latent traversal grid in one (or chunk_size-sized) no-grad call(s),
+	# with the decoder in eval mode, and returns the images on CPU :
+	device = next(decoder.parameters()).device
+	mu_mean = torch.as_tensor(mu_mean, dtype=torch.float32).to(device)
+	sigma_mean = torch.as_tensor(sigma_mean, dtype=torch.float32).to(device)
+	z = traversal_grid(mu_mean, sigma_mean, nbr_steps=nbr_steps)
+
+	training = decoder.training
+	decoder.eval()
+	with torch.no_grad() :
+		if chunk_size is None :
+			images = decoder(z)
+		else :
+			images = torch.cat( [ decoder(chunk) for chunk in torch.split(z, chunk_size, dim=0) ], dim=0)
+	decoder.train(training)
+
+	images = images.float().cpu()
+	if img_shape is not None :
+		images = images.view( (-1,)+tuple(img_shape) )
+	if blank_row :
+		images = torch.cat( [ torch.ones( (nbr_steps,)+tuple(images.shape[1:]) ), images], dim=0)
+	return images
+
+def save_images(images, path, nrow=8, writer=None) :
+	# encoded in the background by the writer (a VisualizationWriter) if any, on the calling thread otherwise :
+	if writer is not None :
+		writer.submit(images, path, nrow=nrow)
+	else :
+		torchvision.utils.save_image(images, path, nrow=nrow)
+
+def save_traversal(decoder, mu_mean, sigma_mean, path, nbr_steps=8, scale=1.0, writer=None, **kwargs) :
+	# one row of nbr_steps images per latent variable :
+	images = render_traversal(decoder, mu_mean, sigma_mean, nbr_steps=nbr_steps, **kwargs)
+	save_images(scale*images, path, nrow=nbr_steps, writer=writer)
+	return images
+
+def encode_image(images, path, nrow=8, image_format='png', compress_level=6) :
+	# grid of the (N,C,H,W) images in [0,1], saved as path with the extension of image_format :
+	# png with a zlib level from 0 (uncompressed, fastest) to 9, or bmp (raw).
+	grid = torchvision.utils.make_grid( torch.as_tensor(images), nrow=nrow)
+	array = grid.mul(255).add_(0.5).clamp_(0,255).permute(1,2,0).to(torch.uint8).numpy()
+	path = '{}.{}'.format( os.path.splitext(path)[0], image_format)
+	if image_format == 'png' :
+		Image.fromarray(array).save(path, compress_level=compress_level)
+	else :
+		Image.fromarray(array).save(path)
+	return path
+
+def visualization_worker(jobs) :
+	while True :
+		job = jobs.get()
+		if job is None :
+			return
+		try :
+			encode_image(**job)
+		except Exception as e :
+			print('EXCEPTION : VISUALIZATION : {}'.format(e) )
+
+
+class VisualizationWriter(object) :
+	# Grids built and encoded in a separate process :
+	# the training thread only hands off the rendered images, as a host array, and never waits for the writer.
+	# When max_pending images are already queued, the new ones are dropped rather than stalling the training.
+	def __init__(self, image_format='png', compress_level=6, max_pending=4) :
+		self.image_format = image_format
+		self.compress_level = compress_level
+		self.dropped = 0
+		# spawned rather than forked, the training process runs intra-op and checkpoint threads :
+		context = multiprocessing.get_context('spawn')
+		self.jobs = context.Queue(maxsize=max_pending)
+		self.process = context.Process(target=visualization_worker, args=(self.jobs,), daemon=True)
+		self.process.start()
+
+	def submit(self, images, path, nrow=8) :
+		job = dict( images=images.detach().float().cpu().numpy(), path=path, nrow=nrow, image_format=self.image_format, compress_level=self.compress_level)
+		try :
+			self.jobs.put_nowait(job)
+		except queue.Full :
+			self.dropped += 1
+			print('EXCEPTION : VISUALIZATION : the writer is behind, {} is dropped.'.format(path) )
+
+	def close(self) :
+		# waits for the queued images :
+		self.jobs.put(None)
+		self.process.join()